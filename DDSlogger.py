@@ -1,12 +1,44 @@
-from genericpath import exists
+import atexit
 import configparser
 import os.path
 import logging
+import logging.handlers
+import queue
+
+# LOG SWITCHES
+class LogSwitches:
+    """
+        The per-layer switches of DDS.ini resolved once into plain booleans, e.g. LOG.perfectlink,
+        so that the hot paths test an attribute instead of parsing the configuration. They can be toggled at runtime by set.
+    """
+
+    NAMES = ('fairlosslink', 'stubbornlink', 'perfectlink', 'perfectfailuredector', 'membership')
+
+    def __init__(self, section = None) -> None:
+        for name in self.NAMES:
+            setattr(self, name, section.getboolean(name, fallback=False) if section != None else False)
+
+    def set(self, name : str, enabled : bool) -> None:
+        if name not in self.NAMES:
+            raise ValueError('Unknown log switch '+str(name))
+        setattr(self, name, enabled)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+        Enqueues the records as they are, the message is formatted by the thread writing the log and not by the logging one.
+        The objects passed as arguments (e.g. the messages of the links) must not be modified after being logged.
+    """
+
+    def prepare(self, record):
+        if record.exc_info: # the traceback cannot wait
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
 
 # LOAD LOGGING CONFIGURATION
 LOG_Enabled = False
 if os.path.isfile('DDS.ini'):
-    
+
     config = configparser.ConfigParser()
     config.read('DDS.ini')
 
@@ -17,11 +49,27 @@ if os.path.isfile('DDS.ini'):
     logger = logging.getLogger(config['LOG']['name'])
     logger.setLevel(int(config['LOG']['level']))
     fh = logging.FileHandler(config['LOG']['fileName'])
-    logger.addHandler(fh)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
+
     fh.setFormatter(formatter)
 
+    if config['LOG'].getboolean('async', fallback=False):
+        # the file is written by a background thread, the logging threads only enqueue the records
+        listener = logging.handlers.QueueListener(queue.SimpleQueue(), fh)
+        logger.addHandler(LazyQueueHandler(listener.queue))
+        listener.start()
+        atexit.register(listener.stop) # flushes the enqueued records
+    else:
+        logger.addHandler(fh)
+
+    logger.propagate = False
+
+    LOG_Enabled = True
+else: # logging disabled
+    config = configparser.ConfigParser()
+    config['LOG'] = {}
+    logger = logging.getLogger('DDS')
+    logger.addHandler(logging.NullHandler())
     logger.propagate = False
 
-    LOG_Enabled = True
\ No newline at end of file
+LOG = LogSwitches(config['LOG'])
@@ -0,0 +1,100 @@
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+# Runs a distributed system of N processes on the local host, without Mininet (and without root privileges):
+# every process listens on its own port and owns a loopback address 127.x.y.z, the ones of a Linux host are all local.
+# Each process runs in its own directory, with its own copy of DDS.ini and its own log file.
+
+PROCESS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process.py')
+
+def localAddress(pid : int, base_port : int) -> str:
+    """ 'IP:port' of process pid """
+    n = pid + 1 # 127.0.0.0 is not a host address
+    return '127.%d.%d.%d:%d' % ((n >> 16) & 255, (n >> 8) & 255, n & 255, base_port + pid)
+
+# generate configuration files for local simulations (same format as the mininet ones, with 'IP:port' addresses)
+def generateProcessConfigurationFilesLocal(n_processes : int, base_port : int, edges : list = None, config_dir : str = '.'):
+    """
+    Args:
+        edges (list): pairs of pids linked in the communication network, complete network if None
+    """
+    with open(os.path.join(config_dir, 'pid_IPaddr_map.txt'), 'w') as fd:
+        for pid in range(n_processes):
+            fd.write(str(pid)+' '+localAddress(pid, base_port)+'\n')
+    with open(os.path.join(config_dir, 'outLinks.txt'), 'w') as fd:
+        if edges == None:
+            fd.write('* *\n') # encoding for fully connected communication network
+            return
+        neighbors = {pid : [] for pid in range(n_processes)}
+        for u, v in edges:
+            neighbors[u].append(v)
+            neighbors[v].append(u)
+        for pid in range(n_processes):
+            fd.write(str(pid)+' '+" ".join(str(v)+':'+localAddress(v, base_port) for v in neighbors[pid])+'\n')
+
+def launchProcesses(n_processes : int, run_dir : str, link : str = 'simple', trace : bool = False) -> dict:
+    """ starts process.py for every pid, returns pid -> subprocess.Popen. With trace, every process records <run_dir>/<pid>/trace """
+    processes = {}
+    for pid in range(n_processes):
+        process_dir = os.path.join(run_dir, str(pid))
+        os.makedirs(process_dir, exist_ok=True)
+        if os.path.isfile('DDS.ini'):
+            shutil.copy('DDS.ini', process_dir)
+        command = [sys.executable, PROCESS_SCRIPT, '--pid', str(pid), '--link', link, '--config-dir', os.path.abspath(run_dir)]
+        if trace:
+            command += ['--trace-file', 'trace']
+        processes[pid] = subprocess.Popen(command, cwd=process_dir, start_new_session=True) # own process group, for the teardown
+    return processes
+
+def teardown(processes : dict, grace : float = 2) -> None:
+    """ SIGTERM to every process, SIGKILL to the ones still alive after grace seconds """
+    for p in processes.values():
+        if p.poll() == None:
+            os.killpg(p.pid, signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    for p in processes.values():
+        try:
+            p.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            os.killpg(p.pid, signal.SIGKILL)
+            p.wait()
+
+def TestOnLocalHost(n_processes : int, link : str = 'simple', base_port : int = 3210, edges : list = None, run_dir : str = 'local_run', duration : float = None, trace : bool = False):
+    """ runs the processes for duration seconds (until interrupted if None), or until one of them terminates """
+    os.makedirs(run_dir, exist_ok=True)
+    generateProcessConfigurationFilesLocal(n_processes, base_port, edges, run_dir)
+    processes = launchProcesses(n_processes, run_dir, link, trace)
+    print('started '+str(n_processes)+' processes, logs in '+os.path.abspath(run_dir)+'/<pid>/')
+    try:
+        deadline = None if duration == None else time.monotonic() + duration
+        while deadline == None or time.monotonic() < deadline:
+            if any(p.poll() != None for p in processes.values()):
+                print('terminated processes: '+str([pid for pid, p in processes.items() if p.poll() != None]))
+                break
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        teardown(processes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='runs a distributed system of processes on the local host')
+    parser.add_argument('-n', '--processes', type=int, default=3)
+    parser.add_argument('--link', default='simple', choices=('simple', 'mtc', 'persistent', 'asyncio', 'udp'))
+    parser.add_argument('--base-port', type=int, default=3210, help='process pid listens on base-port + pid')
+    parser.add_argument('--topology', default='complete', choices=('complete', 'ring'))
+    parser.add_argument('--duration', type=float, default=None, help='seconds, until interrupted (Ctrl-C) by default')
+    parser.add_argument('--run-dir', default='local_run')
+    parser.add_argument('--trace', action='store_true', help='binary traces of the events, merged by: python3 tracer.py merge <run-dir>/*/trace')
+    args = parser.parse_args()
+
+    edges = None
+    if args.topology == 'ring':
+        edges = [(pid, (pid + 1) % args.processes) for pid in range(args.processes)]
+    TestOnLocalHost(args.processes, args.link, args.base_port, edges, args.run_dir, args.duration, args.trace)
@@ -24,6 +24,7 @@ config['LOG']['perfectlink'] = 'false'
 config['LOG']['perfectfailuredector'] = 'true'
 config['LOG']['name'] = 'DDS'
 config['LOG']['fileName'] = 'DDS.log'
+config['LOG']['async'] = 'false' # true: the log file is written by a background thread
 with open('DDS.ini', 'w') as configfile:
     config.write(configfile)
 
@@ -0,0 +1,240 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+import metrics
+
+# Benchmark of the link stacks over loopback: a sender process sends count messages of size bytes to each of fanout
+# receiver processes, at rate messages per second (0: as fast as possible), and the results are stored as JSON.
+#
+#   python3 benchmark.py --links simple,mtc:1:4,persistent --layers fll,pl_stubborn,pl_pingpong --sizes 64,4096 --fanout 1,4 -o results.json
+#   python3 benchmark.py --compare baseline.json results.json
+#
+# Every process runs in its own directory, the DDS.ini of the current directory (if any) is copied there.
+
+LINKS = ('simple', 'mtc', 'persistent', 'asyncio', 'udp')
+LAYERS = ('fll', 'pl_stubborn', 'pl_pingpong')
+
+def percentile(values : list, p : float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def loopbackBytes() -> int:
+    """ bytes transmitted on the loopback interface (all the processes of the host), None if not available """
+    try:
+        with open('/proc/net/dev') as fd:
+            for line in fd:
+                name, _, counters = line.partition(':')
+                if name.strip() == 'lo':
+                    return int(counters.split()[8])
+    except OSError:
+        pass
+    return None
+
+def resources() -> dict:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'cpu_user' : usage.ru_utime, 'cpu_system' : usage.ru_stime, 'max_rss_kb' : usage.ru_maxrss}
+
+### WORKERS (one process per pid)
+
+def buildStack(spec : dict, pid : str):
+    """ returns (fll, layer) of the process, layer being the fll itself for 'fll' """
+    import link
+    from DS_local import localAddress
+
+    addresses = {str(p) : localAddress(p, spec['base_port']).rsplit(':', 1) for p in range(spec['fanout'] + 1)}
+    addresses = {p : (ip, int(port)) for p, (ip, port) in addresses.items()}
+    ip, port = addresses[pid]
+    kind, *threads = spec['link'].split(':')
+    if kind == 'simple':
+        fll = link.FairLossLink_vTCP_simple(pid, port, addresses, source_address=ip)
+    elif kind == 'mtc':
+        n_in, n_out = (int(n) for n in threads) if threads else (1, 1)
+        fll = link.FairLossLink_vTCP_MTC(pid, port, addresses, n_threads_in=n_in, n_threads_out=n_out, source_address=ip)
+    elif kind == 'persistent':
+        fll = link.FairLossLink_vTCP_persistent(pid, port, addresses)
+    elif kind == 'asyncio':
+        fll = link.FairLossLink_vAsyncio(pid, port, addresses)
+    else:
+        fll = link.FairLossLink_vUDP(pid, port, addresses)
+    if spec['layer'] == 'fll':
+        return fll, fll
+    if spec['layer'] == 'pl_stubborn':
+        return fll, link.PerfectLinkOnStubborn(link.StubbornLink(fll, spec['timeout']))
+    return fll, link.PerfectLinkPingPong(fll, timeout=spec['timeout'])
+
+def retransmissions(layer) -> int:
+    if hasattr(layer, 'sl'):
+        return layer.sl.stats()['retransmitted']
+    return layer.stats().get('retransmitted', 0)
+
+def report(fll, layer, **results) -> None:
+    results.update(resources())
+    fll_stats = fll.stats()
+    results['sent_messages'] = fll_stats['sent']
+    results['sent_bytes'] = fll_stats['sent_bytes']
+    results['retransmissions'] = retransmissions(layer)
+    results['stats'] = metrics.stats()
+    print(json.dumps(results), flush=True)
+    os._exit(0)
+
+def runReceiver(spec : dict, pid : str) -> None:
+    fll, layer = buildStack(spec, pid)
+    deliveries = layer.getDeliverEvents()
+    print('ready', flush=True)
+    latencies = []
+    received = set()
+    first = last = None
+    while len(received) < spec['count']:
+        try:
+            _, message = deliveries.get(timeout=spec['idle_timeout'])
+        except Exception: # queue.Empty, the missing messages are lost
+            break
+        now = time.monotonic() # system-wide clock, comparable among the processes of the host
+        if message[0] in received: # duplicate (fair-loss link)
+            continue
+        received.add(message[0])
+        latencies.append(now - message[1])
+        if first == None:
+            first = now
+        last = now
+    report(fll, layer, role='receiver', pid=pid, delivered=len(received), first_delivery=first, last_delivery=last, latencies=latencies)
+
+def runSender(spec : dict) -> None:
+    fll, layer = buildStack(spec, '0')
+    state = {'start' : None, 'sent' : 0}
+    signal.signal(signal.SIGTERM, lambda *_: report(fll, layer, role='sender', pid='0', start=state['start'], offered=state['sent']))
+    payload = 'x' * spec['size']
+    receivers = [str(p) for p in range(1, spec['fanout'] + 1)]
+    interval = 1 / spec['rate'] if spec['rate'] else 0
+    state['start'] = time.monotonic()
+    for i in range(spec['count']):
+        for receiver in receivers:
+            layer.send(receiver, ['MID:'+str(i), time.monotonic(), payload])
+            state['sent'] += 1
+        if interval:
+            time.sleep(max(0, state['start'] + (i + 1) * interval - time.monotonic()))
+    while True: # retransmissions go on until the end of the scenario
+        time.sleep(1)
+
+### HARNESS
+
+def runScenario(spec : dict, run_dir : str) -> dict:
+    def start(role, pid):
+        process_dir = os.path.join(run_dir, pid)
+        os.makedirs(process_dir, exist_ok=True)
+        if os.path.isfile('DDS.ini'):
+            with open('DDS.ini') as src, open(os.path.join(process_dir, 'DDS.ini'), 'w') as dst:
+                dst.write(src.read())
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', role, '--pid', pid, '--spec', json.dumps(spec)],
+                                cwd=process_dir, stdout=subprocess.PIPE, text=True, start_new_session=True)
+
+    receivers = [start('receiver', str(p)) for p in range(1, spec['fanout'] + 1)]
+    sender = None
+    try:
+        for p in receivers:
+            p.stdout.readline() # ready
+        wire_before = loopbackBytes()
+        sender = start('sender', '0')
+        results = [json.loads(p.communicate()[0]) for p in receivers]
+        os.killpg(sender.pid, signal.SIGTERM)
+        sender_results = json.loads(sender.communicate()[0] or 'null')
+        wire_after = loopbackBytes()
+    finally: # e.g. interrupted, the workers must not keep the ports of the next runs
+        for p in receivers + [sender]:
+            if p != None and p.poll() == None:
+                os.killpg(p.pid, signal.SIGKILL)
+                p.wait()
+
+    latencies = [l for r in results for l in r.pop('latencies')]
+    delivered = sum(r['delivered'] for r in results)
+    last = max((r['last_delivery'] for r in results if r['last_delivery'] != None), default=None)
+    processes = ([sender_results] if sender_results != None else []) + results
+    elapsed = last - sender_results['start'] if sender_results != None and last != None else None
+    retransmitted = sum(r['retransmissions'] for r in processes)
+    return {
+        'scenario' : spec,
+        'delivered' : delivered,
+        'expected' : spec['count'] * spec['fanout'],
+        'msgs_per_s' : delivered / elapsed if elapsed else None,
+        'latency_p50_ms' : percentile(latencies, 50) * 1000 if latencies else None,
+        'latency_p99_ms' : percentile(latencies, 99) * 1000 if latencies else None,
+        'sent_messages' : sum(r['sent_messages'] for r in processes), # all the layers, acks included
+        'sent_bytes' : sum(r['sent_bytes'] for r in processes),       # encoded messages, without framing and protocol headers
+        'loopback_bytes' : wire_after - wire_before if wire_before != None else None, # host-wide
+        'retransmissions' : retransmitted,
+        'retransmissions_per_delivery' : retransmitted / delivered if delivered else None,
+        'processes' : processes,
+    }
+
+def compare(baseline_file : str, results_file : str) -> None:
+    """ prints the throughput and p99 latency changes of the scenarios found in both files """
+    def key(result):
+        return json.dumps({k : v for k, v in result['scenario'].items() if k != 'base_port'}, sort_keys=True)
+    with open(baseline_file) as fd:
+        baseline = {key(r) : r for r in json.load(fd)['results']}
+    with open(results_file) as fd:
+        results = json.load(fd)['results']
+    for r in results:
+        b = baseline.get(key(r))
+        if b == None:
+            continue
+        s = r['scenario']
+        line = '%-12s %-12s size=%-6d fanout=%-3d rate=%-6d' % (s['link'], s['layer'], s['size'], s['fanout'], s['rate'])
+        for metric in ('msgs_per_s', 'latency_p99_ms'):
+            if b[metric] and r[metric] != None:
+                line += '  %s %+.1f%%' % (metric, (r[metric] / b[metric] - 1) * 100)
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='throughput, latency and cost of the link stacks over loopback')
+    parser.add_argument('--links', default='simple,persistent', help='comma separated, among '+', '.join(LINKS)+' (mtc:<n_threads_in>:<n_threads_out>)')
+    parser.add_argument('--layers', default='fll,pl_pingpong', help='comma separated, among '+', '.join(LAYERS))
+    parser.add_argument('--sizes', default='64', help='payload sizes in bytes, comma separated')
+    parser.add_argument('--fanout', default='1', help='numbers of receivers, comma separated')
+    parser.add_argument('--rate', default='0', help='offered load in messages per second per receiver, comma separated (0: unlimited)')
+    parser.add_argument('--count', type=int, default=2000, help='messages per receiver')
+    parser.add_argument('--timeout', type=float, default=1, help='retransmission timeout of the perfect links')
+    parser.add_argument('--idle-timeout', type=float, default=10, help='seconds without deliveries after which a receiver gives up')
+    parser.add_argument('--base-port', type=int, default=7000)
+    parser.add_argument('--run-dir', default='benchmark_run')
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'))
+    parser.add_argument('--worker', choices=('sender', 'receiver'), help=argparse.SUPPRESS)
+    parser.add_argument('--pid', help=argparse.SUPPRESS)
+    parser.add_argument('--spec', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker != None:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        if args.worker == 'sender':
+            runSender(json.loads(args.spec))
+        else:
+            runReceiver(json.loads(args.spec), args.pid)
+    elif args.compare != None:
+        compare(*args.compare)
+    else:
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(1)) # the workers are killed on the way out
+        results = []
+        scenarios = itertools.product(args.links.split(','), args.layers.split(','), args.sizes.split(','), args.fanout.split(','), args.rate.split(','))
+        for i, (link_kind, layer, size, fanout, rate) in enumerate(scenarios):
+            spec = {'link' : link_kind, 'layer' : layer, 'size' : int(size), 'fanout' : int(fanout), 'rate' : int(rate), 'count' : args.count,
+                    'timeout' : args.timeout, 'idle_timeout' : args.idle_timeout, 'base_port' : args.base_port + i * 100} # no TIME_WAIT clashes
+            result = runScenario(spec, os.path.join(args.run_dir, str(i)))
+            print('%-12s %-12s size=%-6d fanout=%-3d rate=%-6d delivered %d/%d  %s msgs/s  p50 %s ms  p99 %s ms  retx/delivery %s' % (
+                link_kind, layer, spec['size'], spec['fanout'], spec['rate'], result['delivered'], result['expected'],
+                *(('%.1f' % result[m]) if result[m] != None else '-' for m in ('msgs_per_s', 'latency_p50_ms', 'latency_p99_ms')),
+                ('%.3f' % result['retransmissions_per_delivery']) if result['retransmissions_per_delivery'] != None else '-'), flush=True)
+            results.append(result)
+        with open(args.output, 'w') as fd:
+            json.dump({'python' : platform.python_version(), 'platform' : platform.platform(), 'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'results' : results}, fd, indent=1)
@@ -0,0 +1,308 @@
+import json
+import marshal
+import struct
+from abc import ABC, abstractmethod
+from message import ENVELOPE, isEnvelope
+
+GENERIC_JSON = json.JSONEncoder(separators=(',', ':')) # created once, json.dumps creates an encoder per call with non-default arguments
+GENERIC_JSON_DECODER = json.JSONDecoder()
+
+# abstract class
+class Codec(ABC):
+    """
+        Encoding of the messages exchanged by the links
+    """
+
+    @abstractmethod
+    def encode(self, message) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data):
+        """
+        Args:
+            data (bytes-like): encoded message, it can be a memoryview on a receive buffer
+        """
+        pass
+
+    def encodeData(self, seq : int, encoded):
+        """ encoding of ['pl_DATA', seq, message], encoded being the Encoded message (by this codec) """
+        return self.encode(['pl_DATA', seq, encoded.message])
+
+class Encoded:
+    """
+        A message together with its encoding, e.g. to send the same message to many processes (FairLossLink.multisend)
+        or to retransmit it without encoding it again: the links send data as it is.
+    """
+
+    __slots__ = ('message', 'data')
+
+    def __init__(self, message, codec : Codec, data : bytes = None) -> None:
+        self.message = message
+        self.data = data if data != None else codec.encode(message)
+
+    def __repr__(self) -> str:
+        return repr(self.message)
+
+class JSONCodec(Codec):
+    """
+        Original encoding of the links, the message needs to be convertible in JSON
+    """
+
+    def encode(self, message) -> bytes:
+        return json.dumps({'msg' : message}).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(str(data, 'utf-8'))['msg']
+
+class BinaryCodec(Codec):
+    """
+        Compact binary encoding. The first byte is the kind of encoding:
+
+        CONTROL:          [tag, 'MID:<n>']                                -> tag code, message id
+        DATA_CONTROL:     ['pl_DATA', seq, [tag, 'MID:<n>']]               -> tag code, message id, seq
+        DATA_CONTROL_ACK: ['pl_DATA', seq, [tag, 'MID:<n>'], watermark, []] -> tag code, message id, seq, watermark
+        ACK_CONTROL:      ['pl_ACK', 'pl_DATA', seq, [tag, 'MID:<n>']]     -> tag code, message id, seq
+        ACK:              ['pl_ACK', watermark, []]                       -> watermark
+        DATA_CONTROL_ACK_WINDOW, ACK_WINDOW: the same with the advertised window (flow control) as last element
+        DATA_ENCODED:     ['pl_DATA', seq, message]                       -> seq, then message encoded by the codec (any kind),
+                          so that a message sent to many processes is encoded only once (encodeData)
+        DATA_ACK:         ['pl_DATA', seq, message, watermark, ranges]     -> seq, watermark, ranges, then message encoded by the codec
+        ACK_RANGES:       ['pl_ACK', watermark, ranges]                   -> watermark, ranges
+        DATA_ACK_WINDOW, ACK_RANGES_WINDOW: the same with the advertised window (flow control) after the watermark
+                          the header ends with the number of ranges, followed by first and last of every range
+        ACK_ENCODED:      ['pl_ACK', 'pl_DATA', seq, message]             -> seq, then message encoded by the codec
+        ENVELOPE flag:    the control message is the envelope [ENVELOPE, type id, message id, None, None] (see message.py)
+                          instead of [tag, 'MID:<n>'] -> kind | ENVELOPE, type id instead of tag code
+        GENERIC:          any other message                               -> JSON encoding (as JSONCodec, tuples are decoded as lists)
+        GENERIC_MARSHAL:  any other message, with BinaryCodec(marshal=True) -> marshal encoding, any built-in type is allowed.
+                          marshal is not safe against malicious data and its format changes among Python versions:
+                          only for processes trusting each other and running the same interpreter, decoded only if enabled
+
+        The small fixed-shape control messages (tag registered in the codec), also when carried by a perfect link,
+        and the cumulative acks never go through generic serialization. The other messages of the perfect links have their
+        sequence and ack fields in a binary header, only the message they carry goes through generic serialization.
+        Every process must register the same tags in the same order.
+    """
+
+    GENERIC = 0
+    CONTROL = 1
+    DATA_CONTROL = 2
+    DATA_CONTROL_ACK = 3
+    ACK_CONTROL = 4
+    ACK = 5
+    DATA_CONTROL_ACK_WINDOW = 6
+    ACK_WINDOW = 7
+    DATA_ENCODED = 8
+    GENERIC_MARSHAL = 9
+    DATA_ACK = 10
+    DATA_ACK_WINDOW = 11
+    ACK_RANGES = 12
+    ACK_RANGES_WINDOW = 13
+    ACK_ENCODED = 14
+    ENVELOPE = 0x80 # flag of the kinds carrying a control message
+
+    HEADERS = {
+        CONTROL : struct.Struct('!BBQ'),            # kind, tag code, message id
+        DATA_CONTROL : struct.Struct('!BBQQ'),      # kind, tag code, message id, seq
+        DATA_CONTROL_ACK : struct.Struct('!BBQQQ'), # kind, tag code, message id, seq, watermark
+        ACK_CONTROL : struct.Struct('!BBQQ'),       # kind, tag code, message id, seq
+        ACK : struct.Struct('!BQ'),                 # kind, watermark
+        DATA_CONTROL_ACK_WINDOW : struct.Struct('!BBQQQI'), # kind, tag code, message id, seq, watermark, window
+        ACK_WINDOW : struct.Struct('!BQI'),                  # kind, watermark, window
+        DATA_ENCODED : struct.Struct('!BQ'),                 # kind, seq, followed by the encoded message
+        DATA_ACK : struct.Struct('!BQqH'),                   # kind, seq, watermark, number of ranges, followed by the ranges and the encoded message
+        DATA_ACK_WINDOW : struct.Struct('!BQqIH'),           # kind, seq, watermark, window, number of ranges, followed by the same
+        ACK_RANGES : struct.Struct('!BqH'),                  # kind, watermark, number of ranges, followed by the ranges
+        ACK_RANGES_WINDOW : struct.Struct('!BqIH'),          # kind, watermark, window, number of ranges, followed by the ranges
+        ACK_ENCODED : struct.Struct('!BQ'),                  # kind, seq, followed by the encoded message
+    }
+    RANGE = struct.Struct('!QQ') # first, last
+    MARSHAL_VERSION = 4
+    GENERIC_PREFIX = bytes((GENERIC,))
+    MARSHAL_PREFIX = bytes((GENERIC_MARSHAL,))
+
+    TAGS = ('MT:HeartbeatRequest', 'MT:HeartbeatReply')
+
+    def __init__(self, tags : tuple = TAGS, marshal : bool = False) -> None:
+        """
+        Args:
+            marshal (bool): generic encoding by marshal instead of JSON, see GENERIC_MARSHAL (every process must agree)
+        """
+        self.marshal = marshal
+        self.tags = []
+        self.tag_codes = {} # tag -> code
+        for tag in tags:
+            self.registerTag(tag)
+
+    def registerTag(self, tag : str) -> None:
+        """ enables the fast path for the messages with the given tag (e.g. 'MT:HeartbeatRequest') """
+        if tag in self.tag_codes:
+            return
+        if len(self.tags) == 256:
+            raise ValueError('No more available tag codes')
+        self.tag_codes[tag] = len(self.tags)
+        self.tags.append(tag)
+
+    def controlHeader(self, kind, message, *numbers):
+        """ numbers: seq, watermark (unsigned 64 bits integers), window (checked by the caller) """
+        if type(message) is not list:
+            return None
+        n = len(message)
+        if n == 5:
+            if not isEnvelope(message):
+                return None
+            _, type_id, mid, sender, payload = message
+            if 0 <= type_id < 256 and type(mid) is int and 0 <= mid < 2**64 and sender is None and payload is None and all(type(n) is int and 0 <= n < 2**64 for n in numbers):
+                return self.HEADERS[kind].pack(kind | self.ENVELOPE, type_id, mid, *numbers)
+            return None
+        if n != 2 or type(message[0]) is not str:
+            return None
+        tag, mid = message
+        code = self.tag_codes.get(tag)
+        if code is None or type(mid) is not str or mid[:4] != 'MID:' or not all(type(n) is int and 0 <= n < 2**64 for n in numbers):
+            return None
+        digits = mid[4:]
+        # only canonical integers, so that decoding gives back the very same string
+        if not (digits.isascii() and digits.isdigit()) or (digits[0] == '0' and len(digits) > 1) or len(digits) > 19:
+            return None
+        return self.HEADERS[kind].pack(kind, code, int(digits), *numbers)
+
+    def ackHeader(self, kind, ranges, *numbers):
+        """ header of the DATA_ACK and ACK_RANGES kinds, numbers: the fields before the number of ranges, None if the fields do not fit """
+        if type(ranges) is not list or len(ranges) > 0xFFFF:
+            return None
+        for n in numbers:
+            if type(n) is not int: # struct checks that the numbers fit, but it takes booleans
+                return None
+        try:
+            return self.HEADERS[kind].pack(kind, *numbers, len(ranges)) + b''.join([self.RANGE.pack(first, last) for first, last in ranges])
+        except (TypeError, ValueError, struct.error): # not a pair, number out of range (booleans in ranges are decoded as integers)
+            return None
+
+    def decodeRanges(self, data, offset : int, count : int) -> list:
+        return [list(r) for r in self.RANGE.iter_unpack(data[offset : offset + count * self.RANGE.size])]
+
+    def encode(self, message) -> bytes:
+        if type(message) is list and message:
+            n = len(message)
+            head = message[0]
+            if head == 'pl_DATA' and 3 <= n <= 6:
+                data = self.encodeDataMessage(message, n)
+            elif head == 'pl_ACK' and 3 <= n <= 4:
+                data = self.encodeAck(message, n)
+            elif n == 2 or n == 5:
+                data = self.controlHeader(self.CONTROL, message)
+            else:
+                data = None
+            if data is not None:
+                return data
+        return self.encodeGeneric(message)
+
+    def encodeDataMessage(self, message : list, n : int) -> bytes:
+        """ ['pl_DATA', seq, message(, watermark, ranges(, window))], None if it does not fit the headers """
+        seq = message[1]
+        if type(seq) is not int or not 0 <= seq < 2**64:
+            return None
+        payload = message[2]
+        if n == 3:
+            header = self.controlHeader(self.DATA_CONTROL, payload, seq)
+            if header is not None:
+                return header
+            return self.HEADERS[self.DATA_ENCODED].pack(self.DATA_ENCODED, seq) + self.encodeGeneric(payload)
+        if n == 4:
+            return None
+        watermark, ranges = message[3], message[4]
+        if n == 5:
+            header = self.controlHeader(self.DATA_CONTROL_ACK, payload, seq, watermark) if ranges == [] else None
+            if header is None:
+                header = self.ackHeader(self.DATA_ACK, ranges, seq, watermark)
+                if header is not None:
+                    header += self.encodeGeneric(payload)
+            return header
+        window = message[5]
+        header = None
+        if ranges == [] and type(window) is int and 0 <= window < 2**32:
+            header = self.controlHeader(self.DATA_CONTROL_ACK_WINDOW, payload, seq, watermark, window)
+        if header is None:
+            header = self.ackHeader(self.DATA_ACK_WINDOW, ranges, seq, watermark, window)
+            if header is not None:
+                header += self.encodeGeneric(payload)
+        return header
+
+    def encodeAck(self, message : list, n : int) -> bytes:
+        """ ['pl_ACK', watermark, ranges(, window)] or ['pl_ACK', 'pl_DATA', seq, message], None if it does not fit the headers """
+        watermark = message[1]
+        if n == 4 and watermark == 'pl_DATA': # echo
+            seq = message[2]
+            if type(seq) is not int or not 0 <= seq < 2**64:
+                return None
+            header = self.controlHeader(self.ACK_CONTROL, message[3], seq)
+            if header is not None:
+                return header
+            return self.HEADERS[self.ACK_ENCODED].pack(self.ACK_ENCODED, seq) + self.encodeGeneric(message[3])
+        ranges = message[2]
+        if ranges == [] and type(watermark) is int and 0 <= watermark < 2**64:
+            if n == 3:
+                return self.HEADERS[self.ACK].pack(self.ACK, watermark)
+            if type(message[3]) is int and 0 <= message[3] < 2**32:
+                return self.HEADERS[self.ACK_WINDOW].pack(self.ACK_WINDOW, watermark, message[3])
+        if n == 3:
+            return self.ackHeader(self.ACK_RANGES, ranges, watermark)
+        return self.ackHeader(self.ACK_RANGES_WINDOW, ranges, watermark, message[3])
+
+    def encodeGeneric(self, message) -> bytes:
+        if self.marshal:
+            return self.MARSHAL_PREFIX + marshal.dumps(message, self.MARSHAL_VERSION)
+        return self.GENERIC_PREFIX + GENERIC_JSON.encode(message).encode('utf-8')
+
+    def encodeData(self, seq : int, encoded) -> bytes:
+        return self.HEADERS[self.DATA_ENCODED].pack(self.DATA_ENCODED, seq) + encoded.data
+
+    def decode(self, data):
+        kind = data[0]
+        if kind == self.GENERIC:
+            text = str(data[1:], 'utf-8')
+            message, end = GENERIC_JSON_DECODER.raw_decode(text) # encodeGeneric adds no whitespace to skip
+            if end != len(text):
+                raise ValueError('Extra data after the message')
+            return message
+        if kind == self.GENERIC_MARSHAL:
+            if not self.marshal: # never unmarshal the data of a peer not trusted explicitly
+                raise ValueError('marshal encoding not enabled')
+            return marshal.loads(data[1:])
+        if kind == self.ACK:
+            return ['pl_ACK', self.HEADERS[kind].unpack_from(data)[1], []]
+        if kind == self.ACK_WINDOW:
+            _, watermark, window = self.HEADERS[kind].unpack_from(data)
+            return ['pl_ACK', watermark, [], window]
+        if kind == self.DATA_ENCODED:
+            header = self.HEADERS[kind]
+            return ['pl_DATA', header.unpack_from(data)[1], self.decode(data[header.size:])]
+        if kind == self.ACK_ENCODED:
+            header = self.HEADERS[kind]
+            return ['pl_ACK', 'pl_DATA', header.unpack_from(data)[1], self.decode(data[header.size:])]
+        if kind == self.DATA_ACK or kind == self.DATA_ACK_WINDOW:
+            header = self.HEADERS[kind]
+            _, seq, watermark, *window, count = header.unpack_from(data)
+            offset = header.size + count * self.RANGE.size
+            return ['pl_DATA', seq, self.decode(data[offset:]), watermark, self.decodeRanges(data, header.size, count)] + window
+        if kind == self.ACK_RANGES or kind == self.ACK_RANGES_WINDOW:
+            header = self.HEADERS[kind]
+            _, watermark, *window, count = header.unpack_from(data)
+            return ['pl_ACK', watermark, self.decodeRanges(data, header.size, count)] + window
+        envelope = kind & self.ENVELOPE
+        kind &= ~self.ENVELOPE
+        if kind not in self.HEADERS:
+            raise ValueError('Unknown encoding '+str(kind))
+        _, code, mid, *numbers = self.HEADERS[kind].unpack_from(data)
+        message = [ENVELOPE, code, mid, None, None] if envelope else [self.tags[code], 'MID:'+str(mid)]
+        if kind == self.CONTROL:
+            return message
+        if kind == self.DATA_CONTROL:
+            return ['pl_DATA', numbers[0], message]
+        if kind == self.DATA_CONTROL_ACK:
+            return ['pl_DATA', numbers[0], message, numbers[1], []]
+        if kind == self.DATA_CONTROL_ACK_WINDOW:
+            return ['pl_DATA', numbers[0], message, numbers[1], [], numbers[2]]
+        return ['pl_ACK', 'pl_DATA', numbers[0], message]
@@ -1,5 +1,12 @@
 from DDSlogger import logger
 import sys
+import math
+import heapq
+import time
+import random
+import threading
+import queue
+import collections
 
 def handleEvents(eventQueue, handlerFunction):
     while True:
@@ -8,4 +15,404 @@ def handleEvents(eventQueue, handlerFunction):
             handlerFunction(*e)
         except Exception as ex:
             _, _, exc_tb = sys.exc_info()
-            logger.debug('Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex)+" - event: "+str(e)+' - function handler: '+str(handlerFunction))
\ No newline at end of file
+            logger.debug('Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex)+" - event: "+str(e)+' - function handler: '+str(handlerFunction))
+
+class TimerWheel:
+    """
+        Hashed timer wheel: a timer is stored in the slot of the tick it expires at, so scheduling is O(1) and
+        advancing the wheel only looks at the slots of the elapsed ticks.
+        Timers are never removed: the owner ignores the expired keys it is not interested in anymore.
+    """
+
+    def __init__(self, tick : float, n_slots : int = 512, now : float = None) -> None:
+        """
+        Args:
+            tick (float): resolution of the timers in seconds
+            n_slots (int): number of slots, timers farther than n_slots ticks wait for extra rounds of the wheel
+            now (float): current time of the clock later passed to advance (time.monotonic() by default)
+        """
+        self.tick = tick
+        self.slots = [[] for _ in range(n_slots)]
+        self.current_tick = int((time.monotonic() if now == None else now) / tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, delay : float, key) -> None:
+        """ key is returned by advance once delay seconds have elapsed """
+        with self.lock:
+            expiration = self.current_tick + max(1, math.ceil(delay / self.tick))
+            self.slots[expiration % len(self.slots)].append((expiration, key))
+
+    def advance(self, now : float) -> list:
+        """ returns the keys of the timers expired up to now """
+        expired = []
+        with self.lock:
+            target = int(now / self.tick)
+            while self.current_tick < target:
+                self.current_tick += 1
+                index = self.current_tick % len(self.slots)
+                slot = self.slots[index]
+                if slot:
+                    self.slots[index] = [timer for timer in slot if timer[0] > self.current_tick]
+                    expired.extend(key for expiration, key in slot if expiration <= self.current_tick)
+        return expired
+
+
+class BoundedQueue(queue.Queue):
+    """
+        queue.Queue with an overflow policy applied by put when maxsize items are already enqueued:
+        'block' waits for a free slot, 'drop_newest' discards the item being put, 'drop_oldest' discards the oldest enqueued item.
+        dropped and blocked count the puts that hit the limit.
+    """
+
+    POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, maxsize : int = 0, overflow : str = 'block') -> None:
+        """
+        Args:
+            maxsize (int): maximum number of enqueued items, 0 means unbounded
+            overflow (str): one of BoundedQueue.POLICIES
+        """
+        if overflow not in self.POLICIES:
+            raise ValueError('Unknown overflow policy '+str(overflow))
+        super().__init__(maxsize)
+        self.overflow = overflow
+        self.dropped = 0
+        self.blocked = 0
+
+    def put(self, item, block=True, timeout=None, priority=None) -> bool:
+        """ returns False if the item has been dropped. priority is the traffic class of ClassQueue, ignored here """
+        if self.maxsize <= 0:
+            super().put(item, block, timeout)
+            return True
+        with self.not_full:
+            if self._bounded(item) and self._used() >= self.maxsize:
+                if self.overflow == 'block':
+                    self.blocked += 1
+                    if not block:
+                        raise queue.Full
+                    deadline = None if timeout == None else time.monotonic() + timeout
+                    while self._used() >= self.maxsize:
+                        if deadline == None:
+                            self.not_full.wait()
+                        else:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                raise queue.Full
+                            self.not_full.wait(remaining)
+                else:
+                    self.dropped += 1
+                    if self.overflow == 'drop_newest':
+                        return False
+                    self._drop()
+                    self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        return True
+
+    def _bounded(self, item) -> bool:
+        """ the item is subject to maxsize """
+        return True
+
+    def _used(self) -> int:
+        """ enqueued items counted against maxsize """
+        return self._qsize()
+
+    def _drop(self) -> None:
+        """ discards the oldest item """
+        self._get()
+
+
+class ClassQueue(BoundedQueue):
+    """
+        BoundedQueue with a FIFO per traffic class (0 the most urgent): get returns the oldest item of the most
+        urgent class with items, 'drop_oldest' discards the oldest item of the least urgent one.
+        put takes the class of the item as priority, the least urgent class by default.
+        maxsize bounds the items of the classes other than 0: the most urgent items (CONTROL, e.g. heartbeats) are
+        never blocked nor dropped because of the bulk data queued, whatever the overflow policy.
+    """
+
+    def __init__(self, maxsize : int = 0, overflow : str = 'block', classes : int = 2) -> None:
+        self.classes = classes
+        super().__init__(maxsize, overflow)
+
+    def _init(self, maxsize) -> None:
+        self.queues = [collections.deque() for _ in range(self.classes)]
+
+    def _qsize(self) -> int:
+        return sum(len(q) for q in self.queues)
+
+    def _put(self, entry) -> None:
+        priority, item = entry
+        self.queues[priority].append(item)
+
+    def _get(self):
+        for q in self.queues:
+            if q:
+                return q.popleft()
+
+    def _bounded(self, entry) -> bool:
+        return entry[0] != 0
+
+    def _used(self) -> int:
+        return sum(len(q) for q in self.queues[1:])
+
+    def _drop(self) -> None:
+        for q in reversed(self.queues[1:]): # the most urgent items are not counted against maxsize
+            if q:
+                q.popleft()
+                return
+
+    def put(self, item, block=True, timeout=None, priority=None) -> bool:
+        return super().put((self.classes - 1 if priority == None else priority, item), block, timeout)
+
+    def depths(self) -> list:
+        """ queued items per class """
+        return [len(q) for q in self.queues]
+
+
+class ThreadRuntime:
+    """
+        Runs the event handlers of the layers on real time: a thread per handled queue and per periodic event.
+        The layers get their runtime from the link below them (FairLossLink.runtime), so that the same
+        primitives can run on another runtime, e.g. the virtual clock of simulation.Simulator.
+    """
+
+    random = random # source of randomness of the layers
+
+    def time(self) -> float:
+        return time.monotonic()
+
+    def queue(self, maxsize : int = 0, overflow : str = 'block', classes : int = 1) -> queue.Queue:
+        """ classes > 1: ClassQueue with that number of traffic classes """
+        if classes > 1:
+            return ClassQueue(maxsize, overflow, classes)
+        return BoundedQueue(maxsize, overflow)
+
+    def handle(self, eventQueue, handlerFunction) -> None:
+        """ calls handlerFunction(*event) for every event put in eventQueue """
+        handlerThread = threading.Thread(target=handleEvents, args=(eventQueue, handlerFunction))  # this thread should die with its parent process
+        handlerThread.start()
+
+    def every(self, seconds : float, function, delay : float = None) -> None:
+        """ calls function() every seconds, the first time after delay seconds (seconds by default) """
+        timerThread = threading.Thread(target=self.runPeriodically, args=(seconds, function, seconds if delay == None else delay))  # this thread should die with its parent process
+        timerThread.start()
+
+    def runPeriodically(self, seconds : float, function, delay : float) -> None:
+        time.sleep(delay)
+        while True:
+            try:
+                function()
+            except Exception as ex:
+                _, _, exc_tb = sys.exc_info()
+                logger.debug('Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex)+' - function: '+str(function))
+            time.sleep(seconds)
+
+    def after(self, seconds : float, function) -> None:
+        """ calls function() once, after seconds """
+        timerThread = threading.Timer(seconds, self.runOnce, args=(function,))  # this thread should die with its parent process
+        timerThread.start()
+
+    def runOnce(self, function) -> None:
+        try:
+            function()
+        except Exception as ex:
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex)+' - function: '+str(function))
+
+
+class DispatchedQueue(BoundedQueue):
+    """
+        Event queue of a Dispatcher: once a handler is attached, every put makes the queue runnable,
+        and a runnable queue is drained by one worker at a time, so its events are handled in order.
+    """
+
+    def __init__(self, dispatcher, maxsize : int = 0, overflow : str = 'block', *classes) -> None:
+        super().__init__(maxsize, overflow, *classes)
+        self.dispatcher = dispatcher
+        self.handlerFunction = None
+        self.scheduled = False # in the runnable queue of the dispatcher or being drained
+
+    def attach(self, handlerFunction) -> None:
+        self.handlerFunction = handlerFunction
+        self.dispatcher.ready(self)
+
+    def put(self, item, block=True, timeout=None, priority=None) -> bool:
+        put = super().put(item, block, timeout, priority)
+        if self.handlerFunction != None:
+            self.dispatcher.ready(self)
+        return put
+
+
+class DispatchedClassQueue(DispatchedQueue, ClassQueue):
+    """ DispatchedQueue with traffic classes, see ClassQueue """
+
+
+class Dispatcher(ThreadRuntime):
+    """
+        Runs the event handlers of all the layers of the process on a pool of worker threads, instead of a thread per queue:
+        the queues with events to handle wait in a single runnable queue, and each worker drains at most batch events
+        of a queue before moving to the next one. A single timer thread triggers the periodic events.
+        The handlers must not wait for events handled by the same dispatcher with all the workers busy,
+        e.g. full 'block' queues or the flow control of PerfectLinkPingPong (use block=False).
+    """
+
+    def __init__(self, workers : int = 4, batch : int = 64) -> None:
+        """
+        Args:
+            workers (int): number of worker threads
+            batch (int): maximum events of a queue handled before the worker moves to the next runnable queue
+        """
+        self.batch = batch
+        self.runnable = queue.SimpleQueue()
+        self.lock = threading.Lock() # protects the scheduled flags of the queues
+        self.timers = [] # heap of [due time, id, seconds (None if not periodic), DispatchedQueue of the function]
+        self.timers_changed = threading.Condition()
+        self.timer_ids = 0
+        for _ in range(workers):
+            workerThread = threading.Thread(target=self.work, args=())  # this thread should die with its parent process
+            workerThread.start()
+        timerThread = threading.Thread(target=self.runTimers, args=())  # this thread should die with its parent process
+        timerThread.start()
+
+    def queue(self, maxsize : int = 0, overflow : str = 'block', classes : int = 1) -> DispatchedQueue:
+        if classes > 1:
+            return DispatchedClassQueue(self, maxsize, overflow, classes)
+        return DispatchedQueue(self, maxsize, overflow)
+
+    def handle(self, eventQueue, handlerFunction) -> None:
+        """ calls handlerFunction(*event) for every event put in eventQueue """
+        if isinstance(eventQueue, DispatchedQueue) and eventQueue.dispatcher is self:
+            eventQueue.attach(handlerFunction)
+        else: # queue of another runtime
+            super().handle(eventQueue, handlerFunction)
+
+    def every(self, seconds : float, function, delay : float = None) -> None:
+        """ calls function() every seconds, the first time after delay seconds (seconds by default) """
+        ticks = self.queue()
+        ticks.attach(function)
+        with self.timers_changed:
+            self.timer_ids += 1
+            heapq.heappush(self.timers, [time.monotonic() + (seconds if delay == None else delay), self.timer_ids, seconds, ticks])
+            self.timers_changed.notify()
+
+    def after(self, seconds : float, function) -> None:
+        """ calls function() once, after seconds """
+        ticks = self.queue()
+        ticks.attach(function)
+        with self.timers_changed:
+            self.timer_ids += 1
+            heapq.heappush(self.timers, [time.monotonic() + seconds, self.timer_ids, None, ticks])
+            self.timers_changed.notify()
+
+    def ready(self, eventQueue : DispatchedQueue) -> None:
+        with self.lock:
+            if eventQueue.scheduled:
+                return
+            eventQueue.scheduled = True
+        self.runnable.put(eventQueue)
+
+    def work(self) -> None:
+        while True:
+            eventQueue = self.runnable.get()
+            handlerFunction = eventQueue.handlerFunction
+            for _ in range(self.batch):
+                try:
+                    e = eventQueue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    handlerFunction(*e)
+                except Exception as ex:
+                    _, _, exc_tb = sys.exc_info()
+                    logger.debug('Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex)+" - event: "+str(e)+' - function handler: '+str(handlerFunction))
+            with self.lock:
+                if eventQueue.qsize() > 0: # back in line, after the other runnable queues
+                    self.runnable.put(eventQueue)
+                else:
+                    eventQueue.scheduled = False
+
+    def runTimers(self) -> None:
+        while True:
+            due = []
+            with self.timers_changed:
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    timer = self.timers[0]
+                    due.append(timer[3])
+                    if timer[2] == None: # once
+                        heapq.heappop(self.timers)
+                        continue
+                    timer[0] = max(timer[0] + timer[2], now)
+                    heapq.heapreplace(self.timers, timer)
+                if not due:
+                    self.timers_changed.wait(self.timers[0][0] - now if self.timers else None)
+            for ticks in due: # outside the lock, the ticks of a FusedRuntime are handled right away
+                if ticks.qsize() == 0: # a late tick is skipped, not queued
+                    ticks.put(())
+
+
+
+class FusedQueue(BoundedQueue):
+    """
+        Event queue of a FusedRuntime: once a handler is attached, put calls it right away on the thread putting the event,
+        nothing is enqueued. The calls of a handler are serialized by a reentrant lock, events put by the same thread
+        are handled in order. Without a handler (e.g. the deliver queue read by the application) it is a BoundedQueue.
+    """
+
+    def __init__(self, maxsize : int = 0, overflow : str = 'block') -> None:
+        super().__init__(maxsize, overflow)
+        self.handlerFunction = None
+        self.handlerLock = threading.RLock()
+
+    def attach(self, handlerFunction) -> None:
+        with self.handlerLock:
+            self.handlerFunction = handlerFunction
+            while True: # events put before the handler
+                try:
+                    self.call(self.get_nowait())
+                except queue.Empty:
+                    break
+
+    def put(self, item, block=True, timeout=None, priority=None) -> bool:
+        if self.handlerFunction == None:
+            return super().put(item, block, timeout)
+        with self.handlerLock:
+            self.call(item)
+        return True
+
+    def call(self, e) -> None:
+        try:
+            self.handlerFunction(*e)
+        except Exception as ex: # the thread putting the event (e.g. the receiving thread of the link) goes on
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex)+" - event: "+str(e)+' - function handler: '+str(self.handlerFunction))
+
+
+class FusedRuntime(Dispatcher):
+    """
+        Runs the layers as a synchronous pipeline: a message received by the link is decoded, deduplicated, acked
+        and handled by the protocol on the receiving thread, and a message sent by a protocol reaches the socket
+        on the sending thread, with no queue hop between the layers. The periodic events run on the timer thread.
+        The queues read by the application (getDeliverEvents, getTaggedDeliverEvents without a handler) are unchanged.
+        A slow handler slows down the thread calling it, e.g. the receiving thread of the link, and as for the
+        Dispatcher the handlers must not wait for events (full 'block' queues, flow control with block=True).
+    """
+
+    def __init__(self) -> None:
+        super().__init__(workers=0)
+
+    def queue(self, maxsize : int = 0, overflow : str = 'block', classes : int = 1) -> FusedQueue:
+        """ the events are handled as soon as they are put: no traffic classes """
+        return FusedQueue(maxsize, overflow)
+
+    def handle(self, eventQueue, handlerFunction) -> None:
+        """ calls handlerFunction(*event) for every event put in eventQueue """
+        if isinstance(eventQueue, FusedQueue):
+            eventQueue.attach(handlerFunction)
+        else: # queue of another runtime
+            ThreadRuntime.handle(self, eventQueue, handlerFunction)
+
+
+REAL_TIME = ThreadRuntime()
@@ -1,74 +1,322 @@
-from DDSlogger import logger, config
-import threading
-import queue
-import time
-from eventHandler import handleEvents
+from DDSlogger import logger, LOG
+from metrics import Metrics
+import tracer
+from message import envelope, HEARTBEAT_REQUEST, HEARTBEAT_REPLY, HEARTBEAT
+import collections
+import math
 import sys
+import threading
+
+NEVER = float('-inf') # time of the last message from a process never heard
 
 class PerfectFailureDetector:
     """
         # 2.6.2 Perfect Failure Detection
+
+        Heartbeat requests and replies are envelopes sent on the perfect link, every process is probed once per timeout.
+        With piggyback, every message received from a process by the fair-loss link under pl (for any layer) proves
+        it alive: the requests are sent on the fair-loss link only to the processes not heard since the start of the period,
+        at probes - 1 evenly spaced times of the period, and a process is detected as crashed if nothing is received from it
+        during a whole period. A busy process is never sent a heartbeat.
     """
 
-    def __init__(self, processes, timeout, pl) -> None:
+    def __init__(self, processes, timeout, pl, piggyback : bool = False, probes : int = 4) -> None:
+        """
+        Args:
+            piggyback (bool): any message proves liveness, heartbeats on the fair-loss link to the silent processes only
+            probes (int): with piggyback, the period is divided in probes intervals, the silent processes are sent a request at the end of each but the last
+        """
         self.pl = pl
         self.pid = pl.pid
+        self.runtime = pl.runtime
         self.processes = processes
         self.alive = set(processes)
         self.detected = set()
         self.crashEvents = None
         self.msg_counter_rq = 0
         self.msg_counter_rp = 0
+        self.started = False
+        self.round_start = None
+        self.fll = pl.fairLossLink() if piggyback else None
+        self.probes = probes
+        self.tick = 0
+        self.last_heard = self.fll.getLastHeard() if self.fll != None else None
 
-        deliverHReqEventHandlerThread = threading.Thread(target=handleEvents, args=(self.pl.getTaggedDeliverEvents('HeartbeatRequest'), self.onEventDeliverHReq))
-        deliverHReqEventHandlerThread.start()
+        self.metrics = Metrics('perfectfailuredetector', self.pid)
+        self.metrics.counter('heartbeats_sent')
+        self.metrics.counter('heartbeats_skipped') # processes proven alive by other messages
+        self.metrics.counter('heartbeats_received')
+        self.metrics.counter('replies_received')
+        self.metrics.counter('crashes')
+        self.metrics.histogram('heartbeat_rtt') # first reply of every process in a round
+        self.metrics.gauge('alive', lambda: len(self.alive))
 
-        deliverHRepEventHandlerThread = threading.Thread(target=handleEvents, args=(self.pl.getTaggedDeliverEvents('HeartbeatReply'), self.onEventDeliverHRep))
-        deliverHRepEventHandlerThread.start()
+        self.runtime.handle(self.pl.getTypedDeliverEvents(HEARTBEAT_REQUEST), self.onEventDeliverHReq)
+        self.runtime.handle(self.pl.getTypedDeliverEvents(HEARTBEAT_REPLY), self.onEventDeliverHRep)
         
-        timeoutEventHandlerThread = threading.Thread(target=self.onEventTimeout, args=(timeout, ))  # this thread should die with its parent process
-        timeoutEventHandlerThread.start()
+        # the first heartbeats are sent right away, then every timeout (piggyback: the first period starts right away)
+        if self.fll != None:
+            self.runtime.every(timeout / probes, self.onEventProbe, delay=0)
+        else:
+            self.runtime.every(timeout, self.onEventTimeout, delay=0)
 
 
-    def onEventTimeout(self, seconds : float) -> None:
-        while True:
-            for p in self.processes:
-                if p not in self.alive and p not in self.detected:
-                    self.detected.add(p)
-                    self.Crash(p)
+    def onEventTimeout(self) -> None:
+        if self.started and LOG.perfectfailuredector:
+            logger.info('pid:%s - P: expired timeout', self.pid)
+        self.started = True
+        self.round_start = self.runtime.time()
+        alive, self.alive = self.alive, set() # the replies to this round may arrive before the loop ends
+        targets = []
+        for p in self.processes:
+            if p in self.detected: # never probed again, its pending heartbeats have been cancelled
+                continue
+            if p not in alive:
+                self.detected.add(p)
+                self.Crash(p)
+            else:
+                targets.append(p)
+        # a single request for the round, encoded once
+        self.pl.multisend(targets, envelope(HEARTBEAT_REQUEST, self.msg_counter_rq), block=False) # handlers must not block
+        self.msg_counter_rq += 1
+        self.metrics.heartbeats_sent.inc(len(targets))
+
+    def onEventProbe(self) -> None:
+        last_heard = self.last_heard
+        tick, self.tick = self.tick % self.probes, self.tick + 1
+        if tick == 0: # end of a period
+            if self.started:
+                if LOG.perfectfailuredector:
+                    logger.info('pid:%s - P: expired timeout', self.pid)
+                self.alive = set()
+                for p in self.processes:
+                    if p in self.detected:
+                        continue
+                    if last_heard.get(p, NEVER) < self.round_start:
+                        self.detected.add(p)
+                        self.Crash(p)
+                    else:
+                        self.alive.add(p)
+            self.started = True
+            self.round_start = self.runtime.time()
+            return
+        targets = []
+        for p in self.processes:
+            if p not in self.detected:
+                if last_heard.get(p, NEVER) < self.round_start:
+                    targets.append(p)
                 else:
-                    self.pl.send(p, ['MT:HeartbeatRequest', 'MID:'+str(self.msg_counter_rq)])
-                    self.msg_counter_rq += 1
-            self.alive.clear()
-            time.sleep(seconds)
-            if config['LOG'].getboolean('perfectfailuredector'):
-                logger.info('pid:'+self.pid+' - '+'P: expired timeout')
+                    self.metrics.heartbeats_skipped.inc()
+        if targets:
+            self.fll.multisend(targets, envelope(HEARTBEAT_REQUEST, self.msg_counter_rq))
+            self.msg_counter_rq += 1
+            self.metrics.heartbeats_sent.inc(len(targets))
 
     def onEventDeliverHReq(self, q, message) -> None:
         try:
-            self.pl.send(q, ['MT:HeartbeatReply', 'MID:'+str(self.msg_counter_rp)])
+            if self.fll != None:
+                self.fll.send(q, envelope(HEARTBEAT_REPLY, self.msg_counter_rp))
+            else:
+                self.pl.send(q, envelope(HEARTBEAT_REPLY, self.msg_counter_rp), block=False)
             self.msg_counter_rp += 1
-            if config['LOG'].getboolean('perfectfailuredector'):
-                logger.info('pid:'+self.pid+' - '+'P: delivered HeartbeatRequest from ' + str(q))
+            self.metrics.heartbeats_received.inc()
+            if LOG.perfectfailuredector:
+                logger.info('pid:%s - P: delivered HeartbeatRequest from %s', self.pid, q)
         except Exception as ex: 
             _, _, exc_tb = sys.exc_info()
             logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
             
     def onEventDeliverHRep(self, p, message) -> None:
         try:
+            self.metrics.replies_received.inc()
+            if p not in self.alive and self.round_start != None and self.fll == None:
+                self.metrics.heartbeat_rtt.observe(self.runtime.time() - self.round_start)
             self.alive.add(p)
-            if config['LOG'].getboolean('perfectfailuredector'):
-                logger.info('pid:'+self.pid+' - '+'P: delivered HeartbeatReply from '+str(p))
+            if LOG.perfectfailuredector:
+                logger.info('pid:%s - P: delivered HeartbeatReply from %s', self.pid, p)
         except Exception as ex: 
             _, _, exc_tb = sys.exc_info()
             logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
  
     def Crash(self, p) -> None:
-        if config['LOG'].getboolean('perfectfailuredector'):
-            logger.info('pid:'+self.pid+' - '+'P: detected Crash of '+str(p))
+        if LOG.perfectfailuredector:
+            logger.info('pid:%s - P: detected Crash of %s', self.pid, p)
+        self.metrics.crashes.inc()
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.FD, tracer.CRASH, p)
+        self.pl.cancelPending(p) # p will never acknowledge the pending heartbeats
         if self.crashEvents != None:
             self.crashEvents.put(p)
         
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
+
     def getCrashEvents(self):
-        self.crashEvents =  queue.Queue()
-        return self.crashEvents
\ No newline at end of file
+        self.crashEvents =  self.runtime.queue()
+        return self.crashEvents
+
+class ArrivalWindow:
+    """
+        Inter-arrival times of the last heartbeats of a process, with their running sum and sum of squares:
+        the suspicion level phi of a silence is -log10 of the probability that a heartbeat arrives even later,
+        the inter-arrival times being assumed normally distributed (phi accrual failure detector).
+    """
+
+    __slots__ = ('intervals', 'total', 'squares', 'min_std', 'pause')
+
+    def __init__(self, size : int, first : float, min_std : float, pause : float = 0.0) -> None:
+        """
+        Args:
+            pause (float): seconds added to the mean inter-arrival time, a silence that short is not suspicious
+        """
+        self.intervals = collections.deque(maxlen=size)
+        self.total = 0.0
+        self.squares = 0.0
+        self.min_std = min_std
+        self.pause = pause
+        self.add(first) # bootstrap: one interval of the expected length
+
+    def add(self, interval : float) -> None:
+        if len(self.intervals) == self.intervals.maxlen:
+            oldest = self.intervals[0]
+            self.total -= oldest
+            self.squares -= oldest * oldest
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
+
+    def phi(self, elapsed : float) -> float:
+        n = len(self.intervals)
+        mean = self.total / n
+        std = max(self.min_std, math.sqrt(max(0.0, self.squares / n - mean * mean)))
+        later = 0.5 * math.erfc((elapsed - mean - self.pause) / (std * math.sqrt(2))) # P(interval > elapsed)
+        return -math.log10(later) if later > 0 else math.inf
+
+
+class EventuallyPerfectFailureDetector:
+    """
+        # 2.6.5 Eventually Perfect Failure Detection, with accrual-based timeouts
+
+        Every process sends a heartbeat to all the processes each period, on the fair-loss link under pl (on pl if it
+        has none): lost heartbeats only delay the next arrival. The inter-arrival times of the heartbeats of every
+        process feed an ArrivalWindow, so that the timeout of each process follows its actual heartbeat delays:
+        a process is suspected once the suspicion level phi of its silence reaches threshold, and restored as soon as
+        one of its heartbeats arrives. Any message received from a process resets its silence (a suspected process
+        is also restored by the next check if the other messages bring phi below threshold).
+    """
+
+    def __init__(self, processes, period, pl, threshold : float = 8.0, window : int = 100, min_std : float = None,
+                 pause : float = None) -> None:
+        """
+        Args:
+            period (float): seconds between two heartbeats, and between two checks of the suspicion levels
+            threshold (float): suspicion level phi of a suspected process (8: one false suspicion every 10^8 checks,
+                               if the inter-arrival times were normally distributed)
+            window (int): inter-arrival times per process in the statistics
+            min_std (float): lower bound of the standard deviation of the inter-arrival times (period / 10 by default)
+            pause (float): acceptable silence on top of the mean inter-arrival time, e.g. a few lost heartbeats (2 * period by default)
+        """
+        self.pl = pl
+        self.pid = pl.pid
+        self.runtime = pl.runtime
+        self.processes = processes
+        self.period = period
+        self.threshold = threshold
+        self.fll = pl.fairLossLink()
+        self.last_heard = self.fll.getLastHeard() if self.fll != None else {}
+        self.suspected = set()
+        self.suspectEvents = None
+        self.restoreEvents = None
+        self.msg_counter = 0
+        self.lock = threading.Lock() # the heartbeats are handled concurrently with the checks
+        start = self.runtime.time()
+        min_std = min_std if min_std != None else period / 10
+        pause = pause if pause != None else 2 * period
+        self.arrivals = {p : ArrivalWindow(window, period, min_std, pause) for p in processes}
+        self.last_heartbeat = {p : start for p in processes} # the silence of every process starts with the detector
+
+        self.metrics = Metrics('eventuallyperfectfailuredetector', self.pid)
+        self.metrics.counter('heartbeats_sent')
+        self.metrics.counter('heartbeats_received')
+        self.metrics.counter('suspicions')
+        self.metrics.counter('restores')
+        self.metrics.histogram('heartbeat_interval')
+        self.metrics.gauge('suspected', lambda: len(self.suspected))
+
+        self.runtime.handle(self.pl.getTypedDeliverEvents(HEARTBEAT), self.onEventDeliverHeartbeat)
+
+        # the first heartbeats are sent right away, then every period
+        self.runtime.every(period, self.onEventTimeout, delay=0)
+
+    def onEventTimeout(self) -> None:
+        link = self.fll if self.fll != None else self.pl
+        link.multisend(self.processes, envelope(HEARTBEAT, self.msg_counter))
+        self.msg_counter += 1
+        self.metrics.heartbeats_sent.inc(len(self.processes))
+        now = self.runtime.time()
+        with self.lock:
+            for p in self.processes:
+                suspicious = self.phi(p, now) >= self.threshold
+                if suspicious and p not in self.suspected:
+                    self.suspected.add(p)
+                    self.Suspect(p)
+                elif not suspicious and p in self.suspected:
+                    self.suspected.discard(p)
+                    self.Restore(p)
+
+    def onEventDeliverHeartbeat(self, p, message) -> None:
+        try:
+            now = self.runtime.time()
+            self.metrics.heartbeats_received.inc()
+            with self.lock:
+                arrivals = self.arrivals.get(p)
+                if arrivals == None: # not monitored
+                    return
+                interval = now - self.last_heartbeat[p]
+                arrivals.add(interval)
+                self.last_heartbeat[p] = now
+                self.metrics.heartbeat_interval.observe(interval)
+                if p in self.suspected:
+                    self.suspected.discard(p)
+                    self.Restore(p)
+            if LOG.perfectfailuredector:
+                logger.info('pid:%s - EP: delivered Heartbeat from %s', self.pid, p)
+        except Exception as ex: 
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def phi(self, p, now : float = None) -> float:
+        """ suspicion level of p: its silence is measured from its last heartbeat, or its last message if more recent """
+        if now == None:
+            now = self.runtime.time()
+        last = max(self.last_heartbeat[p], self.last_heard.get(p, NEVER))
+        return self.arrivals[p].phi(now - last)
+
+    def Suspect(self, p) -> None:
+        if LOG.perfectfailuredector:
+            logger.info('pid:%s - EP: Suspect %s', self.pid, p)
+        self.metrics.suspicions.inc()
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.FD, tracer.SUSPECT, p)
+        if self.suspectEvents != None:
+            self.suspectEvents.put(p)
+
+    def Restore(self, p) -> None:
+        if LOG.perfectfailuredector:
+            logger.info('pid:%s - EP: Restore %s', self.pid, p)
+        self.metrics.restores.inc()
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.FD, tracer.RESTORE, p)
+        if self.restoreEvents != None:
+            self.restoreEvents.put(p)
+
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
+
+    def getSuspectEvents(self):
+        self.suspectEvents = self.runtime.queue()
+        return self.suspectEvents
+
+    def getRestoreEvents(self):
+        self.restoreEvents = self.runtime.queue()
+        return self.restoreEvents
@@ -1,45 +1,234 @@
 from genericpath import exists
 import threading
+import asyncio
+import collections
 import queue
 import socket
-import json
 import time
 import sys
-from eventHandler import handleEvents
+import os
+import errno
+import struct
+import selectors
+from eventHandler import TimerWheel, ClassQueue, REAL_TIME
 from abc import ABC, abstractmethod
 
-from DDSlogger import logger, config
+from codec import Codec, BinaryCodec, Encoded
+from metrics import Metrics
+from message import priorityOf, isEnvelope, TYPE, CONTROL, DATA, PRIORITIES
+from DDSlogger import logger, LOG
+import tracer
+
+# HELPER FUNCTIONS
+FRAME_HEADER = struct.Struct('!I') # 4 bytes, payload length
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # 16 MiB, §EDIT largest frame accepted by a receiver
+
+class FrameTooLarge(ConnectionError):
+    """ the length in a frame header exceeds the maximum frame size: the stream is corrupt, the connection has to be closed """
+
+def frame(payload):
+    """ prepends the length header to the payload """
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+class BufferPool:
+    """ pool of reusable receive buffers, shared among the connections of the process """
+
+    def __init__(self, buffer_size : int = 65536, max_buffers : int = 64) -> None:
+        self.buffer_size = buffer_size # 64 KiB, §EDIT buffer size
+        self.max_buffers = max_buffers
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer : bytearray) -> None:
+        if len(buffer) != self.buffer_size: # buffers grown for large frames are not recycled
+            return
+        with self.lock:
+            if len(self.free) < self.max_buffers:
+                self.free.append(buffer)
+
+RECEIVE_BUFFERS = BufferPool()
+
+class FrameReader:
+    """ reads length-prefixed frames from a connected socket
+
+        Data is received with recv_into directly in a pooled buffer, and every complete frame is
+        returned as a memoryview on that buffer: no copy is made between the socket and the decoder.
+        A frame is valid only until the next one is requested.
+    """
 
-# HELPER FUNCTION
-def recvall(sock):
-    """ recvall implementation, receives data of whatever size in several chunks
+    def __init__(self, sock = None, pool : BufferPool = RECEIVE_BUFFERS, max_frame_size : int = MAX_FRAME_SIZE) -> None:
+        """
+        Args:
+            sock (socket): connected socket, None if the data is fed through free() by someone else (e.g. an asyncio protocol)
+            max_frame_size (int): largest payload accepted, a longer frame raises FrameTooLarge before any allocation
+        """
+        self.sock = sock
+        self.pool = pool
+        self.max_frame_size = max_frame_size
+        self.buffer = pool.acquire()
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first byte not consumed yet
+        self.end = 0   # first free byte
+
+    def frames(self):
+        """ generator of the frames received on the socket, it stops when the connection is closed """
+        while True:
+            yield from self.available()
+            received = self.sock.recv_into(self.free())
+            if received == 0: # connection closed
+                return
+            self.end += received
+
+    def available(self):
+        """ generator of the complete frames already in the buffer """
+        while self.end - self.start >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_frame_size:
+                raise FrameTooLarge('frame of '+str(length)+' bytes, the maximum is '+str(self.max_frame_size))
+            frame_end = self.start + FRAME_HEADER.size + length
+            if frame_end > self.end:
+                self.reserve(FRAME_HEADER.size + length)
+                return
+            yield self.view[self.start + FRAME_HEADER.size : frame_end]
+            self.start = frame_end
+
+    def free(self) -> memoryview:
+        """ returns the free part of the buffer, where the next received bytes have to be written (then update self.end) """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            self.reserve(len(self.buffer)) # move the partial header at the beginning
+        return self.view[self.end:]
+
+    def reserve(self, frame_size : int) -> None:
+        """ makes room for a frame of frame_size bytes starting at self.start """
+        pending = self.end - self.start
+        if frame_size > len(self.buffer):
+            buffer = bytearray(frame_size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.pool.release(self.buffer)
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start + frame_size > len(self.buffer):
+            self.view[:pending] = self.view[self.start:self.end]
+        else:
+            return
+        self.start, self.end = 0, pending
 
-    Args:
-        sock (socket): connected socket
+    def close(self) -> None:
+        self.view = None
+        self.pool.release(self.buffer)
+        self.buffer = None
 
-    Returns:
-        [byte]: data received from the socket
-    """
-    BUFF_SIZE = 4096 # 4 KiB, §EDIT buffer size
-    data = b''
-    while True:
-        part = sock.recv(BUFF_SIZE)
-        data += part
-        if len(part) < BUFF_SIZE:
-            # either 0 or end of data
-            break
-    return data
+def endpoint(address, servicePort : int) -> tuple:
+    """ (IP, port) of a destination address: an IP address (the process listens on servicePort) or an (IP, port) pair """
+    if isinstance(address, str):
+        return (address, servicePort)
+    return tuple(address)
 
 # abstract class
 class FairLossLink(ABC):
+    """
+        Interface of the fair-loss links: the implementations take care of transmitting the encoded messages
+        and call deliver on the decoded ones. self.codec (codec.Codec) defines the encoding.
+        self.runtime runs the event handlers of the layers built on the link (see eventHandler.ThreadRuntime).
+    """
+
+    queue_size = 0      # capacity of the deliver queue, 0 means unbounded
+    overflow = 'block'  # see eventHandler.BoundedQueue
+    runtime = REAL_TIME
+    last_heard = None   # pid -> time of the last message received from it, see getLastHeard
+    _metrics = None
+    metrics_lock = threading.Lock()
 
     @abstractmethod 
-    def send(self, pid_receiver, message):
+    def transmit(self, pid_receiver, data : bytes, priority : int = DATA):
+        """ hands an encoded message to the threads transmitting it, the CONTROL ones before the queued DATA ones """
         pass
 
-    @abstractmethod 
+    @property
+    def metrics(self) -> Metrics:
+        """ created on first use, the implementations do not call a base constructor """
+        if self._metrics == None:
+            with FairLossLink.metrics_lock:
+                if self._metrics == None:
+                    self._metrics = self.createMetrics()
+        return self._metrics
+
+    def createMetrics(self) -> Metrics:
+        metrics = Metrics('fairlosslink', self.pid)
+        metrics.counter('sent')       # messages handed to transmit
+        metrics.counter('sent_bytes') # their encoded size
+        metrics.counter('delivered')
+        metrics.counter('dropped')    # messages dropped by the link itself (e.g. full buffers)
+        metrics.gauge('deliver_queue_depth', lambda: self.deliver_events.qsize())
+        metrics.gauge('deliver_queue_dropped', lambda: self.deliver_events.dropped)
+        metrics.gauge('send_queue_depth', lambda: self.to_send.qsize())
+        metrics.gauge('send_queue_dropped', lambda: self.to_send.dropped)
+        for priority, name in enumerate(PRIORITIES): # e.g. send_queue_control_depth
+            metrics.gauge('deliver_queue_'+name+'_depth', lambda priority=priority: self.deliver_events.depths()[priority])
+            metrics.gauge('send_queue_'+name+'_depth', lambda priority=priority: self.to_send.depths()[priority])
+        return metrics
+
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
+
+    def destinations(self) -> list:
+        """ pids the link can send to """
+        return list(self.pid_to_address)
+
+    ### INTERFACES
+    def send(self, pid_receiver, message):
+        if type(message) is Encoded: # e.g. multisend or retransmission
+            data, message = message.data, message.message
+        else:
+            data = self.codec.encode(message)
+        self.transmit(pid_receiver, data, priorityOf(message))
+        metrics = self.metrics
+        metrics.sent.inc()
+        metrics.sent_bytes.inc(len(data))
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.FLL, tracer.SEND, pid_receiver, tracer.messageId(message), len(data))
+        if LOG.fairlosslink:
+            logger.info('pid:%s - fll_send: sending %s to %s', self.pid, message, pid_receiver)
+
+    def multisend(self, pids, message):
+        """ sends message to every process in pids, encoding it only once """
+        if type(message) is not Encoded:
+            message = Encoded(message, self.codec)
+        for pid_receiver in pids:
+            self.send(pid_receiver, message)
+
+    def broadcast(self, message):
+        self.multisend(self.destinations(), message)
+
     def deliver(self, pid_sender, message):
-        pass
+        if LOG.fairlosslink:
+            logger.info('pid:%s - fll_deliver: delivered %s from %s', self.pid, message, pid_sender)
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.FLL, tracer.DELIVER, pid_sender, tracer.messageId(message))
+        self.metrics.delivered.inc()
+        if self.last_heard != None:
+            self.last_heard[pid_sender] = self.runtime.time()
+        if self.deliver_events != None:
+            self.deliver_events.put((pid_sender,message), priority=priorityOf(message))
+
+    ### INTERCONNECTION
+    def getDeliverEvents(self):
+        self.deliver_events = self.runtime.queue(self.queue_size, self.overflow, classes=len(PRIORITIES))
+        return self.deliver_events
+
+    def getLastHeard(self) -> dict:
+        """ pid -> runtime time of the last message received from pid, whatever layer it is for (e.g. proof of liveness) """
+        if self.last_heard == None:
+            self.last_heard = {}
+        return self.last_heard
 
 class FairLossLink_vTCP_simple(FairLossLink):
     """
@@ -51,19 +240,29 @@ class FairLossLink_vTCP_simple(FairLossLink):
         3) ona that transmit all messages enqueued to send
     """
 
-    def __init__(self, pid, servicePort : int, dest_addresses : dict) -> None:
+    def __init__(self, pid, servicePort : int, dest_addresses : dict, codec : Codec = None, queue_size : int = 0, overflow : str = 'block',
+                 source_address : str = None) -> None:
         """
         Args:
             servicePort (int): port for the incoming connections
-            dest_addresses (dict): map pid -> IP address
+            dest_addresses (dict): map pid -> IP address, or (IP, port) if the process does not listen on servicePort
+            codec (Codec): encoding of the messages, BinaryCodec by default
+            queue_size (int): capacity of the send and deliver queues, 0 means unbounded
+            overflow (str): policy applied when a queue is full, see eventHandler.BoundedQueue ('block' propagates backpressure)
+            source_address (str): IP the outgoing connections are bound to. The receivers identify the sender by the
+                                  source IP, so processes sharing a host need distinct ones (e.g. 127.0.0.x addresses)
         """
         self.pid = pid
         self.servicePort = servicePort
         self.pid_to_address = dest_addresses
-        self.address_to_pid = dict((v,k) for k,v in self.pid_to_address.items())
+        self.address_to_pid = dict((endpoint(v, servicePort)[0],k) for k,v in self.pid_to_address.items())
+        self.source_address = source_address
+        self.codec = codec if codec != None else BinaryCodec()
+        self.queue_size = queue_size
+        self.overflow = overflow
         
         self.to_receive = queue.Queue() # (socket, sourceIP)
-        self.to_send = queue.Queue()    # (destIP, messageByte)
+        self.to_send = ClassQueue(queue_size, overflow) # ((destIP, destPort), messageByte) per traffic class
         self.deliver_events = None      # (pid_source, message)
         
         linkInThread = threading.Thread(target=self.manage_links_in, args=())  # this thread should die with its parent process
@@ -97,15 +296,17 @@ class FairLossLink_vTCP_simple(FairLossLink):
 
     def manage_links_out(self):
         while True:
-            ipDestionation, message = self.to_send.get()
+            destination, message = self.to_send.get()
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    if self.source_address != None:
+                        s.bind((self.source_address, 0))
                     s.settimeout(2) # connect timeout
-                    s.connect((ipDestionation, self.servicePort))
+                    s.connect(destination)
                     s.settimeout(None) # back to a blocking socket
                     s.sendall(message)
-                    if config['LOG'].getboolean('fairlosslink'):
-                        logger.info('pid:'+self.pid+' - '+'fll_send: sent '+str(message) +' to '+self.address_to_pid[ipDestionation])
+                    if LOG.fairlosslink:
+                        logger.info('pid:%s - fll_send: sent %s to %s', self.pid, message, self.address_to_pid[destination[0]])
             except socket.error as err:
                 _, _, exc_tb = sys.exc_info()
                 logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
@@ -117,11 +318,12 @@ class FairLossLink_vTCP_simple(FairLossLink):
     def receive_message(self):
         while True:
             sock, addr = self.to_receive.get()
+            reader = FrameReader(sock)
             try:
                 with sock:
-                    received_data = recvall(sock)
-                    message = json.loads(received_data.decode('utf-8')) #§NOTE what about decoding errors?
-                    self.deliver(self.address_to_pid[addr[0]], message['msg']) #§NOTE direct delivery
+                    for received_data in reader.frames():
+                        message = self.codec.decode(received_data) #§NOTE what about decoding errors?
+                        self.deliver(self.address_to_pid[addr[0]], message) #§NOTE direct delivery
             except socket.error as err:
                 _, _, exc_tb = sys.exc_info()
                 logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
@@ -129,25 +331,12 @@ class FairLossLink_vTCP_simple(FairLossLink):
             except Exception as ex:
                 _, _, exc_tb = sys.exc_info()
                 logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
+            finally:
+                reader.close()
         
     ### INTERFACES
-    def send(self, pid_receiver, message):
-        data_to_send = {'msg' : message} #§NOTE message needs to be convertible in JSON
-        data_to_send_byte = json.dumps(data_to_send).encode('utf-8')
-        self.to_send.put((self.pid_to_address[pid_receiver],data_to_send_byte))
-        if config['LOG'].getboolean('fairlosslink'):
-            logger.info('pid:'+self.pid+' - '+'fll_send: sending '+str(message)+' to '+str(pid_receiver))
-    
-    def deliver(self, pid_sender, message):
-        if config['LOG'].getboolean('fairlosslink'):
-            logger.info('pid:'+self.pid+' - '+'fll_deliver: delivered '+str(message)+' from '+str(pid_sender))
-        if self.deliver_events != None:
-            self.deliver_events.put((pid_sender,message))
-
-    ### INTERCONNECTION
-    def getDeliverEvents(self):
-        self.deliver_events = queue.Queue()
-        return self.deliver_events
+    def transmit(self, pid_receiver, data : bytes, priority : int = DATA):
+        self.to_send.put((endpoint(self.pid_to_address[pid_receiver], self.servicePort),frame(data)), priority=priority)
         
 class FairLossLink_vTCP_MTC(FairLossLink):
     """
@@ -158,21 +347,31 @@ class FairLossLink_vTCP_MTC(FairLossLink):
 
     """
 
-    def __init__(self, pid, servicePort : int, dest_addresses : dict, n_threads_in : int = 1, n_threads_out : int = 1) -> None:
+    def __init__(self, pid, servicePort : int, dest_addresses : dict, n_threads_in : int = 1, n_threads_out : int = 1, codec : Codec = None,
+                 queue_size : int = 0, overflow : str = 'block', source_address : str = None) -> None:
         """
         Args:
             servicePort (int): port for the incoming connections
-            dest_addresses (dict): map pid -> IP address
+            dest_addresses (dict): map pid -> IP address, or (IP, port) if the process does not listen on servicePort
             n_threads_in (int): number of threads managing incoming connections
             n_threads_out (int): number of threads managing outgoing connections
+            codec (Codec): encoding of the messages, BinaryCodec by default
+            queue_size (int): capacity of the send and deliver queues, 0 means unbounded
+            overflow (str): policy applied when a queue is full, see eventHandler.BoundedQueue ('block' propagates backpressure)
+            source_address (str): IP the outgoing connections are bound to. The receivers identify the sender by the
+                                  source IP, so processes sharing a host need distinct ones (e.g. 127.0.0.x addresses)
         """
         self.pid = pid
         self.servicePort = servicePort
         self.pid_to_address = dest_addresses
-        self.address_to_pid = dict((v,k) for k,v in self.pid_to_address.items())
+        self.address_to_pid = dict((endpoint(v, servicePort)[0],k) for k,v in self.pid_to_address.items())
+        self.source_address = source_address
+        self.codec = codec if codec != None else BinaryCodec()
+        self.queue_size = queue_size
+        self.overflow = overflow
         
         self.to_receive = queue.Queue() # (socket, sourceIP)
-        self.to_send = queue.Queue()    # (destIP, messageByte)
+        self.to_send = ClassQueue(queue_size, overflow) # ((destIP, destPort), messageByte) per traffic class
         self.deliver_events = None      # (pid_source, message)
         
         linkInThread = threading.Thread(target=self.manage_links_in, args=(n_threads_in,))  # this thread should die with its parent process
@@ -214,11 +413,12 @@ class FairLossLink_vTCP_MTC(FairLossLink):
     def receive_message(self):
         while True:
             sock, addr = self.to_receive.get()
+            reader = FrameReader(sock)
             try:
                 with sock:
-                    received_data = recvall(sock)
-                    message = json.loads(received_data.decode('utf-8')) #§NOTE what about decoding errors?
-                    self.deliver(self.address_to_pid[addr[0]], message['msg']) #§NOTE direct delivery
+                    for received_data in reader.frames():
+                        message = self.codec.decode(received_data) #§NOTE what about decoding errors?
+                        self.deliver(self.address_to_pid[addr[0]], message) #§NOTE direct delivery
             except socket.error as err:
                 _, _, exc_tb = sys.exc_info()
                 logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
@@ -226,170 +426,964 @@ class FairLossLink_vTCP_MTC(FairLossLink):
             except Exception as ex:
                 _, _, exc_tb = sys.exc_info()
                 logger.debug('Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+            finally:
+                reader.close()
 
     def send_message(self):
         while True:
-            ipDestionation, message = self.to_send.get()
+            destination, message = self.to_send.get()
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    if self.source_address != None:
+                        s.bind((self.source_address, 0))
                     s.settimeout(2) # connect timeout
-                    s.connect((ipDestionation, self.servicePort))
+                    s.connect(destination)
                     s.settimeout(None) # back to a blocking socket
                     s.sendall(message)
-                    if config['LOG'].getboolean('fairlosslink'):
-                        logger.info('pid:'+self.pid+' - '+'fll_send: sent '+str(message) +' to '+self.address_to_pid[ipDestionation])
+                    if LOG.fairlosslink:
+                        logger.info('pid:%s - fll_send: sent %s to %s', self.pid, message, self.address_to_pid[destination[0]])
             except socket.error as err:
                 _, _, exc_tb = sys.exc_info()
                 logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
                 continue
             except Exception as ex: #§TO-DO proper exeception handling, except socket.error:
-                logger.debug('pid:'+self.pid+' - EXCEPTION, '+self.manage_link_out.__name__+str(type(ex))+':'+str(ex)+' - '+str(ipDestionation))
+                logger.debug('pid:'+self.pid+' - EXCEPTION, '+self.manage_link_out.__name__+str(type(ex))+':'+str(ex)+' - '+str(destination))
         
     ### INTERFACES
-    def send(self, pid_receiver, message):
-        data_to_send = {'msg' : message} #§NOTE message needs to be convertible in JSON
-        data_to_send_byte = json.dumps(data_to_send).encode('utf-8')
-        self.to_send.put((self.pid_to_address[pid_receiver],data_to_send_byte))
-        if config['LOG'].getboolean('fairlosslink'):
-            logger.info('pid:'+self.pid+' - '+'fll_send: sending '+str(message)+' to '+str(pid_receiver))
-    
-    def deliver(self, pid_sender, message):
-        if config['LOG'].getboolean('fairlosslink'):
-            logger.info('pid:'+self.pid+' - '+'fll_deliver: delivered '+str(message)+' from '+str(pid_sender))
-        if self.deliver_events != None:
-            self.deliver_events.put((pid_sender,message))
+    def transmit(self, pid_receiver, data : bytes, priority : int = DATA):
+        self.to_send.put((endpoint(self.pid_to_address[pid_receiver], self.servicePort),frame(data)), priority=priority)
 
-    ### INTERCONNECTION
-    def getDeliverEvents(self):
-        self.deliver_events = queue.Queue()
-        return self.deliver_events
+class PeerState:
+    """ outgoing state of FairLossLink_vTCP_persistent towards one destination """
+
+    def __init__(self, pid, max_queue : int) -> None:
+        self.pid = pid
+        self.to_send = collections.deque() # frames waiting to be sent, filled by any thread
+        self.control = collections.deque() # CONTROL frames, sent before the ones in to_send
+        self.max_queue = max_queue # 0 means unbounded, for the DATA frames
+        self.sock = None
+        self.connected = False
+        self.connect_deadline = None
+        self.out = None # memoryview of the data being written on the socket
+        self.writing = False # registered in the selector for writing
+        self.failures = 0 # consecutive failed connection attempts
+        self.retry_at = 0 # the circuit is open (messages are dropped) until this time
+        self.dropped = 0
+
+class FairLossLink_vTCP_persistent(FairLossLink):
+    """
+        # 2.4.2 Fair-Loss Links
+
+        This version keeps one long-lived TCP connection per destination pid, lazily (re)established when
+        a message has to be sent, and multiplexes all the messages on it as length-prefixed frames.
+        The first frame of every connection carries the pid of the connecting process.
+
+        Every destination has its own outgoing queue and connection state (PeerState), served by a single thread
+        through non-blocking sockets: a slow or crashed peer only delays its own messages.
+        When a connection cannot be established its queued messages are dropped (fair-loss) and the circuit is opened:
+        messages to that peer are dropped on send, for a backoff period doubling at every failed attempt.
+    """
+
+    def __init__(self, pid, servicePort : int, dest_addresses : dict, codec : Codec = None, max_queue : int = 0,
+                 connect_timeout : float = 2, backoff : float = 0.5, max_backoff : float = 30, queue_size : int = 0, overflow : str = 'block') -> None:
+        """
+        Args:
+            servicePort (int): port for the incoming connections
+            dest_addresses (dict): map pid -> IP address, or (IP, port) if the process does not listen on servicePort
+            codec (Codec): encoding of the messages, BinaryCodec by default
+            max_queue (int): maximum number of messages waiting to be sent to a destination, further ones are dropped (0: unbounded)
+            connect_timeout (float): seconds to establish a connection
+            backoff (float): seconds the circuit stays open after the first failed connection attempt
+            max_backoff (float): maximum seconds the circuit stays open
+            queue_size (int): capacity of the deliver queue, 0 means unbounded
+            overflow (str): policy applied when a queue is full, see eventHandler.BoundedQueue ('block' propagates backpressure)
+        """
+        self.pid = pid
+        self.servicePort = servicePort
+        self.pid_to_address = dest_addresses
+        self.address_to_pid = dict((v,k) for k,v in self.pid_to_address.items())
+        self.codec = codec if codec != None else BinaryCodec()
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.peers = dict((p, PeerState(p, max_queue)) for p in self.pid_to_address) # pid -> PeerState
+        self.ready = collections.deque() # pids with new messages to send, filled by any thread
+        self.hello = frame(str(self.pid).encode('utf-8'))
+        self.deliver_events = None      # (pid_source, message)
+
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_in, self.wakeup_out = socket.socketpair() # wakes up the linkOutThread when new messages are enqueued
+        self.wakeup_in.setblocking(False)
+        self.wakeup_out.setblocking(False)
+        self.wakeup_pending = False
+
+        linkInThread = threading.Thread(target=self.manage_links_in, args=())  # this thread should die with its parent process
+        linkInThread.start()
+
+        linkOutThread = threading.Thread(target=self.manage_links_out, args=())  # this thread should die with its parent process
+        linkOutThread.start()
+
+
+    ### LINK MANAGEMENT
+    def manage_links_in(self):
+        while True: # if the socket fails, re-open
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s: # TCP socket
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    s.bind(('', self.servicePort)) # the socket is reachable by any address the machine happens to have.
+                    s.listen(socket.SOMAXCONN) # connections are long-lived, so the backlog only matters at start-up
+                    while True:
+                        sock, addr = s.accept()
+                        # one thread per incoming connection, it lives as long as the connection
+                        receiveThread = threading.Thread(target=self.receive_message, args=(sock, addr))
+                        receiveThread.start()
+            except socket.error as err:
+                _, _, exc_tb = sys.exc_info()
+                logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
+                continue
+            except Exception as ex:
+                _, _, exc_tb = sys.exc_info()
+                logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def manage_links_out(self):
+        self.selector.register(self.wakeup_in, selectors.EVENT_READ)
+        connecting = set() # peers whose connection is in progress
+        while True:
+            try:
+                timeout = None
+                if connecting:
+                    timeout = max(0, min(peer.connect_deadline for peer in connecting) - time.monotonic())
+                for key, _ in self.selector.select(timeout):
+                    if key.fileobj is self.wakeup_in:
+                        try:
+                            self.wakeup_in.recv(4096)
+                        except BlockingIOError:
+                            pass
+                        self.wakeup_pending = False # cleared after reading the wake-ups and before reading self.ready
+                        continue
+                    peer = key.data
+                    if key.fileobj is not peer.sock: # closed while handling a previous event
+                        continue
+                    if not peer.connected:
+                        connecting.discard(peer)
+                        err = peer.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        if err != 0:
+                            self.connection_failed(peer, OSError(err, os.strerror(err)))
+                            continue
+                        peer.connected = True
+                        peer.failures = 0
+                    self.write(peer)
+                now = time.monotonic()
+                for peer in [peer for peer in connecting if now >= peer.connect_deadline]:
+                    connecting.discard(peer)
+                    self.connection_failed(peer, socket.timeout('connect timeout'))
+                for _ in range(len(self.ready)):
+                    peer = self.peers[self.ready.popleft()]
+                    if peer.sock == None:
+                        if self.connect(peer):
+                            connecting.add(peer)
+                    elif peer.connected and not peer.writing:
+                        self.write(peer)
+            except Exception as ex:
+                _, _, exc_tb = sys.exc_info()
+                logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def connect(self, peer : PeerState) -> bool:
+        """ starts a non-blocking connection, returns True if it is in progress """
+        if time.monotonic() < peer.retry_at: # circuit open
+            self.drop(peer)
+            return False
+        peer.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer.sock.setblocking(False)
+        peer.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # small messages must not wait for the next ones
+        err = peer.sock.connect_ex(endpoint(self.pid_to_address[peer.pid], self.servicePort))
+        if err not in (0, errno.EINPROGRESS):
+            self.connection_failed(peer, OSError(err, os.strerror(err)))
+            return False
+        peer.connected = False
+        peer.connect_deadline = time.monotonic() + self.connect_timeout
+        peer.out = memoryview(self.hello)
+        peer.writing = True
+        self.selector.register(peer.sock, selectors.EVENT_WRITE, peer)
+        return True
+
+    def write(self, peer : PeerState) -> None:
+        """ writes the queued frames until the socket would block """
+        try:
+            while True:
+                if peer.out == None:
+                    if not peer.to_send and not peer.control:
+                        break
+                    frames = []
+                    size = 0
+                    for frames_queue in (peer.control, peer.to_send):
+                        while frames_queue and size < 65536: # coalesce small frames in a single send
+                            frames.append(frames_queue.popleft())
+                            size += len(frames[-1])
+                    peer.out = memoryview(b''.join(frames))
+                sent = peer.sock.send(peer.out)
+                peer.out = peer.out[sent:] if sent < len(peer.out) else None
+        except BlockingIOError:
+            if not peer.writing:
+                peer.writing = True
+                self.selector.register(peer.sock, selectors.EVENT_WRITE, peer)
+            return
+        except socket.error as err: # the connection broke, the data being written is lost
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
+            self.disconnect(peer)
+            if peer.to_send or peer.control: # reconnect immediately
+                self.ready.append(peer.pid)
+            return
+        if peer.writing:
+            peer.writing = False
+            self.selector.unregister(peer.sock)
+        if LOG.fairlosslink:
+            logger.info('pid:%s - fll_send: sent pending messages to %s', self.pid, peer.pid)
+
+    def connection_failed(self, peer : PeerState, err : Exception) -> None:
+        self.disconnect(peer)
+        peer.failures += 1
+        peer.retry_at = time.monotonic() + min(self.backoff * 2 ** (peer.failures - 1), self.max_backoff)
+        self.drop(peer)
+        logger.debug('pid:'+self.pid+' - connection to '+str(peer.pid)+' failed ('+str(err)+'), circuit open for '+str(round(peer.retry_at - time.monotonic(), 3))+'s')
+
+    def disconnect(self, peer : PeerState) -> None:
+        if peer.sock != None:
+            if peer.writing:
+                self.selector.unregister(peer.sock)
+            peer.sock.close()
+        peer.sock = None
+        peer.connected = False
+        peer.writing = False
+        peer.out = None
+
+    def createMetrics(self) -> Metrics:
+        metrics = super().createMetrics()
+        metrics.gauge('send_queue_depth', lambda: sum(len(peer.to_send) + len(peer.control) for peer in list(self.peers.values())))
+        metrics.gauge('send_queue_control_depth', lambda: sum(len(peer.control) for peer in list(self.peers.values())))
+        metrics.gauge('send_queue_data_depth', lambda: sum(len(peer.to_send) for peer in list(self.peers.values())))
+        return metrics
+
+    def drop(self, peer : PeerState) -> None:
+        """ drops the queued messages (fair-loss) """
+        for frames_queue in (peer.control, peer.to_send):
+            while frames_queue:
+                frames_queue.popleft()
+                peer.dropped += 1
+                self.metrics.dropped.inc()
+
+    def receive_message(self, sock, addr):
+        reader = FrameReader(sock)
+        try:
+            with sock:
+                frames = reader.frames()
+                pid_sender = str(next(frames), 'utf-8') # hello frame
+                for received_data in frames:
+                    self.deliver(pid_sender, self.codec.decode(received_data))
+        except StopIteration: # closed before the hello frame
+            pass
+        except socket.error as err:
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
+        except Exception as ex:
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+        finally:
+            reader.close()
+
+    ### INTERFACES
+    def transmit(self, pid_receiver, data : bytes, priority : int = DATA):
+        peer = self.peers[pid_receiver]
+        if time.monotonic() < peer.retry_at or (priority != CONTROL and peer.max_queue and len(peer.to_send) >= peer.max_queue):
+            peer.dropped += 1 # circuit open or queue full, the message is lost
+            self.metrics.dropped.inc()
+            return
+        (peer.control if priority == CONTROL else peer.to_send).append(frame(data))
+        self.ready.append(pid_receiver)
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            try:
+                self.wakeup_out.send(b'\0')
+            except BlockingIOError: # the linkOutThread has already plenty of wake-ups to read
+                pass
+
+class IncomingConnection(asyncio.BufferedProtocol):
+    """ asyncio protocol receiving frames directly in the buffer of a FrameReader """
+
+    def __init__(self, fll) -> None:
+        self.fll = fll
+        self.reader = FrameReader()
+        self.pid_sender = None # set by the hello frame
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.reader.free()
+
+    def buffer_updated(self, nbytes):
+        self.reader.end += nbytes
+        try:
+            for received_data in self.reader.available():
+                if self.pid_sender == None:
+                    self.pid_sender = str(received_data, 'utf-8') # hello frame
+                else:
+                    self.fll.deliver(self.pid_sender, self.fll.codec.decode(received_data))
+        except FrameTooLarge as err:
+            logger.debug('pid:'+self.fll.pid+' - closing the connection of '+str(self.pid_sender)+' - '+str(err))
+            self.transport.close()
+        except Exception as ex:
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.fll.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def connection_lost(self, exc):
+        self.reader.close()
+
+class OutgoingConnection(asyncio.Protocol):
+    """ asyncio protocol of a connection used only to send frames """
+
+    def __init__(self, fll, pid_receiver) -> None:
+        self.fll = fll
+        self.pid_receiver = pid_receiver
+
+    def connection_lost(self, exc):
+        if self.fll.transports.get(self.pid_receiver) is self.transport:
+            del self.fll.transports[self.pid_receiver]
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+class FairLossLink_vAsyncio(FairLossLink):
+    """
+        # 2.4.2 Fair-Loss Links
+
+        All the connections are served by an asyncio event loop running in a single thread: accept, receive and send
+        never block, so a process can keep connections with thousands of neighbors and a slow sender does not stall the others.
+        As in FairLossLink_vTCP_persistent, there is one long-lived connection per destination, lazily (re)established,
+        whose first frame carries the pid of the connecting process.
+    """
+
+    def __init__(self, pid, servicePort : int, dest_addresses : dict, codec : Codec = None, max_buffered : int = 33554432,
+                 queue_size : int = 0, overflow : str = 'block') -> None:
+        """
+        Args:
+            servicePort (int): port for the incoming connections
+            dest_addresses (dict): map pid -> IP address, or (IP, port) if the process does not listen on servicePort
+            codec (Codec): encoding of the messages, BinaryCodec by default
+            max_buffered (int): bytes waiting to be sent on a connection above which new messages are dropped (32 MiB)
+            queue_size (int): capacity of the deliver queue, 0 means unbounded
+            overflow (str): policy applied when a queue is full, see eventHandler.BoundedQueue ('block' propagates backpressure)
+        """
+        self.pid = pid
+        self.servicePort = servicePort
+        self.pid_to_address = dest_addresses
+        self.address_to_pid = dict((v,k) for k,v in self.pid_to_address.items())
+        self.codec = codec if codec != None else BinaryCodec()
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.max_buffered = max_buffered
+
+        self.to_send = collections.deque() # (pid_receiver, messageByte), filled by any thread, emptied by the event loop
+        self.control = collections.deque() # the same for the CONTROL messages, sent first
+        self.wakeup_pending = False
+        self.transports = {}    # pid -> transport of the connected outgoing connection
+        self.connecting = {}    # pid -> frames waiting for the connection to be established
+        self.deliver_events = None  # (pid_source, message)
+
+        self.loop = asyncio.new_event_loop()
+        loopThread = threading.Thread(target=self.run_loop, args=())  # this thread should die with its parent process
+        loopThread.start()
+
+    ### LINK MANAGEMENT
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self.manage_links_in())
+        self.loop.run_forever()
+
+    async def manage_links_in(self):
+        while True: # if the listening socket fails, re-open
+            try:
+                # the socket is reachable by any address the machine happens to have.
+                server = await self.loop.create_server(lambda: IncomingConnection(self), port=self.servicePort, reuse_address=True, backlog=socket.SOMAXCONN)
+                async with server:
+                    await server.serve_forever()
+            except Exception as ex:
+                _, _, exc_tb = sys.exc_info()
+                logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+                await asyncio.sleep(1)
+
+    def manage_links_out(self):
+        """ runs in the event loop, sends every enqueued message """
+        self.wakeup_pending = False # cleared before emptying the queue, later messages schedule a new call
+        while self.control or self.to_send:
+            pid_receiver, message = (self.control or self.to_send).popleft()
+            transport = self.transports.get(pid_receiver)
+            if transport != None:
+                if transport.get_write_buffer_size() > self.max_buffered: # the receiver is too slow, the message is lost
+                    self.metrics.dropped.inc()
+                    continue
+                transport.write(message)
+                if LOG.fairlosslink:
+                    logger.info('pid:%s - fll_send: sent %s to %s', self.pid, message, pid_receiver)
+            elif pid_receiver in self.connecting:
+                self.connecting[pid_receiver].append(message)
+            else:
+                self.connecting[pid_receiver] = [message]
+                self.loop.create_task(self.connect(pid_receiver))
+
+    async def connect(self, pid_receiver):
+        try:
+            transport, _ = await asyncio.wait_for(self.loop.create_connection(lambda: OutgoingConnection(self, pid_receiver), *endpoint(self.pid_to_address[pid_receiver], self.servicePort)), 2) # connect timeout
+            transport.write(frame(str(self.pid).encode('utf-8'))) # hello frame
+            transport.writelines(self.connecting.pop(pid_receiver))
+            self.transports[pid_receiver] = transport
+        except Exception as ex: # the messages waiting for the connection are lost
+            del self.connecting[pid_receiver]
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def createMetrics(self) -> Metrics:
+        metrics = super().createMetrics()
+        metrics.gauge('send_queue_depth', lambda: len(self.control) + len(self.to_send))
+        metrics.gauge('send_queue_control_depth', lambda: len(self.control))
+        metrics.gauge('send_queue_data_depth', lambda: len(self.to_send))
+        return metrics
+
+    ### INTERFACES
+    def transmit(self, pid_receiver, data : bytes, priority : int = DATA):
+        (self.control if priority == CONTROL else self.to_send).append((pid_receiver,frame(data)))
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            self.loop.call_soon_threadsafe(self.manage_links_out)
+
+class FairLossLink_vUDP(FairLossLink):
+    """
+        # 2.4.2 Fair-Loss Links
+
+        UDP datagrams already provide fair-loss semantics, with no connection to establish.
+        Messages to the same destination are packed in a single datagram, up to mtu bytes, if they are sent within flush_window seconds.
+        Datagram format: 1 byte sender pid length, sender pid, then for every message 2 bytes length and the encoded message.
+    """
+
+    MESSAGE_HEADER = struct.Struct('!H') # 2 bytes, message length
+    MAX_DATAGRAM = 65507 # largest UDP payload on IPv4
+
+    def __init__(self, pid, servicePort : int, dest_addresses : dict, codec : Codec = None, mtu : int = 1472, flush_window : float = 0.002,
+                 queue_size : int = 0, overflow : str = 'block') -> None:
+        """
+        Args:
+            servicePort (int): port for the incoming datagrams
+            dest_addresses (dict): map pid -> IP address, or (IP, port) if the process does not listen on servicePort
+            codec (Codec): encoding of the messages, BinaryCodec by default
+            mtu (int): maximum size of a datagram packing several messages (1500 bytes Ethernet MTU minus IP and UDP headers)
+            flush_window (float): seconds a message can wait for other messages to the same destination
+            queue_size (int): capacity of the send and deliver queues, 0 means unbounded
+            overflow (str): policy applied when a queue is full, see eventHandler.BoundedQueue ('block' propagates backpressure)
+        """
+        self.pid = pid
+        self.servicePort = servicePort
+        self.pid_to_address = dest_addresses
+        self.address_to_pid = dict((v,k) for k,v in self.pid_to_address.items())
+        self.codec = codec if codec != None else BinaryCodec()
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.mtu = mtu
+        self.flush_window = flush_window
+
+        pid_bytes = str(self.pid).encode('utf-8')
+        self.datagram_header = bytes((len(pid_bytes),)) + pid_bytes
+
+        self.to_send = ClassQueue(queue_size, overflow) # (pid_receiver, messageByte) per traffic class
+        self.deliver_events = None      # (pid_source, message)
+
+        linkInThread = threading.Thread(target=self.manage_links_in, args=())  # this thread should die with its parent process
+        linkInThread.start()
+
+        linkOutThread = threading.Thread(target=self.manage_links_out, args=())  # this thread should die with its parent process
+        linkOutThread.start()
+
+    ### LINK MANAGEMENT
+    def manage_links_in(self):
+        buffer = bytearray(self.MAX_DATAGRAM)
+        view = memoryview(buffer)
+        while True: # if the socket fails, re-open
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s: # UDP socket
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4194304) # absorb bursts, capped by the kernel (net.core.rmem_max)
+                    s.bind(('', self.servicePort)) # the socket is reachable by any address the machine happens to have.
+                    while True:
+                        size, _ = s.recvfrom_into(buffer)
+                        self.receive_message(view[:size])
+            except socket.error as err:
+                _, _, exc_tb = sys.exc_info()
+                logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
+                continue
+            except Exception as ex:
+                _, _, exc_tb = sys.exc_info()
+                logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def receive_message(self, datagram : memoryview):
+        try:
+            offset = datagram[0] + 1
+            pid_sender = str(datagram[1:offset], 'utf-8')
+            while offset < len(datagram):
+                length, = self.MESSAGE_HEADER.unpack_from(datagram, offset)
+                offset += self.MESSAGE_HEADER.size
+                self.deliver(pid_sender, self.codec.decode(datagram[offset:offset+length]))
+                offset += length
+        except Exception as ex: # a malformed datagram is dropped
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def manage_links_out(self):
+        batches = {}    # pid -> parts of the datagram under construction
+        sizes = {}      # pid -> size of the datagram under construction
+        deadline = None # time by which the pending batches are sent
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            while True:
+                try:
+                    try:
+                        pid_receiver, message = self.to_send.get(timeout = None if deadline == None else max(0, deadline - time.monotonic()))
+                        size = self.MESSAGE_HEADER.size + len(message)
+                        if len(self.datagram_header) + size > self.MAX_DATAGRAM: # it does not fit any datagram, the message is lost
+                            logger.debug('pid:'+self.pid+' - fll_send: dropped message of '+str(len(message))+' bytes to '+str(pid_receiver))
+                            self.metrics.dropped.inc()
+                            continue
+                        if pid_receiver in batches and sizes[pid_receiver] + size > self.mtu:
+                            self.send_datagram(s, pid_receiver, batches.pop(pid_receiver))
+                        if pid_receiver not in batches:
+                            batches[pid_receiver] = [self.datagram_header]
+                            sizes[pid_receiver] = len(self.datagram_header)
+                        batches[pid_receiver].append(self.MESSAGE_HEADER.pack(len(message)))
+                        batches[pid_receiver].append(message)
+                        sizes[pid_receiver] += size
+                        if deadline == None:
+                            deadline = time.monotonic() + self.flush_window
+                    except queue.Empty:
+                        pass
+                    if deadline != None and time.monotonic() >= deadline:
+                        for pid_receiver, parts in batches.items():
+                            self.send_datagram(s, pid_receiver, parts)
+                        batches.clear()
+                        deadline = None
+                except Exception as ex:
+                    _, _, exc_tb = sys.exc_info()
+                    logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def send_datagram(self, s, pid_receiver, parts):
+        try:
+            datagram = b''.join(parts)
+            s.sendto(datagram, endpoint(self.pid_to_address[pid_receiver], self.servicePort))
+            if LOG.fairlosslink:
+                logger.info('pid:%s - fll_send: sent %s to %s', self.pid, datagram, pid_receiver)
+        except socket.error as err: # the messages in the datagram are lost
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(err))+' : '+str(err))
+
+    ### INTERFACES
+    def transmit(self, pid_receiver, data : bytes, priority : int = DATA):
+        self.to_send.put((pid_receiver,data), priority=priority)
+
+class TokenBucket:
+    """ rate limiter: rate events per second, with bursts of up to burst events """
+
+    def __init__(self, rate : float, burst : float, clock = time.monotonic) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.last = clock()
+
+    def take(self, n : int) -> int:
+        """ returns how many of the n requested events are allowed now """
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        allowed = min(n, int(self.tokens))
+        self.tokens -= allowed
+        return allowed
 
 class StubbornLink:
     """
         2.4.3 Stubborn Links
+
+        Every sent message is retransmitted once per timeout period, forever, unless it is evicted by a higher layer.
+        Retransmissions are spread over the period (in slots ticks) instead of being sent in bursts, and they can be
+        limited by a token bucket per destination. Messages are kept per destination, in a dict key -> message
+        plus a deque of keys giving the retransmission order.
     """
 
-    def __init__(self, fll : FairLossLink, timeout) -> None:
+    def __init__(self, fll : FairLossLink, timeout, rate : float = None, burst : float = None, slots : int = 10) -> None:
+        """
+        Args:
+            timeout (float): retransmission period of every message
+            rate (float): maximum retransmissions per second to a single destination (None: unlimited)
+            burst (float): maximum burst of retransmissions to a single destination (rate by default)
+            slots (int): number of ticks per period among which the retransmissions are spread
+        """
         self.fll = fll
         self.pid = fll.pid
-        self.sent = []
+        self.runtime = fll.runtime
+        self.sent = {}     # pid_receiver -> {key -> Encoded message}
+        self.rotation = {} # pid_receiver -> deque of keys, in retransmission order
+        self.buckets = {}  # pid_receiver -> TokenBucket
+        self.next_key = 0  # key of the messages sent without one
+        self.rate = rate
+        self.burst = burst if burst != None else rate
+        self.slots = slots
 
         self.fllDeliverEvents = self.fll.getDeliverEvents() # interconnection
-        self.send_events = queue.Queue()
+        self.send_events = self.runtime.queue(classes=len(PRIORITIES))
         self.deliver_events = None   
 
+        self.metrics = Metrics('stubbornlink', self.pid)
+        self.metrics.counter('sent')
+        self.metrics.counter('delivered')
+        self.metrics.counter('retransmitted')
+        self.metrics.counter('evicted')
+        self.metrics.gauge('pending', lambda: sum(len(messages) for messages in list(self.sent.values())))
+        self.metrics.gauge('send_queue_depth', lambda: self.send_events.qsize())
+        self.metrics.gauge('deliver_queue_depth', lambda: self.deliver_events.qsize())
+        for priority, name in enumerate(PRIORITIES):
+            self.metrics.gauge('send_queue_'+name+'_depth', lambda priority=priority: self.send_events.depths()[priority])
+
         # handle timeout events
-        timeoutEventHandlerThread = threading.Thread(target=self.onEventTimeout, args=(timeout, ))  # this thread should die with its parent process
-        timeoutEventHandlerThread.start()
+        self.runtime.every(timeout / slots, self.onEventTimeout)
         
         # handle fll_deliver events
-        fllDeliverEventHandlerThread = threading.Thread(target=handleEvents, args=(self.fllDeliverEvents, self.onEventFllDeliver))
-        fllDeliverEventHandlerThread.start()
+        self.runtime.handle(self.fllDeliverEvents, self.onEventFllDeliver)
 
-        # handle fll_deliver events
-        sendEventHandlerThread = threading.Thread(target=handleEvents, args=(self.send_events, self.onEventFlSend))
-        sendEventHandlerThread.start()
+        # handle send events
+        self.runtime.handle(self.send_events, self.onEventFlSend)
 
 
     ### EVENT HANDLERS
-    def onEventTimeout(self, seconds : float) -> None:
-        while True:
-            time.sleep(seconds)
-            for pid_receiver, message in self.sent:
+    def onEventTimeout(self) -> None:
+        for pid_receiver, messages in list(self.sent.items()):
+            rotation = self.rotation[pid_receiver]
+            quota = -(-len(messages) // self.slots) # every message once per period
+            if self.rate != None:
+                quota = self.buckets[pid_receiver].take(quota)
+            for _ in range(len(rotation)):
+                if quota == 0 or not rotation: # the rotation may be cleared by evict
+                    break
+                key = rotation.popleft()
+                message = messages.get(key)
+                if message == None: # evicted
+                    continue
+                rotation.append(key)
                 self.fll.send(pid_receiver, message)
-
+                self.metrics.retransmitted.inc()
+                if tracer.TRACER != None:
+                    tracer.TRACER.record(tracer.SL, tracer.RETRANSMIT, pid_receiver, tracer.messageId(message.message))
+                quota -= 1
 
     def onEventFllDeliver(self, pid_sender, message):
         self.deliver(pid_sender, message)
 
-    def onEventFlSend(self, pid_receiver, message):
+    def onEventFlSend(self, pid_receiver, message, key = None):
+        if type(message) is not Encoded: # encoded once for all its retransmissions
+            message = Encoded(message, self.fll.codec)
         self.fll.send(pid_receiver,message)
-        self.sent.append((pid_receiver,message))
+        self.metrics.sent.inc()
+        if key == None:
+            key = ('sl', self.next_key)
+            self.next_key += 1
+        if pid_receiver not in self.sent:
+            self.rotation[pid_receiver] = collections.deque()
+            if self.rate != None:
+                self.buckets[pid_receiver] = TokenBucket(self.rate, self.burst, self.runtime.time)
+            self.sent[pid_receiver] = {}
+        self.sent[pid_receiver][key] = message
+        self.rotation[pid_receiver].append(key)
         
     ### INTERFACES
-    def send(self, pid_receiver, message):
-        if config['LOG'].getboolean('stubbornlink'):
-            logger.info('pid:'+self.pid+' - '+'sl_send: sending '+str(message)+' to '+str(pid_receiver))
-        self.send_events.put((pid_receiver, message))
+    def send(self, pid_receiver, message, key = None):
+        """
+            key: identifies the message among the ones sent to pid_receiver, for a later evict
+        """
+        if LOG.stubbornlink:
+            logger.info('pid:%s - sl_send: sending %s to %s', self.pid, message, pid_receiver)
+        self.send_events.put((pid_receiver, message, key), priority=priorityOf(message))
+
+    def multisend(self, pids, message):
+        """ sends message to every process in pids, encoding it only once """
+        if type(message) is not Encoded:
+            message = Encoded(message, self.fll.codec)
+        for pid_receiver in pids:
+            self.send(pid_receiver, message)
+
+    def broadcast(self, message):
+        self.multisend(self.fll.destinations(), message)
     
     def deliver(self, pid_sender, message):
-        if config['LOG'].getboolean('stubbornlink'):
-            logger.info('pid:'+self.pid+' - '+'sl_deliver: delivered '+str(message)+' from '+str(pid_sender))
+        if LOG.stubbornlink:
+            logger.info('pid:%s - sl_deliver: delivered %s from %s', self.pid, message, pid_sender)
+        self.metrics.delivered.inc()
         if self.deliver_events != None:
-            self.deliver_events.put((pid_sender,message))
+            self.deliver_events.put((pid_sender,message), priority=priorityOf(message))
+
+    def evict(self, pid_receiver, key = None):
+        """ stops retransmitting the message with the given key to pid_receiver, or all of them if key is None """
+        messages = self.sent.get(pid_receiver)
+        if messages == None:
+            return
+        if key == None:
+            self.metrics.evicted.inc(len(messages))
+            messages.clear()
+            self.rotation[pid_receiver].clear()
+        elif messages.pop(key, None) != None: # its key is dropped from the rotation when reached
+            self.metrics.evicted.inc()
+
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
 
     ### INTERCONNECTION
     def getDeliverEvents(self):
-        self.deliver_events = queue.Queue()
+        self.deliver_events = self.runtime.queue(classes=len(PRIORITIES))
         return self.deliver_events
 
+class DeliveredWindow:
+    """
+        Sequence numbers delivered from one sender: every number up to watermark, plus the ones above it in out_of_order.
+        Memory is proportional to the reordering window, not to the number of messages ever delivered.
+    """
+
+    def __init__(self) -> None:
+        self.watermark = -1
+        self.out_of_order = set()
+
+    def add(self, seq : int) -> bool:
+        """ marks seq as delivered, returns False if it was already delivered """
+        if seq <= self.watermark or seq in self.out_of_order:
+            return False
+        if seq == self.watermark + 1:
+            self.watermark = seq
+            while self.watermark + 1 in self.out_of_order:
+                self.watermark += 1
+                self.out_of_order.remove(self.watermark)
+        else:
+            self.out_of_order.add(seq)
+        return True
+
+    def contains(self, seq : int) -> bool:
+        return seq <= self.watermark or seq in self.out_of_order
+
+    def ranges(self, limit : int = 32) -> list:
+        """ the first limit ranges [first, last] of consecutive seqs in out_of_order """
+        ranges = []
+        for seq in sorted(self.out_of_order):
+            if ranges and ranges[-1][1] == seq - 1:
+                ranges[-1][1] = seq
+            elif len(ranges) == limit:
+                break
+            else:
+                ranges.append([seq, seq])
+        return ranges
+
 # abstract class
 class PerfectLink(ABC):
 
     @abstractmethod 
-    def send(self, pid_receiver, message):
+    def send(self, pid_receiver, message, block : bool = True, timeout : float = None):
+        """
+            block, timeout: with flow control, how long to wait for the credits to pid_receiver (see PerfectLinkPingPong.send).
+            The event handlers of the other layers must not block: they send with block=False.
+        """
         pass
 
     @abstractmethod 
     def deliver(self, pid_sender, message):
         pass
 
+    def cancelPending(self, pid_receiver):
+        """ gives up the messages to pid_receiver still not known to be delivered, e.g. once it is detected as crashed """
+        pass
+
+    def multisend(self, pids, message, block : bool = True, timeout : float = None):
+        """ sends message to every process in pids """
+        for pid_receiver in pids:
+            self.send(pid_receiver, message, block, timeout)
+
+    def broadcast(self, message):
+        return self.multisend(self.destinations(), message)
+
+    def destinations(self) -> list:
+        """ pids the link can send to """
+        return []
+
+    def fairLossLink(self) -> FairLossLink:
+        """ the link under this one: the envelopes sent on it directly are dispatched without any delivery guarantee """
+        return None
+
+    @staticmethod
+    def dataMessage(codec : Codec, seq : int, message, encoded : Encoded) -> Encoded:
+        """ ['pl_DATA', seq, message] encoded by codec, reusing the encoding of message """
+        return Encoded(['pl_DATA', seq, message], codec, codec.encodeData(seq, encoded))
+
+    def createMetrics(self) -> Metrics:
+        metrics = Metrics('perfectlink', self.pid)
+        metrics.counter('sent')
+        metrics.counter('delivered')
+        metrics.counter('duplicates')
+        metrics.gauge('send_queue_depth', lambda: self.send_events.qsize())
+        metrics.gauge('deliver_queue_depth', lambda: self.deliver_events.qsize() + self.backlog())
+        for priority, name in enumerate(PRIORITIES):
+            metrics.gauge('send_queue_'+name+'_depth', lambda priority=priority: self.send_events.depths()[priority])
+        return metrics
+
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
+
+    def backlog(self) -> int:
+        """ delivered messages still in the tagged and typed queues """
+        return sum(q.qsize() for q in list(self.tagged_deliver_events.values()) + list(self.typed_deliver_events.values()))
+
+    def dispatch(self, pid_sender, message) -> None:
+        """ puts a delivered message in the queue of its type (envelopes) or tag ('MT:' messages), otherwise in the deliver queue """
+        if isEnvelope(message):
+            events = self.typed_deliver_events.get(message[TYPE])
+        elif type(message) is list and len(message) > 1 and type(message[0]) is str and message[0][:3] == 'MT:':
+            events = self.tagged_deliver_events.get(message[0])
+        else:
+            events = None
+        if events != None:
+            events.put((pid_sender,message))
+        elif self.deliver_events != None:
+            self.deliver_events.put((pid_sender,message), priority=priorityOf(message))
+
+    def getTypedDeliverEvents(self, type_id : int) -> queue.Queue:
+        """
+            type_id (int) : get delivery events of the envelopes of a type (see message.TYPES)
+        """
+        self.typed_deliver_events[type_id] = self.runtime.queue()
+        return self.typed_deliver_events[type_id]
+
+
+class Fanout:
+    """
+        record of a message sent by multisend: pending are the processes that have not acked it yet (PerfectLinkPingPong),
+        skipped the ones it has not been sent to for lack of credits (flow control)
+    """
+
+    __slots__ = ('pending', 'skipped')
+
+    def __init__(self, pids, skipped = ()) -> None:
+        self.pending = dict.fromkeys(pids) # insertion-ordered (not a set), so that simulated runs are reproducible
+        self.skipped = list(skipped)
+
+    def done(self) -> bool:
+        """ all the processes it has been sent to have acked it, the skipped ones excluded """
+        return not self.pending
+
 
 class PerfectLinkOnStubborn(PerfectLink):
     """
     2.4.4 Perfect Links
+
+    Every message is sent as ['pl_DATA', seq, message], seq being a sequence number per receiver, so that
+    duplicates are detected in constant time by a DeliveredWindow per sender.
     """
 
     def __init__(self, sl : StubbornLink) -> None:
         self.sl = sl
         self.pid = sl.pid
-        self.delivered = []
+        self.runtime = sl.runtime
+        self.delivered = {} # pid_sender -> DeliveredWindow
+        self.next_seq = {}  # pid_receiver -> sequence number of the next message
 
-        self.send_events = queue.Queue()
+        self.send_events = self.runtime.queue(classes=len(PRIORITIES))
         self.tagged_deliver_events = {} # collect deliver events with a specific message tag
+        self.typed_deliver_events = {}  # type id -> deliver events of the envelopes of that type
         self.deliver_events = None
         self.slDeliverEvents = self.sl.getDeliverEvents() 
+        self.metrics = self.createMetrics()
 
-        slDeliverEventHandlerThread = threading.Thread(target=handleEvents, args=(self.slDeliverEvents, self.onEventSlDeliver))
-        slDeliverEventHandlerThread.start()
-
-        plSendEventHandlerThread = threading.Thread(target=handleEvents, args=(self.send_events, self.onEventPlSend))
-        plSendEventHandlerThread.start()
+        self.runtime.handle(self.slDeliverEvents, self.onEventSlDeliver)
+        self.runtime.handle(self.send_events, self.onEventPlSend)
 
     ### EVENT HANDLERS
     def onEventSlDeliver(self, pid_sender, message):  
-        pid_sender_message_tuple = (pid_sender, message)
-        if pid_sender_message_tuple not in self.delivered:
-            self.delivered.append(pid_sender_message_tuple)
-            self.deliver(pid_sender_message_tuple[0], pid_sender_message_tuple[1])
+        if message[0] != 'pl_DATA': # sent on the fair-loss link directly, e.g. heartbeats
+            if isEnvelope(message):
+                self.dispatch(pid_sender, message)
+            return
+        _, seq, innerMessage = message
+        window = self.delivered.get(pid_sender)
+        if window == None:
+            window = self.delivered[pid_sender] = DeliveredWindow()
+        if window.add(seq):
+            if tracer.TRACER != None:
+                tracer.TRACER.record(tracer.PL, tracer.DELIVER, pid_sender, seq)
+            self.deliver(pid_sender, innerMessage)
+        else:
+            self.metrics.duplicates.inc()
 
     def onEventPlSend(self, pid_receiver, message):
-        self.sl.send(pid_receiver,message)
+        if type(pid_receiver) is Fanout:
+            self.onEventPlMultisend(pid_receiver, message)
+            return
+        seq = self.next_seq.get(pid_receiver, 0)
+        self.next_seq[pid_receiver] = seq + 1
+        self.sl.send(pid_receiver,['pl_DATA', seq, message], key=seq)
+        self.metrics.sent.inc()
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.PL, tracer.SEND, pid_receiver, seq)
+
+    def onEventPlMultisend(self, fanout : Fanout, message):
+        codec = self.sl.fll.codec
+        encoded = Encoded(message, codec)
+        for pid_receiver in fanout.pending:
+            seq = self.next_seq.get(pid_receiver, 0)
+            self.next_seq[pid_receiver] = seq + 1
+            self.sl.send(pid_receiver, self.dataMessage(codec, seq, message, encoded), key=seq)
+            self.metrics.sent.inc()
+            if tracer.TRACER != None:
+                tracer.TRACER.record(tracer.PL, tracer.SEND, pid_receiver, seq)
 
     ### INTERFACES    
-    def send(self, pid_receiver, message):
-        self.send_events.put((pid_receiver,message))
-        if config['LOG'].getboolean('perfectlink'):
-            logger.info('pid:'+self.pid+' - '+'pl_send: sending '+str(message)+' to '+str(pid_receiver))
+    def send(self, pid_receiver, message, block : bool = True, timeout : float = None):
+        """ never blocks, there is no flow control """
+        self.send_events.put((pid_receiver,message), priority=priorityOf(message))
+        if LOG.perfectlink:
+            logger.info('pid:%s - pl_send: sending %s to %s', self.pid, message, pid_receiver)
     
     def deliver(self, pid_sender, message):
-        if config['LOG'].getboolean('perfectlink'):
-            logger.info('pid:'+self.pid+' - '+'pl_deliver: delivered '+str(message)+' from '+str(pid_sender))
-        if len(message) > 1 and isinstance(message[0],str) and message[0][:3] == 'MT:' and message[0] in self.tagged_deliver_events:
-            self.tagged_deliver_events[message[0]].put((pid_sender,message))
-        elif self.deliver_events != None:
-            self.deliver_events.put((pid_sender,message))
+        if LOG.perfectlink:
+            logger.info('pid:%s - pl_deliver: delivered %s from %s', self.pid, message, pid_sender)
+        self.metrics.delivered.inc()
+        self.dispatch(pid_sender, message)
+
+    def multisend(self, pids, message, block : bool = True, timeout : float = None):
+        """ sends message to every process in pids, encoding it only once """
+        self.send_events.put((Fanout(pids), message), priority=priorityOf(message)) # no acks: the record only carries the destinations
+        if LOG.perfectlink:
+            logger.info('pid:%s - pl_send: sending %s to %s', self.pid, message, pids)
+
+    def destinations(self) -> list:
+        return self.sl.fll.destinations()
+
+    def fairLossLink(self) -> FairLossLink:
+        return self.sl.fll
+
+    def cancelPending(self, pid_receiver):
+        self.sl.evict(pid_receiver)
 
     ### INTERCONNECTION
     def getDeliverEvents(self):
-        self.deliver_events = queue.Queue()
+        self.deliver_events = self.runtime.queue(classes=len(PRIORITIES))
         return self.deliver_events
 
     def getTaggedDeliverEvents(self, msg_tag : str) -> queue.Queue:
         """
             msg_tag (str) : get delivery events for a specific message tag (msg_tag DO NOT include the prefix 'MT:')
         """
-        self.tagged_deliver_events['MT:'+msg_tag] = queue.Queue()
+        self.tagged_deliver_events['MT:'+msg_tag] = self.runtime.queue()
         return self.tagged_deliver_events['MT:'+msg_tag]
 
 
@@ -397,77 +1391,316 @@ class PerfectLinkOnStubborn(PerfectLink):
 class PerfectLinkPingPong(PerfectLink):
     """
         PerfectLink implementation on a Fairloss link, based on ack mechanism to avoid infinite retransmissions
+
+        Every message is sent as ['pl_DATA', seq, message], seq being a sequence number per receiver, so that
+        duplicates are detected in constant time by a DeliveredWindow per sender.
+        Each message waiting for its ack is retransmitted on its own schedule, with exponential backoff and jitter.
+        The CONTROL messages are retransmitted every timeout seconds instead, without backoff: a failure detector
+        relies on them arriving within its period, so timeout must stay well below the period of the detector using
+        the link (e.g. PerfectFailureDetector timeout 20 on a link with timeout 5 gives a lost heartbeat 3 retries).
+
+        Acks:
+        - echo: every delivered message is acked by ['pl_ACK', 'pl_DATA', seq, message]
+        - cumulative: the acks to a sender are coalesced for ack_delay seconds in ['pl_ACK', watermark, ranges],
+          acking every seq up to watermark and in the [first, last] ranges. If a message to the same process is sent
+          in the meanwhile, the ack is piggybacked on it: ['pl_DATA', seq, message, watermark, ranges].
+
+        Flow control (window > 0, cumulative acks only): at most window messages to a process can wait for their ack.
+        Cumulative acks carry one more element, the window advertised by the receiver to that sender: its share of the
+        window minus the messages still waiting in its deliver queues, split among the processes it delivers from, so that
+        all the senders together cannot overrun it; send blocks, or returns False, while the credits to a process are exhausted.
+        One message is always allowed when none is waiting for its ack, to probe a closed window. The CONTROL messages
+        (e.g. heartbeats) need no credits: they would compete with the replies of the same protocol for a small share.
     """
 
-    def __init__(self, fll : FairLossLink, timeout : int) -> None:
+    def __init__(self, fll : FairLossLink, timeout : int, max_timeout : float = None, jitter : float = 0.1,
+                 cumulative_acks : bool = True, ack_delay : float = 0.01, window : int = 0) -> None:
+        """
+        Args:
+            timeout (float): seconds before the first retransmission of a message
+            max_timeout (float): maximum seconds between two retransmissions of a DATA message (8 * timeout by default)
+            jitter (float): retransmission times are randomly spread by +-jitter of their value
+            cumulative_acks (bool): cumulative and piggybacked acks, otherwise every message is acked by echoing it
+            ack_delay (float): maximum seconds a cumulative ack waits to be sent
+            window (int): maximum messages waiting for their ack per receiver, 0 disables flow control
+        """
         self.fll = fll
         self.pid = fll.pid
-        self.delivered = []
-        self.waitingForAck = []
-
-        self.send_events = queue.Queue()
+        self.runtime = fll.runtime
+        self.delivered = {} # pid_sender -> DeliveredWindow
+        self.next_seq = {}  # pid_receiver -> sequence number of the next message
+        self.waitingForAck = {} # pid_receiver -> {seq -> [message, retransmissions, time of the first transmission, Fanout or None]}
+        self.timeout = timeout
+        self.max_timeout = max_timeout if max_timeout != None else 8 * timeout
+        self.jitter = jitter
+        self.retransmissions = TimerWheel(tick=timeout / 10, now=self.runtime.time())
+        self.cumulative_acks = cumulative_acks
+        self.ack_delay = ack_delay
+        self.ack_pending = {} # senders to ack, a dict for a reproducible iteration order (set order depends on the string hashes)
+        self.lock = threading.Lock() # protects delivered and ack_pending, shared with the thread sending cumulative acks
+        self.window = window if cumulative_acks else 0
+        self.inflight = {}   # pid_receiver -> messages waiting for their ack
+        self.advertised = {} # pid_receiver -> window advertised by the receiver, a single credit until its first ack
+        self.flow = threading.Condition()
+
+        self.send_events = self.runtime.queue(classes=len(PRIORITIES))
         self.tagged_deliver_events = {} # collect deliver events with a specific message tag
+        self.typed_deliver_events = {}  # type id -> deliver events of the envelopes of that type
         self.deliver_events = None
         self.flDeliverEvents = self.fll.getDeliverEvents() 
 
-        # handle timeout events
-        timeoutEventHandlerThread = threading.Thread(target=self.onEventTimeout, args=(timeout, ))  # this thread should die with its parent process
-        timeoutEventHandlerThread.start()
+        self.metrics = self.createMetrics()
+        self.metrics.counter('retransmitted')
+        self.metrics.counter('acks_sent')
+        self.metrics.counter('acks_received')
+        self.metrics.counter('would_block') # sends refused because of exhausted credits
+        self.metrics.counter('blocked')     # sends that waited for credits
+        self.metrics.counter('refused')     # messages received while the window was full, not acked
+        self.metrics.histogram('ack_rtt')   # messages never retransmitted only (Karn's algorithm)
+        self.metrics.gauge('pending', lambda: sum(len(pending) for pending in list(self.waitingForAck.values())))
 
-        flDeliverEventHandlerThread = threading.Thread(target=handleEvents, args=(self.flDeliverEvents, self.onEventFlDeliver))
-        flDeliverEventHandlerThread.start()
+        # handle timeout events
+        self.runtime.every(self.retransmissions.tick, self.onEventTimeout)
 
-        plSendEventHandlerThread = threading.Thread(target=handleEvents, args=(self.send_events, self.onEventPlSend))
-        plSendEventHandlerThread.start()
+        self.runtime.handle(self.flDeliverEvents, self.onEventFlDeliver)
+        self.runtime.handle(self.send_events, self.onEventPlSend)
 
     ### EVENT HANDLERS
-    def onEventTimeout(self, seconds : float) -> None:
-        while True:
-            time.sleep(seconds)
-            for pid_receiver, message in self.waitingForAck:
-                self.fll.send(pid_receiver, message)
-
+    def onEventTimeout(self) -> None:
+        for pid_receiver, seq in self.retransmissions.advance(self.runtime.time()):
+            pending = self.waitingForAck.get(pid_receiver, {}).get(seq)
+            if pending == None: # acked or cancelled
+                continue
+            pending[1] += 1
+            self.fll.send(pid_receiver, pending[0])
+            self.metrics.retransmitted.inc()
+            if tracer.TRACER != None:
+                tracer.TRACER.record(tracer.PL, tracer.RETRANSMIT, pid_receiver, seq)
+            self.retransmissions.schedule(self.retransmissionTimeout(pending[1], priorityOf(pending[0])), (pid_receiver, seq))
+
+    def onEventAckTimeout(self) -> None:
+        with self.lock:
+            acks = [(pid_sender, self.delivered[pid_sender]) for pid_sender in self.ack_pending]
+            acks = [(pid_sender, ['pl_ACK', window.watermark, window.ranges()] + self.advertisedWindow()) for pid_sender, window in acks]
+            self.ack_pending.clear()
+        for pid_sender, messageToAck in acks:
+            self.fll.send(pid_receiver=pid_sender, message=messageToAck)
+            self.metrics.acks_sent.inc()
 
     def onEventFlDeliver(self, pid_sender, message): 
         if message[0] == 'pl_ACK':
-            innerMessage = message[1:]
-            pid_sender_message_tuple = (pid_sender, innerMessage)
-            if pid_sender_message_tuple in self.waitingForAck:
-                self.waitingForAck.remove(pid_sender_message_tuple)
-        else:
-            pid_sender_message_tuple = (pid_sender, message)
-            if pid_sender_message_tuple not in self.delivered:
-                self.delivered.append(pid_sender_message_tuple)
-                self.deliver(pid_sender, message)
-            messageToAck = ['pl_ACK'] + message
-            self.fll.send(pid_receiver=pid_sender, message=messageToAck)
+            self.metrics.acks_received.inc()
+            if message[1] == 'pl_DATA': # echo
+                pending = self.waitingForAck.get(pid_sender)
+                entry = pending.pop(message[2], None) if pending != None else None
+                if entry != None:
+                    self.acked(pid_sender, [entry])
+                    self.releaseCredits(pid_sender, 1)
+            else:
+                self.onAck(pid_sender, *message[1:])
+        elif message[0] == 'pl_DATA':
+            seq, innerMessage = message[1], message[2]
+            if len(message) > 3: # piggybacked ack
+                self.onAck(pid_sender, *message[3:])
+            with self.lock:
+                window = self.delivered.get(pid_sender)
+                if window == None:
+                    window = self.delivered[pid_sender] = DeliveredWindow()
+                if self.window and self.freeWindow() == 0 and not window.contains(seq) and priorityOf(innerMessage) != CONTROL:
+                    self.metrics.refused.inc() # not acked, the sender retransmits it until there is room (e.g. its probes)
+                    return
+                new = window.add(seq)
+                flush = False
+                if self.cumulative_acks:
+                    flush = not self.ack_pending # no flush armed yet
+                    self.ack_pending[pid_sender] = None # acked also if duplicate, the previous ack may be lost
+            if flush: # a one-shot flush, no periodic event while there is nothing to ack
+                self.runtime.after(self.ack_delay, self.onEventAckTimeout)
+            if new:
+                if tracer.TRACER != None:
+                    tracer.TRACER.record(tracer.PL, tracer.DELIVER, pid_sender, seq)
+                self.deliver(pid_sender, innerMessage)
+            else:
+                self.metrics.duplicates.inc()
+            if not self.cumulative_acks:
+                messageToAck = ['pl_ACK', 'pl_DATA', seq, innerMessage]
+                self.fll.send(pid_receiver=pid_sender, message=messageToAck)
+                self.metrics.acks_sent.inc()
+        elif isEnvelope(message): # sent on the fair-loss link directly, e.g. heartbeats
+            self.dispatch(pid_sender, message)
+
+    def onAck(self, pid_sender, watermark : int, ranges : list, window : int = None) -> None:
+        pending = self.waitingForAck.get(pid_sender)
+        if pending == None:
+            return
+        acked = []
+        sent = list(pending) # snapshot, the send handler adds new messages concurrently
+        for seq in sent:
+            if seq <= watermark:
+                acked.append(pending.pop(seq, None))
+        for first, last in ranges:
+            if last - first < len(sent):
+                for seq in range(first, last + 1):
+                    acked.append(pending.pop(seq, None))
+            else:
+                for seq in sent:
+                    if first <= seq <= last:
+                        acked.append(pending.pop(seq, None))
+        acked = [entry for entry in acked if entry != None]
+        self.acked(pid_sender, acked)
+        self.releaseCredits(pid_sender, sum(1 for entry in acked if priorityOf(entry[0]) != CONTROL) if self.window else 0, window)
+
+    def acked(self, pid_sender, entries : list) -> None:
+        now = self.runtime.time()
+        for _, retransmissions, sent_at, fanout in entries:
+            if retransmissions == 0: # the ack of a retransmitted message could be for any of its copies
+                self.metrics.ack_rtt.observe(now - sent_at)
+            if fanout != None:
+                fanout.pending.pop(pid_sender, None)
 
     def onEventPlSend(self, pid_receiver, message):
-        self.fll.send(pid_receiver,message)
-        self.waitingForAck.append((pid_receiver, message))
+        if type(pid_receiver) is Fanout:
+            self.onEventPlMultisend(pid_receiver, message)
+            return
+        seq = self.next_seq.get(pid_receiver, 0)
+        self.next_seq[pid_receiver] = seq + 1
+        message = ['pl_DATA', seq, message]
+        piggybacked = None
+        if self.cumulative_acks and pid_receiver in self.ack_pending:
+            with self.lock:
+                if pid_receiver in self.ack_pending:
+                    del self.ack_pending[pid_receiver]
+                    window = self.delivered[pid_receiver]
+                    piggybacked = message + [window.watermark, window.ranges()] + self.advertisedWindow()
+        # before sending, the ack can be handled before send returns (e.g. fused runtime)
+        self.waitingForAck.setdefault(pid_receiver, {})[seq] = [message, 0, self.runtime.time(), None]
+        self.fll.send(pid_receiver,message if piggybacked == None else piggybacked)
+        self.metrics.sent.inc()
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.PL, tracer.SEND, pid_receiver, seq)
+        self.retransmissions.schedule(self.retransmissionTimeout(0), (pid_receiver, seq))
+
+    def onEventPlMultisend(self, fanout : Fanout, message):
+        """ message is encoded once, only the header with the sequence number differs among the destinations """
+        codec = self.fll.codec
+        encoded = Encoded(message, codec)
+        now = self.runtime.time()
+        for pid_receiver in list(fanout.pending):
+            seq = self.next_seq.get(pid_receiver, 0)
+            self.next_seq[pid_receiver] = seq + 1
+            data = self.dataMessage(codec, seq, message, encoded) # also retransmitted as it is, the acks are not piggybacked
+            self.waitingForAck.setdefault(pid_receiver, {})[seq] = [data, 0, now, fanout]
+            self.fll.send(pid_receiver, data)
+            self.metrics.sent.inc()
+            if tracer.TRACER != None:
+                tracer.TRACER.record(tracer.PL, tracer.SEND, pid_receiver, seq)
+            self.retransmissions.schedule(self.retransmissionTimeout(0), (pid_receiver, seq))
+
+    def advertisedWindow(self) -> list:
+        """ [window] to append to the acks, the share of the free window of every sender, empty without flow control (called holding self.lock) """
+        if not self.window:
+            return []
+        return [self.freeWindow() // max(1, len(self.delivered))]
+
+    def freeWindow(self) -> int:
+        """ window minus the messages still waiting in the deliver queues """
+        backlog = self.backlog()
+        if self.deliver_events != None:
+            backlog += self.deliver_events.qsize()
+        return max(0, self.window - backlog)
+
+    def releaseCredits(self, pid_receiver, acked : int, window : int = None) -> None:
+        if not self.window:
+            return
+        with self.flow:
+            self.inflight[pid_receiver] = max(0, self.inflight.get(pid_receiver, 0) - acked)
+            if window != None:
+                self.advertised[pid_receiver] = window
+            self.flow.notify_all()
+
+    def retransmissionTimeout(self, retransmissions : int, priority : int = DATA) -> float:
+        """ seconds before the next retransmission, the CONTROL messages are not backed off (see the class docstring) """
+        if priority == CONTROL:
+            seconds = self.timeout
+        else:
+            seconds = min(self.timeout * 2 ** retransmissions, self.max_timeout)
+        return seconds * self.runtime.random.uniform(1 - self.jitter, 1 + self.jitter)
 
     ### INTERFACES    
-    def send(self, pid_receiver, message):
-        self.send_events.put((pid_receiver,message))
-        if config['LOG'].getboolean('perfectlink'):
-            logger.info('pid:'+self.pid+' - '+'pl_send: sending '+str(message)+' to '+str(pid_receiver))
+    def send(self, pid_receiver, message, block : bool = True, timeout : float = None) -> bool:
+        """
+            With flow control, if the credits to pid_receiver are exhausted it waits for them (block),
+            at most timeout seconds, and returns False if the message has not been sent ("would block").
+            On a simulated runtime the credits cannot be released while waiting: use block=False.
+        """
+        if self.window and priorityOf(message) != CONTROL and not self.acquireCredit(pid_receiver, block, timeout):
+            return False
+        self.send_events.put((pid_receiver,message), priority=priorityOf(message))
+        if LOG.perfectlink:
+            logger.info('pid:%s - pl_send: sending %s to %s', self.pid, message, pid_receiver)
+        return True
+
+    def multisend(self, pids, message, block : bool = True, timeout : float = None) -> Fanout:
+        """
+            sends message to every process in pids, encoding it only once. Returns the Fanout record of the message,
+            done once all the processes have acked it. With flow control the processes without credits are skipped
+            (see send, timeout applies to each of them): they are in the skipped processes of the record, not in the pending ones.
+        """
+        skipped = []
+        if self.window and priorityOf(message) != CONTROL:
+            credited = []
+            for pid_receiver in pids:
+                (credited if self.acquireCredit(pid_receiver, block, timeout) else skipped).append(pid_receiver)
+            pids = credited
+        fanout = Fanout(pids, skipped)
+        self.send_events.put((fanout, message), priority=priorityOf(message))
+        if LOG.perfectlink:
+            logger.info('pid:%s - pl_send: sending %s to %s', self.pid, message, pids)
+        return fanout
+
+    def acquireCredit(self, pid_receiver, block : bool, timeout : float) -> bool:
+        with self.flow:
+            if self.inflight.get(pid_receiver, 0) >= max(1, self.advertised.get(pid_receiver, 1)):
+                if not block:
+                    self.metrics.would_block.inc()
+                    return False
+                self.metrics.blocked.inc()
+                if not self.flow.wait_for(lambda: self.inflight.get(pid_receiver, 0) < max(1, self.advertised.get(pid_receiver, 1)), timeout):
+                    self.metrics.would_block.inc()
+                    return False
+            self.inflight[pid_receiver] = self.inflight.get(pid_receiver, 0) + 1
+        return True
+
+    def destinations(self) -> list:
+        return self.fll.destinations()
+
+    def fairLossLink(self) -> FairLossLink:
+        return self.fll
     
     def deliver(self, pid_sender, message):
-        if config['LOG'].getboolean('perfectlink'):
-            logger.info('pid:'+self.pid+' - '+'pl_deliver: delivered '+str(message)+' from '+str(pid_sender))
-        if len(message) > 1 and isinstance(message[0],str) and message[0][:3] == 'MT:' and message[0] in self.tagged_deliver_events:
-            self.tagged_deliver_events[message[0]].put((pid_sender,message))
-        elif self.deliver_events != None:
-            self.deliver_events.put((pid_sender,message))
+        if LOG.perfectlink:
+            logger.info('pid:%s - pl_deliver: delivered %s from %s', self.pid, message, pid_sender)
+        self.metrics.delivered.inc()
+        self.dispatch(pid_sender, message)
+
+    def cancelPending(self, pid_receiver):
+        pending = self.waitingForAck.pop(pid_receiver, None) # their timers expire with nothing to retransmit
+        for entry in list(pending.values()) if pending != None else []:
+            if entry[3] != None:
+                entry[3].pending.pop(pid_receiver, None)
+        if self.window:
+            with self.flow:
+                self.inflight[pid_receiver] = 0
+                self.flow.notify_all()
 
     ### INTERCONNECTION
     def getDeliverEvents(self):
-        self.deliver_events = queue.Queue()
+        self.deliver_events = self.runtime.queue(classes=len(PRIORITIES))
         return self.deliver_events
 
     def getTaggedDeliverEvents(self, msg_tag : str) -> queue.Queue:
         """
             msg_tag (str) : get delivery events for a specific message tag (msg_tag DO NOT include the prefix 'MT:')
         """
-        self.tagged_deliver_events['MT:'+msg_tag] = queue.Queue()
+        self.tagged_deliver_events['MT:'+msg_tag] = self.runtime.queue()
         return self.tagged_deliver_events['MT:'+msg_tag]
\ No newline at end of file
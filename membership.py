@@ -0,0 +1,260 @@
+from DDSlogger import logger, LOG
+from metrics import Metrics
+import tracer
+from message import envelope, MID, PAYLOAD, SWIM_PING, SWIM_PING_REQ, SWIM_ACK
+import math
+import sys
+import threading
+
+# states of the members
+ALIVE, SUSPECT, DEAD = range(3)
+STATES = ('alive', 'suspect', 'dead')
+
+class SwimMembership:
+    """
+        Membership and failure detection by randomized probing (SWIM, Das, Gupta, Motivala - DSN 2002)
+
+        Every period a process pings one member, taken in turn from a shuffled list of the members. If the ack does not
+        arrive within half a period, k other members are asked to ping it on its behalf (ping-req) and relay the ack.
+        Without any ack by the end of the period the member is suspected, and declared dead, i.e. crashed, if the
+        suspicion is not refuted within suspicion periods. A suspected process refutes the suspicion by increasing its
+        incarnation number.
+        The updates of the membership (pid, state, incarnation) are piggybacked on the pings and acks, each one
+        retransmitted a logarithmic number of times (infection-style dissemination): every process sends O(1) messages
+        per period, whatever the number of processes.
+        Pings, ping-reqs and acks are envelopes sent on the fair-loss link under pl (on pl if it has none).
+    """
+
+    def __init__(self, processes, period, pl, k : int = 3, max_updates : int = 8, retransmit_mult : int = 3,
+                 suspicion_mult : int = 4) -> None:
+        """
+        Args:
+            period (float): protocol period, seconds between two pings of a process
+            k (int): members asked to ping the member that did not ack
+            max_updates (int): membership updates piggybacked on a message
+            retransmit_mult (int): every update is piggybacked retransmit_mult * log10(n) times
+            suspicion_mult (int): a suspected member is declared dead after suspicion_mult * log10(n) periods
+        """
+        self.pl = pl
+        self.pid = pl.pid
+        self.runtime = pl.runtime
+        self.link = pl.fairLossLink()
+        if self.link == None:
+            self.link = pl
+        self.k = k
+        self.max_updates = max_updates
+        scale = max(1, math.ceil(math.log10(len(processes) + 1)))
+        self.retransmissions = retransmit_mult * scale
+        self.suspicion = suspicion_mult * scale
+        self.members = {p : [ALIVE, 0] for p in processes} # pid -> [state, incarnation]
+        self.members[self.pid] = [ALIVE, 0]
+        self.incarnation = 0
+        self.updates = {}      # pid -> [state, incarnation, retransmissions left]
+        self.suspected_at = {} # pid -> period of its suspicion
+        self.order = []        # members to ping in the next periods
+        self.periods = 0
+        self.tick = 0
+        self.target = None     # member pinged in the current period
+        self.probe_seq = None
+        self.acked = True
+        self.seq = 0           # sequence number of the pings, the acks carry the one of their ping
+        self.relays = {}       # seq -> (origin, seq of the origin, period) of the pings sent on behalf of origin
+        self.crashEvents = None
+        self.lock = threading.Lock() # the messages are handled concurrently with the timeouts
+
+        self.metrics = Metrics('membership', self.pid)
+        self.metrics.counter('pings_sent')
+        self.metrics.counter('ping_reqs_sent')
+        self.metrics.counter('acks_sent')
+        self.metrics.counter('acks_relayed')
+        self.metrics.counter('suspicions')
+        self.metrics.counter('refutations')
+        self.metrics.counter('crashes')
+        self.metrics.gauge('alive', lambda: sum(1 for state, _ in list(self.members.values()) if state == ALIVE))
+        self.metrics.gauge('suspected', lambda: len(self.suspected_at))
+        self.metrics.gauge('updates', lambda: len(self.updates))
+
+        self.runtime.handle(self.pl.getTypedDeliverEvents(SWIM_PING), self.onEventDeliverPing)
+        self.runtime.handle(self.pl.getTypedDeliverEvents(SWIM_PING_REQ), self.onEventDeliverPingReq)
+        self.runtime.handle(self.pl.getTypedDeliverEvents(SWIM_ACK), self.onEventDeliverAck)
+
+        # two ticks per period: ping at the first one, ping-req at the second one if not acked yet
+        self.runtime.every(period / 2, self.onEventTimeout, delay=0)
+
+    ### EVENT HANDLERS
+    def onEventTimeout(self) -> None:
+        with self.lock:
+            tick, self.tick = self.tick % 2, self.tick + 1
+            if tick == 0:
+                if self.target != None and not self.acked:
+                    self.update(self.target, SUSPECT, self.members[self.target][1])
+                self.periods += 1
+                for p, since in list(self.suspected_at.items()):
+                    if self.periods - since >= self.suspicion:
+                        self.update(p, DEAD, self.members[p][1])
+                for seq, (_, _, period) in list(self.relays.items()):
+                    if period < self.periods - 1: # the ack of the target did not arrive
+                        del self.relays[seq]
+                self.probe()
+            elif self.target != None and not self.acked:
+                self.probeIndirectly()
+
+    def onEventDeliverPing(self, q, message) -> None:
+        try:
+            with self.lock:
+                self.merge(message[PAYLOAD])
+                self.link.send(q, envelope(SWIM_ACK, message[MID], self.pid, self.piggyback(q)))
+                self.metrics.acks_sent.inc()
+        except Exception as ex:
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def onEventDeliverPingReq(self, q, message) -> None:
+        try:
+            with self.lock:
+                target, updates = message[PAYLOAD]
+                self.merge(updates)
+                self.seq += 1
+                self.relays[self.seq] = (q, message[MID], self.periods)
+                self.link.send(target, envelope(SWIM_PING, self.seq, self.pid, self.piggyback(target)))
+                self.metrics.pings_sent.inc()
+        except Exception as ex:
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    def onEventDeliverAck(self, q, message) -> None:
+        try:
+            with self.lock:
+                self.merge(message[PAYLOAD])
+                seq = message[MID]
+                if seq == self.probe_seq: # directly or through a relay
+                    self.acked = True
+                relay = self.relays.pop(seq, None)
+                if relay != None:
+                    origin, origin_seq, _ = relay
+                    self.link.send(origin, envelope(SWIM_ACK, origin_seq, self.pid, self.piggyback(origin)))
+                    self.metrics.acks_relayed.inc()
+        except Exception as ex:
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('pid:'+self.pid+' - Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex))
+
+    ### PROBES
+    def probe(self) -> None:
+        """ pings the next member, every member is pinged once in a round of the shuffled list """
+        self.target = None
+        while self.target == None:
+            if not self.order:
+                self.order = [p for p, (state, _) in self.members.items() if p != self.pid and state != DEAD]
+                if not self.order:
+                    return
+                self.runtime.random.shuffle(self.order)
+            p = self.order.pop()
+            if self.members[p][0] != DEAD:
+                self.target = p
+        self.seq += 1
+        self.probe_seq = self.seq
+        self.acked = False
+        self.link.send(self.target, envelope(SWIM_PING, self.seq, self.pid, self.piggyback(self.target)))
+        self.metrics.pings_sent.inc()
+
+    def probeIndirectly(self) -> None:
+        candidates = [p for p, (state, _) in self.members.items() if p != self.pid and p != self.target and state != DEAD]
+        for p in self.runtime.random.sample(candidates, min(self.k, len(candidates))):
+            self.link.send(p, envelope(SWIM_PING_REQ, self.probe_seq, self.pid, [self.target, self.piggyback(p)]))
+            self.metrics.ping_reqs_sent.inc()
+
+    ### DISSEMINATION
+    def piggyback(self, pid_receiver) -> list:
+        """
+            the max_updates updates retransmitted the least so far, as [pid, state, incarnation], plus the suspicion
+            of pid_receiver if any, so that it can refute it in time even if the update has already been disseminated
+        """
+        if len(self.updates) > self.max_updates:
+            pids = sorted(self.updates, key=lambda p: self.updates[p][2], reverse=True)[:self.max_updates]
+        else:
+            pids = list(self.updates)
+        updates = []
+        for p in pids:
+            update = self.updates[p]
+            updates.append([p, update[0], update[1]])
+            update[2] -= 1
+            if update[2] == 0:
+                del self.updates[p]
+        state, incarnation = self.members.get(pid_receiver, (ALIVE, 0))
+        if state == SUSPECT and pid_receiver not in pids:
+            updates.append([pid_receiver, state, incarnation])
+        return updates
+
+    def merge(self, updates : list) -> None:
+        for p, state, incarnation in updates:
+            self.update(p, state, incarnation)
+
+    def update(self, p, state : int, incarnation : int) -> None:
+        """
+            applies an update of the membership if it overrides the known state of p, and disseminates it.
+            A stale update is answered by disseminating the known state again, e.g. to the process still suspecting
+            a member that has refuted the suspicion.
+        """
+        if p == self.pid:
+            if state != ALIVE and incarnation >= self.incarnation: # refutes the suspicion
+                self.incarnation = incarnation + 1
+                self.members[p] = [ALIVE, self.incarnation]
+                self.metrics.refutations.inc()
+            elif incarnation == self.incarnation or p in self.updates:
+                return
+            self.updates[p] = [ALIVE, self.incarnation, self.retransmissions]
+            return
+        current = self.members.get(p)
+        if current == None: # joined
+            current = self.members[p] = [ALIVE, -1]
+        known_state, known_incarnation = current
+        if known_state == DEAD or incarnation < known_incarnation:
+            if state != DEAD and p not in self.updates: # stale
+                self.updates[p] = [known_state, known_incarnation, self.retransmissions]
+            return
+        if state == ALIVE:
+            if incarnation == known_incarnation:
+                return
+            self.suspected_at.pop(p, None)
+        elif state == SUSPECT:
+            if incarnation == known_incarnation and known_state == SUSPECT:
+                return
+            if known_state != SUSPECT:
+                self.suspected_at[p] = self.periods
+                self.Suspect(p)
+        else:
+            self.suspected_at.pop(p, None)
+            self.Crash(p)
+        current[0], current[1] = state, incarnation
+        self.updates[p] = [state, incarnation, self.retransmissions]
+
+    def Suspect(self, p) -> None:
+        if LOG.membership:
+            logger.info('pid:%s - SWIM: Suspect %s', self.pid, p)
+        self.metrics.suspicions.inc()
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.FD, tracer.SUSPECT, p)
+
+    def Crash(self, p) -> None:
+        if LOG.membership:
+            logger.info('pid:%s - SWIM: detected Crash of %s', self.pid, p)
+        self.metrics.crashes.inc()
+        if tracer.TRACER != None:
+            tracer.TRACER.record(tracer.FD, tracer.CRASH, p)
+        self.pl.cancelPending(p)
+        if self.crashEvents != None:
+            self.crashEvents.put(p)
+
+    ### INTERFACES
+    def alive(self) -> list:
+        """ members not declared dead, the suspected ones included """
+        with self.lock:
+            return [p for p, (state, _) in self.members.items() if state != DEAD]
+
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
+
+    ### INTERCONNECTION
+    def getCrashEvents(self):
+        self.crashEvents = self.runtime.queue()
+        return self.crashEvents
@@ -0,0 +1,70 @@
+# Typed messages of the protocols: an envelope is the list [ENVELOPE, type id, message id, sender, payload],
+# type id and message id being integers, so that the perfect links dispatch it to the queue of its type
+# by a single dict lookup (getTypedDeliverEvents) and the codecs encode it like any other list.
+# The ENVELOPE mark keeps the lists of the applications starting with an integer out of the typed queues.
+# The tagged messages ['MT:<tag>', 'MID:<n>', ...] are still supported (getTaggedDeliverEvents).
+
+ENVELOPE = 'MT#'
+TYPE, MID, SENDER, PAYLOAD = range(1, 5) # positions in the envelope
+
+# traffic classes, the control messages are sent and handled before the data ones queued by every layer
+CONTROL, DATA = range(2)
+PRIORITIES = ('control', 'data')
+
+class MessageTypes:
+    """
+        Registry of the message types: name -> integer id.
+        Every process must register the same types in the same order.
+    """
+
+    def __init__(self) -> None:
+        self.names = []
+        self.ids = {} # name -> type id
+        self.priorities = [] # type id -> traffic class
+
+    def register(self, name : str, priority : int = DATA) -> int:
+        """ returns the type id of name, registering it if needed """
+        type_id = self.ids.get(name)
+        if type_id == None:
+            type_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.priorities.append(priority)
+        return type_id
+
+    def name(self, type_id : int) -> str:
+        return self.names[type_id]
+
+TYPES = MessageTypes()
+
+# 2.6.2 Perfect Failure Detection
+HEARTBEAT_REQUEST = TYPES.register('HeartbeatRequest', CONTROL)
+HEARTBEAT_REPLY = TYPES.register('HeartbeatReply', CONTROL)
+# 2.6.5 Eventually Perfect Failure Detection
+HEARTBEAT = TYPES.register('Heartbeat', CONTROL)
+# SWIM membership (membership.py)
+SWIM_PING = TYPES.register('SwimPing', CONTROL)
+SWIM_PING_REQ = TYPES.register('SwimPingReq', CONTROL)
+SWIM_ACK = TYPES.register('SwimAck', CONTROL)
+
+def envelope(type_id : int, mid : int, sender = None, payload = None) -> list:
+    return [ENVELOPE, type_id, mid, sender, payload]
+
+def isEnvelope(message) -> bool:
+    return type(message) is list and len(message) == 5 and message[0] == ENVELOPE and type(message[TYPE]) is int
+
+def priorityOf(message) -> int:
+    """ traffic class of a message: the acks of the links and the envelopes of control types are CONTROL """
+    if type(message) is not list: # e.g. codec.Encoded
+        message = getattr(message, 'message', None)
+        if type(message) is not list:
+            return DATA
+    if not message:
+        return DATA
+    head = message[0]
+    if head == 'pl_DATA' and len(message) > 2:
+        return priorityOf(message[2])
+    if head == 'pl_ACK':
+        return CONTROL
+    if isEnvelope(message) and 0 <= message[TYPE] < len(TYPES.priorities):
+        return TYPES.priorities[message[TYPE]]
+    return DATA
@@ -0,0 +1,155 @@
+import bisect
+import os
+import threading
+import time
+import weakref
+
+# Runtime metrics of the layers: every layer owns a Metrics object with its counters, gauges and histograms,
+# stats() gives a snapshot of them and dumpPrometheus writes all the metrics of the process in the Prometheus text format.
+# Counters and histograms are updated without locks: every thread increments its own cell, the cells are summed when read.
+
+class Counter:
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+        self.cells = [] # one [value] per thread
+
+    def inc(self, n : int = 1) -> None:
+        try:
+            self.local.cell[0] += n
+        except AttributeError: # first increment of this thread
+            self.local.cell = [n]
+            self.cells.append(self.local.cell)
+
+    def value(self) -> int:
+        return sum(cell[0] for cell in list(self.cells))
+
+class Gauge:
+    """ value read on demand, e.g. the depth of a queue """
+
+    def __init__(self, function) -> None:
+        self.function = function
+
+    def value(self):
+        try:
+            return self.function()
+        except Exception: # e.g. the queue does not exist yet
+            return None
+
+class Histogram:
+    """ counts of the observed values per bucket (upper bounds in seconds), plus their sum """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets : tuple = BUCKETS) -> None:
+        self.buckets = buckets
+        self.local = threading.local()
+        self.cells = [] # one [count per bucket..., count above the last bucket, sum] per thread
+
+    def observe(self, value : float) -> None:
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0] * (len(self.buckets) + 2)
+            self.cells.append(cell)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def value(self) -> dict:
+        """ {'count', 'sum', 'buckets' : cumulative counts per upper bound, 'p50', 'p99' : upper bounds of the buckets of the quantiles} """
+        totals = [0] * (len(self.buckets) + 2)
+        for cell in list(self.cells):
+            for i, n in enumerate(cell):
+                totals[i] += n
+        count = sum(totals[:-1])
+        cumulative, buckets = 0, {}
+        for bound, n in zip(self.buckets + (float('inf'),), totals[:-1]):
+            cumulative += n
+            buckets[bound] = cumulative
+        return {'count' : count, 'sum' : totals[-1], 'buckets' : buckets, 'p50' : self.quantile(buckets, count, 0.5), 'p99' : self.quantile(buckets, count, 0.99)}
+
+    @staticmethod
+    def quantile(buckets : dict, count : int, q : float) -> float:
+        for bound, cumulative in buckets.items():
+            if count and cumulative >= q * count:
+                return bound
+        return None
+
+REGISTRY = weakref.WeakSet() # Metrics of the layers of the process, they go away with their layer
+
+class Metrics:
+    """
+        metrics of one layer instance, labelled by layer name and pid.
+        Every metric is also an attribute named after it, e.g. metrics.counter('sent') -> metrics.sent.inc()
+    """
+
+    def __init__(self, layer : str, pid) -> None:
+        self.layer = layer
+        self.pid = pid
+        self.metrics = {} # name -> Counter, Gauge or Histogram
+        REGISTRY.add(self)
+
+    def counter(self, name : str) -> Counter:
+        return self.add(name, Counter())
+
+    def gauge(self, name : str, function) -> Gauge:
+        return self.add(name, Gauge(function))
+
+    def histogram(self, name : str, buckets : tuple = Histogram.BUCKETS) -> Histogram:
+        return self.add(name, Histogram(buckets))
+
+    def add(self, name : str, metric):
+        self.metrics[name] = metric
+        setattr(self, name, metric)
+        return metric
+
+    def snapshot(self) -> dict:
+        return {name : metric.value() for name, metric in list(self.metrics.items())}
+
+def stats() -> list:
+    """ snapshots of all the layers of the process: [{'layer', 'pid', 'metrics'}] """
+    return [{'layer' : m.layer, 'pid' : m.pid, 'metrics' : m.snapshot()} for m in list(REGISTRY)]
+
+def prometheusText(prefix : str = 'dds') -> str:
+    lines = {} # metric name -> lines, to write a single TYPE line per metric
+    for m in list(REGISTRY):
+        labels = 'layer="%s",pid="%s"' % (m.layer, m.pid)
+        for name, metric in list(m.metrics.items()):
+            value = metric.value()
+            if value == None:
+                continue
+            if isinstance(metric, Counter):
+                lines.setdefault((prefix+'_'+name+'_total', 'counter'), []).append('%s_%s_total{%s} %s' % (prefix, name, labels, value))
+            elif isinstance(metric, Gauge):
+                lines.setdefault((prefix+'_'+name, 'gauge'), []).append('%s_%s{%s} %s' % (prefix, name, labels, value))
+            else:
+                full_name = prefix+'_'+name+'_seconds'
+                samples = lines.setdefault((full_name, 'histogram'), [])
+                for bound, cumulative in value['buckets'].items():
+                    samples.append('%s_bucket{%s,le="%s"} %d' % (full_name, labels, '+Inf' if bound == float('inf') else bound, cumulative))
+                samples.append('%s_sum{%s} %s' % (full_name, labels, value['sum']))
+                samples.append('%s_count{%s} %d' % (full_name, labels, value['count']))
+    text = []
+    for (name, kind), samples in sorted(lines.items()):
+        text.append('# TYPE '+name+' '+kind)
+        text.extend(samples)
+    return '\n'.join(text)+'\n'
+
+def dumpPrometheus(path : str) -> None:
+    """ writes the metrics of the process to path, atomically (e.g. for the textfile collector of node_exporter) """
+    tmp = path+'.tmp'
+    with open(tmp, 'w') as fd:
+        fd.write(prometheusText())
+    os.replace(tmp, path)
+
+def startPrometheusDump(path : str, seconds : float = 5) -> None:
+    """ dumps the metrics to path every seconds """
+    def dump():
+        while True:
+            time.sleep(seconds)
+            try:
+                dumpPrometheus(path)
+            except OSError:
+                pass
+    dumpThread = threading.Thread(target=dump, args=())  # this thread should die with its parent process
+    dumpThread.start()
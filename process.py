@@ -1,4 +1,4 @@
-import netifaces
+import argparse
 import random
 import time
 import os.path
@@ -6,59 +6,122 @@ import configparser
 from DDSlogger import logger
 
 import link
+import eventHandler
 import failure_detector
+import membership
+import metrics
+import tracer
+
+# COMMAND LINE
+# no arguments: process of a mininet simulation (DS_simulation.py), the pid is derived from the IP addresses of the host
+# --pid: the pid is given explicitly and the addresses in the configuration files are 'IP:port' (DS_local.py)
+parser = argparse.ArgumentParser()
+parser.add_argument('--pid', help='pid of the process, otherwise derived from the IP addresses of the host')
+parser.add_argument('--link', default='simple', choices=('simple', 'mtc', 'persistent', 'asyncio', 'udp'), help='fair-loss link implementation')
+parser.add_argument('--config-dir', default='.', help='directory of pid_IPaddr_map.txt and outLinks.txt')
+parser.add_argument('--metrics-file', help='file where the metrics of the process are periodically dumped (Prometheus text format)')
+parser.add_argument('--workers', type=int, default=4, help='threads running the event handlers of the layers, 0 for a thread per event queue')
+parser.add_argument('--fused', action='store_true', help='the layers handle the events on the thread of the link (no queue between the layers)')
+parser.add_argument('--trace-file', help='file of the binary trace of the events of the process (tracer.py)')
+parser.add_argument('--swim', action='store_true', help='SWIM gossip membership (randomized probing, O(n) messages per period) instead of the failure detectors')
+parser.add_argument('--eventual', action='store_true', help='eventually perfect failure detector (suspect/restore, accrual-based timeouts) instead of the perfect one')
+parser.add_argument('--piggyback', action='store_true', help='any message proves liveness to the failure detector, heartbeats on the fair-loss link to the silent processes only')
+args = parser.parse_args()
+
+def parseAddress(address : str):
+    """ 'IP' or 'IP:port' -> 'IP' or ('IP', port) """
+    if ':' in address:
+        ip, port = address.rsplit(':', 1)
+        return (ip, int(port))
+    return address
 
 # HARDWARE DEPENDENT CONFIGURATION
 
-# get one of the VM' IPs in a mininet simulation
-ip_addresses = [netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['addr'] for iface in netifaces.interfaces() if netifaces.AF_INET in netifaces.ifaddresses(iface)]
-for ip in ip_addresses:
-    if ip != '127.0.0.1':
-        break
+if args.pid == None:
+    import netifaces
+
+    # get one of the VM' IPs in a mininet simulation
+    ip_addresses = [netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['addr'] for iface in netifaces.interfaces() if netifaces.AF_INET in netifaces.ifaddresses(iface)]
+    for ip in ip_addresses:
+        if ip != '127.0.0.1':
+            break
 
 processes = []
+pid_to_addresses = {}
 # get pid in a mininet simulation
-with open('pid_IPaddr_map.txt', 'r') as fd:
+with open(os.path.join(args.config_dir, 'pid_IPaddr_map.txt'), 'r') as fd:
     for line in fd:
         line_content = line.split()
         pid_i = line_content[0]
         addrs_i = line_content[1:]
-        if ip in addrs_i:
+        if args.pid == None and ip in addrs_i:
             pid = pid_i
+        pid_to_addresses[pid_i] = addrs_i
         processes.append(pid_i)
 processes = tuple(processes)
+if args.pid != None:
+    pid = args.pid
 
 # get neighbors in a mininet simulation
 neighborID_to_addr = {}
-with open('outLinks.txt', 'r') as fd:
+with open(os.path.join(args.config_dir, 'outLinks.txt'), 'r') as fd:
     for line in fd:
         if line == '* *\n':
-            with open('pid_IPaddr_map.txt', 'r') as fd:
-                for line in fd:
-                    nid, addr = line.split()
-                    #if addr != ip:
-                    neighborID_to_addr[nid] = addr
+            for nid, addrs in pid_to_addresses.items():
+                #if addr != ip:
+                neighborID_to_addr[nid] = parseAddress(addrs[0])
             break
         else:
             line_content = line.split()
             if line_content[0] == pid:
                 for npid_naddr in line_content[1:]:
-                    npid, nadd = npid_naddr.split(':')
-                    neighborID_to_addr[npid] = nadd
+                    npid, nadd = npid_naddr.split(':', 1)
+                    neighborID_to_addr[npid] = parseAddress(nadd)
                 break
-neighborID_to_addr[pid] = '127.0.0.1'
-logger.debug(str(pid)+' : '+str(neighborID_to_addr))
 
 # SETTING UP PRIMITIVES
 
+if args.trace_file != None: # before the layers, to trace their first events
+    tracer.enable(args.trace_file, pid)
+
+if args.fused: # the layers take the runtime of the link
+    link.FairLossLink.runtime = eventHandler.FusedRuntime()
+elif args.workers > 0:
+    link.FairLossLink.runtime = eventHandler.Dispatcher(workers=args.workers)
+
 # setting up link
 service_port = 3210
-fll = link.FairLossLink_vTCP_simple(pid, service_port, neighborID_to_addr) # Implementation 1 of ffl
-#fll = link.FairLossLink_vTCP_MTC(pid, service_port, neighborID_to_addr, n_threads_in=1, n_threads_out=2) # Implementation 2 of ffl
+source_address = None
+if args.pid == None:
+    neighborID_to_addr[pid] = '127.0.0.1'
+else:
+    # processes sharing the host: each one listens on its own port and sends from its own loopback address
+    source_address, service_port = parseAddress(pid_to_addresses[pid][0])
+    neighborID_to_addr[pid] = (source_address, service_port)
+logger.debug(str(pid)+' : '+str(neighborID_to_addr))
+
+if args.link == 'simple':
+    fll = link.FairLossLink_vTCP_simple(pid, service_port, neighborID_to_addr, source_address=source_address) # Implementation 1 of ffl
+elif args.link == 'mtc':
+    fll = link.FairLossLink_vTCP_MTC(pid, service_port, neighborID_to_addr, n_threads_in=1, n_threads_out=2, source_address=source_address) # Implementation 2 of ffl
+elif args.link == 'persistent':
+    fll = link.FairLossLink_vTCP_persistent(pid, service_port, neighborID_to_addr)
+elif args.link == 'asyncio':
+    fll = link.FairLossLink_vAsyncio(pid, service_port, neighborID_to_addr)
+else:
+    fll = link.FairLossLink_vUDP(pid, service_port, neighborID_to_addr)
 #sl = link.StubbornLink(fll, 30)
 #pl = link.PerfectLinkOnStubborn(sl=sl)
 pl = link.PerfectLinkPingPong(fll, timeout = 5)
-P = failure_detector.PerfectFailureDetector(processes=processes, timeout=20, pl=pl)
+if args.swim:
+    P = membership.SwimMembership(processes=processes, period=5, pl=pl)
+elif args.eventual:
+    P = failure_detector.EventuallyPerfectFailureDetector(processes=processes, period=5, pl=pl)
+else:
+    P = failure_detector.PerfectFailureDetector(processes=processes, timeout=20, pl=pl, piggyback=args.piggyback)
+
+if args.metrics_file != None:
+    metrics.startPrometheusDump(args.metrics_file)
 
 # PROTOCOL
 
@@ -70,4 +133,4 @@ while True:
             time.sleep(5)
             pl.send(npid,['MID:'+str(counter), 'Hello!'])
         counter += 1
-"""
\ No newline at end of file
+"""
@@ -0,0 +1,181 @@
+from DDSlogger import logger
+import sys
+import heapq
+import itertools
+import queue
+import random
+
+from link import FairLossLink
+from codec import Codec, BinaryCodec
+
+class SimulatedQueue(queue.Queue):
+    """
+        Event queue of a simulated runtime: if a handler is attached, every put schedules the handler call
+        at the current virtual time, otherwise the events are kept to be read once the simulation has run.
+        Queues are unbounded, since nothing could consume them while a put is blocked.
+    """
+
+    def __init__(self, simulator) -> None:
+        super().__init__()
+        self.simulator = simulator
+        self.handler = None
+        self.dropped = 0
+        self.blocked = 0
+
+    def attach(self, handlerFunction) -> None:
+        self.handler = handlerFunction
+        while not self.empty():
+            self.simulator.schedule(0, handlerFunction, *self.get_nowait())
+
+    def put(self, item, block=True, timeout=None, priority=None) -> bool:
+        if self.handler != None:
+            self.simulator.schedule(0, self.handler, *item)
+        else:
+            super().put(item)
+        return True
+
+class Simulator:
+    """
+        Discrete-event runtime with a virtual clock: the event handlers of the layers are called one at a time,
+        in a single thread, in the order of their virtual time, so whole clusters run in one process faster than real time.
+        All the randomness of the layers (self.random) and of the network comes from seed: runs are reproducible.
+
+        e.g.
+            sim = Simulator(seed=1)
+            net = SimulatedNetwork(sim, delay=0.01, loss=0.1)
+            fll = {pid : SimulatedFairLossLink(pid, net) for pid in processes}
+            pl = {pid : link.PerfectLinkPingPong(fll[pid], timeout=0.5) for pid in processes}
+            ...
+            sim.run(until=60)
+    """
+
+    def __init__(self, seed = 0) -> None:
+        self.now = 0.0
+        self.events = [] # heap of (time, order, function, args)
+        self.order = itertools.count() # events at the same time run in the order they were scheduled
+        self.random = random.Random(seed)
+        self.processed = 0
+
+    ### RUNTIME
+    def time(self) -> float:
+        return self.now
+
+    def queue(self, maxsize : int = 0, overflow : str = 'block', classes : int = 1) -> SimulatedQueue:
+        return SimulatedQueue(self)
+
+    def handle(self, eventQueue : SimulatedQueue, handlerFunction) -> None:
+        eventQueue.attach(handlerFunction)
+
+    def every(self, seconds : float, function, delay : float = None) -> None:
+        self.schedule(seconds if delay == None else delay, self.runPeriodically, seconds, function)
+
+    def runPeriodically(self, seconds : float, function) -> None:
+        try:
+            function()
+        finally:
+            self.schedule(seconds, self.runPeriodically, seconds, function)
+
+    def after(self, seconds : float, function) -> None:
+        """ calls function() once, seconds virtual seconds from now """
+        self.schedule(seconds, function)
+
+    ### SCHEDULING
+    def schedule(self, delay : float, function, *args) -> None:
+        """ calls function(*args) delay virtual seconds from now """
+        heapq.heappush(self.events, (self.now + delay, next(self.order), function, args))
+
+    def step(self) -> bool:
+        """ processes the next event, returns False if there is none """
+        if not self.events:
+            return False
+        self.now, _, function, args = heapq.heappop(self.events)
+        self.processed += 1
+        try:
+            function(*args)
+        except Exception as ex:
+            _, _, exc_tb = sys.exc_info()
+            logger.debug('Exception in '+str(sys._getframe(  ).f_code.co_name)+":"+str(exc_tb.tb_lineno)+" - "+str(type(ex))+' : '+str(ex)+" - event: "+str(args)+' - function handler: '+str(function))
+        return True
+
+    def run(self, until : float = None) -> None:
+        """
+            processes the events up to the virtual time until, or until there are no more events
+            (the periodic events of the layers never end: until is needed as soon as a layer is running)
+        """
+        while self.events and (until == None or self.events[0][0] <= until):
+            self.step()
+        if until != None:
+            self.now = max(self.now, until)
+
+class SimulatedNetwork:
+    """
+        In-memory network among SimulatedFairLossLinks: every message is delivered after a delay, uniformly drawn in
+        [delay, delay + jitter], or lost with probability loss. Delay and loss can be set per directed link.
+        Messages can be reordered.
+    """
+
+    def __init__(self, simulator : Simulator, delay : float = 0.001, jitter : float = 0.0, loss : float = 0.0) -> None:
+        """
+        Args:
+            delay (float): minimum virtual seconds taken by a message to reach its destination
+            jitter (float): maximum extra delay of a message
+            loss (float): probability that a message is lost
+        """
+        self.simulator = simulator
+        self.default = (delay, jitter, loss)
+        self.links = {}   # (pid_sender, pid_receiver) -> (delay, jitter, loss)
+        self.nodes = {}   # pid -> SimulatedFairLossLink
+        self.crashed = set()
+        self.sent = 0
+        self.lost = 0
+
+    def setLink(self, pid_sender, pid_receiver, delay : float = None, jitter : float = None, loss : float = None) -> None:
+        """ changes the properties of the link from pid_sender to pid_receiver, the ones not given are unchanged """
+        current = self.links.get((pid_sender, pid_receiver), self.default)
+        self.links[(pid_sender, pid_receiver)] = tuple(current[i] if value == None else value for i, value in enumerate((delay, jitter, loss)))
+
+    def crash(self, pid) -> None:
+        """ pid stops sending and receiving messages, its layers keep running in isolation """
+        self.crashed.add(pid)
+
+    def register(self, fll) -> None:
+        self.nodes[fll.pid] = fll
+
+    def transmit(self, pid_sender, pid_receiver, data : bytes) -> None:
+        self.sent += 1
+        delay, jitter, loss = self.links.get((pid_sender, pid_receiver), self.default)
+        rnd = self.simulator.random
+        if pid_sender in self.crashed or pid_receiver in self.crashed or pid_receiver not in self.nodes or (loss and rnd.random() < loss):
+            self.lost += 1
+            return
+        self.simulator.schedule(delay + (rnd.uniform(0, jitter) if jitter else 0), self.arrive, pid_sender, pid_receiver, data)
+
+    def arrive(self, pid_sender, pid_receiver, data : bytes) -> None:
+        if pid_receiver in self.crashed: # crashed while the message was in transit
+            self.lost += 1
+            return
+        fll = self.nodes[pid_receiver]
+        fll.deliver(pid_sender, fll.codec.decode(data))
+
+class SimulatedFairLossLink(FairLossLink):
+    """
+        2.4.2 Fair-Loss Links on a SimulatedNetwork: the layers built on it run on the simulator instead of threads.
+        Messages are still encoded, so that the receiver never shares objects with the sender.
+    """
+
+    def __init__(self, pid, network : SimulatedNetwork, codec : Codec = None, queue_size : int = 0, overflow : str = 'block') -> None:
+        self.pid = pid
+        self.network = network
+        self.runtime = network.simulator
+        self.codec = codec if codec != None else BinaryCodec()
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.deliver_events = None
+        network.register(self)
+
+    def destinations(self) -> list:
+        return list(self.network.nodes)
+
+    ### INTERFACES
+    def transmit(self, pid_receiver, data : bytes, priority : int = None):
+        self.network.transmit(self.pid, pid_receiver, data) # no queue to jump, priority is not needed
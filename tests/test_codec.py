@@ -0,0 +1,109 @@
+import pytest
+
+from codec import BinaryCodec, JSONCodec, Encoded
+from message import envelope, HEARTBEAT_REQUEST, SWIM_PING
+
+HELLO = ['MID:1', 'Hello!']
+HEARTBEAT = ['MT:HeartbeatRequest', 'MID:42']
+
+# (message, kind of its BinaryCodec encoding)
+MESSAGES = [
+    (HEARTBEAT, BinaryCodec.CONTROL),
+    (envelope(HEARTBEAT_REQUEST, 7), BinaryCodec.CONTROL | BinaryCodec.ENVELOPE),
+    (['pl_DATA', 3, HEARTBEAT], BinaryCodec.DATA_CONTROL),
+    (['pl_DATA', 3, HEARTBEAT, 2, []], BinaryCodec.DATA_CONTROL_ACK),
+    (['pl_DATA', 3, envelope(SWIM_PING, 9), 2, [], 16], BinaryCodec.DATA_CONTROL_ACK_WINDOW | BinaryCodec.ENVELOPE),
+    (['pl_ACK', 'pl_DATA', 3, HEARTBEAT], BinaryCodec.ACK_CONTROL),
+    (['pl_ACK', 5, []], BinaryCodec.ACK),
+    (['pl_ACK', 5, [], 4], BinaryCodec.ACK_WINDOW),
+    (['pl_DATA', 3, HELLO], BinaryCodec.DATA_ENCODED),
+    (['pl_DATA', 3, HELLO, 7, [[9, 10], [12, 12]]], BinaryCodec.DATA_ACK),
+    (['pl_DATA', 3, HELLO, -1, [[1, 1]], 4], BinaryCodec.DATA_ACK_WINDOW),
+    (['pl_DATA', 3, HEARTBEAT, 2, [[4, 4]]], BinaryCodec.DATA_ACK),
+    (['pl_ACK', 5, [[7, 8], [10, 2**64 - 1]]], BinaryCodec.ACK_RANGES),
+    (['pl_ACK', -1, [[1, 2]], 3], BinaryCodec.ACK_RANGES_WINDOW),
+    (['pl_ACK', 'pl_DATA', 4, HELLO], BinaryCodec.ACK_ENCODED),
+    (['pl_DATA', 3, {'key' : [1, 'a', None, True, 1.5]}], BinaryCodec.DATA_ENCODED),
+    # generic encoding: anything else, also the malformed messages of the links
+    (HELLO, BinaryCodec.GENERIC),
+    ([], BinaryCodec.GENERIC),
+    ([1], BinaryCodec.GENERIC),
+    ([0, 1, 2, 3], BinaryCodec.GENERIC),
+    ([1, 'app data'], BinaryCodec.GENERIC),
+    ([1, 1, None, None], BinaryCodec.GENERIC),
+    ('text', BinaryCodec.GENERIC),
+    (None, BinaryCodec.GENERIC),
+    (['MT:HeartbeatRequest', 'MID:01'], BinaryCodec.GENERIC), # not canonical
+    (['MT:Unknown', 'MID:1'], BinaryCodec.GENERIC),
+    (envelope(HEARTBEAT_REQUEST, 7, 'a'), BinaryCodec.GENERIC), # sender and payload are not in the header
+    (['pl_DATA'], BinaryCodec.GENERIC),
+    (['pl_DATA', 'x', 'y'], BinaryCodec.GENERIC),
+    (['pl_DATA', -3, HELLO], BinaryCodec.GENERIC),
+    (['pl_DATA', True, HELLO], BinaryCodec.GENERIC),
+    (['pl_DATA', 3, HELLO, 7], BinaryCodec.GENERIC),
+    (['pl_DATA', 3, HELLO, 7, [[1]]], BinaryCodec.GENERIC),
+    (['pl_DATA', 3, HELLO, 7, [[1, 2.5]]], BinaryCodec.GENERIC),
+    (['pl_DATA', 3, HELLO, 7, [], 2**32], BinaryCodec.GENERIC),
+    (['pl_ACK', 'z'], BinaryCodec.GENERIC),
+    (['pl_ACK', 'z', []], BinaryCodec.GENERIC),
+    (['pl_ACK', 5, [[-1, 2]]], BinaryCodec.GENERIC),
+    (['pl_ACK', 2**63, [[1, 2]]], BinaryCodec.GENERIC),
+    (['pl_ACK', 'pl_DATA', 'x', HELLO], BinaryCodec.GENERIC),
+]
+
+@pytest.mark.parametrize('message, kind', MESSAGES)
+def test_binary_round_trip(message, kind):
+    codec = BinaryCodec()
+    data = codec.encode(message)
+    assert data[0] == kind
+    assert codec.decode(data) == message
+    assert codec.decode(memoryview(bytearray(data))) == message # as received in the buffer of a FrameReader
+
+@pytest.mark.parametrize('message, kind', MESSAGES)
+def test_marshal_round_trip(message, kind):
+    codec = BinaryCodec(marshal=True)
+    data = codec.encode(message)
+    assert data[0] == (BinaryCodec.GENERIC_MARSHAL if kind == BinaryCodec.GENERIC else kind)
+    assert codec.decode(memoryview(data)) == message
+
+@pytest.mark.parametrize('message, _', MESSAGES)
+def test_json_round_trip(message, _):
+    codec = JSONCodec()
+    assert codec.decode(memoryview(codec.encode(message))) == message
+
+def test_marshal_types():
+    codec = BinaryCodec(marshal=True)
+    message = ['pl_DATA', 3, (1, b'bytes', {1, 2}, 1j)]
+    assert codec.decode(codec.encode(message)) == message
+
+def test_generic_tuples_are_lists():
+    codec = BinaryCodec()
+    assert codec.decode(codec.encode(('MID:1', (1, 2)))) == ['MID:1', [1, 2]]
+
+def test_marshal_not_decoded_unless_enabled():
+    data = BinaryCodec(marshal=True).encode(HELLO)
+    with pytest.raises(ValueError):
+        BinaryCodec().decode(data)
+
+def test_json_not_serializable():
+    with pytest.raises(TypeError):
+        BinaryCodec().encode(['pl_DATA', 3, b'bytes'])
+
+def test_unknown_kind():
+    with pytest.raises(ValueError):
+        BinaryCodec().decode(bytes((0x7f, 0)))
+
+def test_encode_data_reuses_the_encoding():
+    codec = BinaryCodec()
+    for message in (HELLO, HEARTBEAT, envelope(HEARTBEAT_REQUEST, 7)):
+        encoded = Encoded(message, codec)
+        data = codec.encodeData(3, encoded)
+        assert data.endswith(encoded.data)
+        assert codec.decode(data) == ['pl_DATA', 3, message]
+
+def test_registered_tags():
+    codec = BinaryCodec()
+    codec.registerTag('MT:Custom')
+    data = codec.encode(['MT:Custom', 'MID:3'])
+    assert data[0] == BinaryCodec.CONTROL
+    assert codec.decode(data) == ['MT:Custom', 'MID:3']
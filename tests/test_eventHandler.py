@@ -0,0 +1,86 @@
+import queue
+import threading
+
+import pytest
+
+from eventHandler import BoundedQueue, ClassQueue
+from message import CONTROL, DATA
+
+def drain(q) -> list:
+    items = []
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            return items
+
+def test_most_urgent_class_first():
+    q = ClassQueue()
+    for item, priority in (('d1', DATA), ('c1', CONTROL), ('d2', DATA), ('c2', CONTROL), ('d3', None)):
+        q.put(item, priority=priority)
+    assert q.depths() == [2, 3]
+    assert drain(q) == ['c1', 'c2', 'd1', 'd2', 'd3']
+
+@pytest.mark.parametrize('overflow', BoundedQueue.POLICIES)
+def test_control_never_waits_behind_data(overflow):
+    q = ClassQueue(2, overflow)
+    q.put('d1', block=False, priority=DATA)
+    q.put('d2', block=False, priority=DATA)
+    assert q.put('ctl', block=False, priority=CONTROL) # neither dropped nor blocked by the full data class
+    assert q.dropped == 0 and q.blocked == 0
+    assert drain(q) == ['ctl', 'd1', 'd2']
+
+def test_drop_newest_data():
+    q = ClassQueue(2, 'drop_newest')
+    assert q.put('d1', priority=DATA) and q.put('d2', priority=DATA)
+    assert not q.put('d3', priority=DATA)
+    assert q.dropped == 1
+    assert drain(q) == ['d1', 'd2']
+
+def test_drop_oldest_data_only():
+    q = ClassQueue(2, 'drop_oldest')
+    for item, priority in (('c1', CONTROL), ('d1', DATA), ('c2', CONTROL), ('d2', DATA), ('d3', DATA)):
+        assert q.put(item, priority=priority)
+    assert q.dropped == 1
+    assert drain(q) == ['c1', 'c2', 'd2', 'd3']
+
+def test_control_items_do_not_fill_the_queue():
+    q = ClassQueue(2, 'drop_newest')
+    for i in range(5):
+        q.put('c'+str(i), priority=CONTROL)
+    assert q.put('d1', priority=DATA) and q.put('d2', priority=DATA)
+    assert not q.put('d3', priority=DATA)
+    assert drain(q) == ['c0', 'c1', 'c2', 'c3', 'c4', 'd1', 'd2']
+
+def test_block_data():
+    q = ClassQueue(1, 'block')
+    q.put('d1', priority=DATA)
+    with pytest.raises(queue.Full):
+        q.put('d2', block=False, priority=DATA)
+    with pytest.raises(queue.Full):
+        q.put('d2', timeout=0.01, priority=DATA)
+    assert q.blocked == 2
+    unblocked = threading.Event()
+    def put():
+        q.put('d2', priority=DATA)
+        unblocked.set()
+    threading.Thread(target=put, daemon=True).start()
+    assert not unblocked.wait(0.05)
+    q.put('ctl', priority=CONTROL) # a control item does not free a data slot
+    assert not unblocked.wait(0.05)
+    assert q.get() == 'ctl'
+    assert not unblocked.wait(0.05)
+    assert q.get() == 'd1'
+    assert unblocked.wait(1)
+    assert q.get() == 'd2'
+
+@pytest.mark.parametrize('overflow, put, kept', [('drop_newest', [True, True, False], [1, 2]), ('drop_oldest', [True] * 3, [2, 3])])
+def test_bounded_queue_drop(overflow, put, kept):
+    q = BoundedQueue(2, overflow)
+    assert [q.put(i) for i in (1, 2, 3)] == put
+    assert q.dropped == 1
+    assert drain(q) == kept
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        BoundedQueue(1, 'drop_everything')
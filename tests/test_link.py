@@ -0,0 +1,86 @@
+import asyncio
+import socket
+import struct
+import threading
+import types
+
+import pytest
+
+from link import FrameReader, FrameTooLarge, BufferPool, IncomingConnection, FRAME_HEADER, MAX_FRAME_SIZE, frame
+
+def read_all(sock, **kwargs) -> list:
+    reader = FrameReader(sock, **kwargs)
+    try:
+        return [bytes(payload) for payload in reader.frames()]
+    finally:
+        reader.close()
+
+def send(sock, data : bytes) -> None:
+    """ sends data and closes sock on another thread, data can be larger than the socket buffers """
+    def run():
+        with sock:
+            sock.sendall(data)
+    threading.Thread(target=run, daemon=True).start()
+
+def test_frames():
+    a, b = socket.socketpair()
+    payloads = [b'', b'x', b'y' * 100, b'z' * 200000] # the last one is larger than the pooled buffer
+    send(a, b''.join(frame(payload) for payload in payloads))
+    with b:
+        assert read_all(b, pool=BufferPool(buffer_size=64)) == payloads
+
+def test_frames_split_in_single_bytes():
+    a, b = socket.socketpair()
+    data = frame(b'hello') + frame(b'world')
+    with a:
+        for i in range(len(data)):
+            a.send(data[i:i+1])
+    with b:
+        assert read_all(b, pool=BufferPool(buffer_size=8)) == [b'hello', b'world']
+
+def test_max_frame_size():
+    a, b = socket.socketpair()
+    with a:
+        a.sendall(frame(b'x' * 16) + frame(b'y' * 17))
+    with b:
+        reader = FrameReader(b, max_frame_size=16)
+        frames = reader.frames()
+        assert bytes(next(frames)) == b'x' * 16
+        with pytest.raises(FrameTooLarge):
+            next(frames)
+        reader.close()
+
+def test_corrupt_header_is_not_allocated():
+    a, b = socket.socketpair()
+    with a:
+        a.sendall(FRAME_HEADER.pack(2**32 - 1) + b'garbage')
+    with b:
+        reader = FrameReader(b)
+        size = len(reader.buffer)
+        with pytest.raises(FrameTooLarge):
+            next(reader.frames())
+        assert len(reader.buffer) == size
+        reader.close()
+    assert MAX_FRAME_SIZE < 2**32 - 1
+
+def test_frame_too_large_is_a_connection_error():
+    # the receiving loops of the TCP links close the socket on a socket.error
+    assert issubclass(FrameTooLarge, socket.error)
+
+def test_asyncio_connection_closed_on_frame_too_large():
+    delivered = []
+    fll = types.SimpleNamespace(pid='b', deliver=lambda pid, message: delivered.append((pid, message)),
+                                codec=types.SimpleNamespace(decode=bytes))
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: IncomingConnection(fll), '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        writer.write(frame(b'a') + frame(b'ok') + struct.pack('!I', MAX_FRAME_SIZE + 1) + b'garbage')
+        closed = await asyncio.wait_for(reader.read(), 5) == b''
+        writer.close()
+        server.close()
+        return closed
+
+    assert asyncio.run(run())
+    assert delivered == [('a', b'ok')]
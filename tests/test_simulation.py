@@ -0,0 +1,117 @@
+import collections
+
+import pytest
+
+import link
+import failure_detector
+from message import priorityOf, envelope, DATA, HEARTBEAT_REQUEST
+from simulation import Simulator, SimulatedNetwork, SimulatedFairLossLink
+
+PROCESSES = ('0', '1', '2', '3', '4')
+MESSAGES = 100 # from every process to every other one
+
+def cluster(seed : int, loss : float, cumulative_acks : bool = True, fd_timeout : float = 2):
+    """ PerfectLinkPingPong and PerfectFailureDetector on every process of a lossy, reordering simulated network """
+    sim = Simulator(seed)
+    net = SimulatedNetwork(sim, delay=0.01, jitter=0.05, loss=loss)
+    pls, deliveries, crashes = {}, {}, {}
+    for p in PROCESSES:
+        pls[p] = link.PerfectLinkPingPong(SimulatedFairLossLink(p, net), timeout=0.2, cumulative_acks=cumulative_acks)
+        deliveries[p] = pls[p].getDeliverEvents()
+        fd = failure_detector.PerfectFailureDetector(PROCESSES, fd_timeout, pls[p])
+        crashes[p] = fd.getCrashEvents()
+    return sim, net, pls, deliveries, crashes
+
+def sendAll(pls) -> None:
+    for p, pl in pls.items():
+        for i in range(MESSAGES):
+            for q in PROCESSES:
+                if q != p:
+                    pl.send(q, ['MID:'+str(i), p+'->'+q])
+
+def drain(q) -> list:
+    return [q.get_nowait() for _ in range(q.qsize())]
+
+@pytest.mark.parametrize('cumulative_acks', (True, False))
+@pytest.mark.parametrize('seed', (1, 2))
+def test_exactly_once_under_loss(seed, cumulative_acks):
+    sim, net, pls, deliveries, crashes = cluster(seed, loss=0.2, cumulative_acks=cumulative_acks)
+    sendAll(pls)
+    sim.run(until=30)
+    assert net.lost > 0
+    for q in PROCESSES:
+        delivered = collections.Counter((p, message[0], message[1]) for p, message in drain(deliveries[q]))
+        expected = {(p, 'MID:'+str(i), p+'->'+q) for p in PROCESSES if p != q for i in range(MESSAGES)}
+        assert set(delivered) == expected
+        assert max(delivered.values()) == 1
+        assert drain(crashes[q]) == [] # no false crash detection
+        # only heartbeats can still wait for their ack, they are sent every period
+        assert [entry for pending in pls[q].waitingForAck.values() for entry in pending.values() if priorityOf(entry[0]) == DATA] == []
+
+def test_reproducible():
+    runs = []
+    for _ in range(2):
+        sim, net, pls, deliveries, crashes = cluster(3, loss=0.2)
+        sendAll(pls)
+        sim.run(until=10)
+        runs.append((sim.processed, net.sent, net.lost, [drain(deliveries[q]) for q in PROCESSES]))
+    assert runs[0] == runs[1]
+
+def test_crash_detected_and_pending_cancelled():
+    sim, net, pls, deliveries, crashes = cluster(4, loss=0.1)
+    sim.run(until=5)
+    net.crash('4')
+    for i in range(10):
+        pls['0'].send('4', ['MID:'+str(i), 'lost'])
+    sim.run(until=20)
+    for q in PROCESSES[:4]:
+        assert drain(crashes[q]) == ['4']
+    assert not pls['0'].waitingForAck.get('4')
+
+def test_control_messages_not_backed_off():
+    sim = Simulator()
+    pl = link.PerfectLinkPingPong(SimulatedFairLossLink('0', SimulatedNetwork(sim)), timeout=5, jitter=0)
+    heartbeat = ['pl_DATA', 0, envelope(HEARTBEAT_REQUEST, 0)]
+    assert [pl.retransmissionTimeout(n, priorityOf(heartbeat)) for n in range(5)] == [5] * 5
+    assert [pl.retransmissionTimeout(n) for n in range(5)] == [5, 10, 20, 40, 40]
+
+def test_heartbeat_retransmitted_within_the_period():
+    sim, net, pls, deliveries, crashes = cluster(6, loss=0, fd_timeout=1)
+    net.setLink('1', '0', loss=1) # every heartbeat reply and ack from 1 to 0 is lost for a while
+    sim.run(until=0.7)
+    net.setLink('1', '0', loss=0)
+    sim.run(until=10)
+    assert drain(crashes['0']) == []
+
+def pair(**kwargs):
+    sim = Simulator(7)
+    net = SimulatedNetwork(sim, delay=0.01)
+    pls = {p : link.PerfectLinkPingPong(SimulatedFairLossLink(p, net), timeout=1, jitter=0, **kwargs) for p in ('a', 'b')}
+    return sim, net, pls
+
+def test_idle_link_schedules_no_ack_flush():
+    sim, net, pls = pair()
+    sim.run(until=10)
+    # the ticks of the retransmission wheels only (tick of timeout / 10), no periodic ack flush
+    assert sim.processed <= 2 * (10 / 0.1 + 1)
+
+def test_cumulative_acks_coalesced():
+    sim, net, pls = pair(ack_delay=0.05)
+    deliveries = pls['b'].getDeliverEvents()
+    for i in range(100):
+        pls['a'].send('b', ['MID:'+str(i), i])
+    sim.run(until=1)
+    assert [message[1] for _, message in drain(deliveries)] == list(range(100))
+    assert pls['b'].metrics.acks_sent.value() == 1 # a single flush for the whole burst
+    assert net.sent == 101
+    assert not pls['a'].waitingForAck['b']
+
+def test_acks_piggybacked_on_replies():
+    sim, net, pls = pair(ack_delay=0.05)
+    deliveries = pls['b'].getDeliverEvents()
+    sim.handle(deliveries, lambda p, message: pls['b'].send(p, ['MID:'+str(message[1]), 'reply']))
+    for i in range(10):
+        pls['a'].send('b', ['MID:'+str(i), i])
+    sim.run(until=1)
+    assert pls['b'].metrics.acks_sent.value() == 0 # every ack went out on a reply
+    assert not pls['a'].waitingForAck['b']
@@ -0,0 +1,65 @@
+import pytest
+
+import tracer
+from message import envelope, HEARTBEAT_REQUEST
+from simulation import Simulator, SimulatedNetwork, SimulatedFairLossLink
+
+@pytest.mark.parametrize('message, message_id', [
+    (['pl_DATA', 7, ['MID:1', 'Hello!']], 7),
+    (['pl_ACK', 12, []], 12),
+    (['pl_ACK', 'pl_DATA', 3, ['MID:1', 'Hello!']], 3),
+    (envelope(HEARTBEAT_REQUEST, 42), 42),
+    (['MID:5', 'Hello!'], 5),
+    (['MT:HeartbeatRequest', 'MID:9'], 9),
+])
+def test_message_id(message, message_id):
+    assert tracer.messageId(message) == message_id
+
+@pytest.mark.parametrize('message', [
+    ['pl_ACK', 'z'],
+    ['pl_ACK'],
+    ['pl_DATA'],
+    ['pl_DATA', 'x', 'y'],
+    ['pl_ACK', 'pl_DATA'],
+    ['pl_ACK', 'pl_DATA', 'x', None],
+    ['pl_ACK', -1, [[1, 1]]],
+    ['pl_DATA', 2**64, 'x'],
+    ['pl_DATA', True, 'x'],
+    ['pl_DATA', 1.5, 'x'],
+    envelope(HEARTBEAT_REQUEST, -1),
+    envelope(HEARTBEAT_REQUEST, 'MID:1'),
+    ['MID:-1', 'x'],
+    ['MID:²', 'x'], # a digit for str.isdigit, not for int
+    ['MID:', 'x'],
+    [],
+    'MID:1',
+    None,
+    {'msg' : 1},
+])
+def test_message_id_of_malformed_messages(message):
+    assert tracer.messageId(message) == tracer.NO_ID
+
+def test_record_clamps_message_ids(tmp_path):
+    path = str(tmp_path / 'trace')
+    t = tracer.Tracer(path, 'a', capacity=8)
+    for message_id in (5, -1, 2**64, 'y', None):
+        t.record(tracer.FLL, tracer.SEND, 'b', message_id)
+    t.close()
+    assert [r[5] for r in tracer.readTrace(path)] == [5] + [tracer.NO_ID] * 4
+
+def test_malformed_messages_are_sent_with_tracing(tmp_path):
+    path = str(tmp_path / 'trace')
+    sim = Simulator(seed=1)
+    net = SimulatedNetwork(sim)
+    a, b = SimulatedFairLossLink('a', net), SimulatedFairLossLink('b', net)
+    deliveries = b.getDeliverEvents()
+    tracer.enable(path, 'a')
+    try:
+        a.send('b', ['pl_ACK', 'z'])
+        a.send('b', ['pl_DATA', 'x', 'y'])
+        sim.run()
+    finally:
+        tracer.disable()
+    assert [deliveries.get_nowait()[1] for _ in range(2)] == [['pl_ACK', 'z'], ['pl_DATA', 'x', 'y']]
+    records = tracer.readTrace(path)
+    assert [(r[3], r[5]) for r in records] == [(tracer.SEND, tracer.NO_ID)] * 2 + [(tracer.DELIVER, tracer.NO_ID)] * 2
@@ -0,0 +1,190 @@
+import argparse
+import itertools
+import mmap
+import os
+import struct
+import sys
+import time
+from message import isEnvelope, MID
+
+# Binary tracing of the events of the layers (send, deliver, retransmission, crash, suspect, restore), cheap enough to stay enabled:
+# every event is a fixed-size record written in a ring buffer mapped on a file, so the trace survives a crash of the process.
+#
+#   tracer.enable('node0.trace', pid)                       # in the process, see also process.py --trace
+#   python3 tracer.py merge node*.trace                     # global timeline of all the nodes
+#   python3 tracer.py replay node0.trace --link persistent  # replays the send schedule of a node on loopback
+
+# layers
+FLL, SL, PL, FD = range(4)
+LAYERS = ('fll', 'sl', 'pl', 'fd')
+# events
+SEND, DELIVER, RETRANSMIT, CRASH, SUSPECT, RESTORE = range(6)
+EVENTS = ('send', 'deliver', 'retransmit', 'crash', 'suspect', 'restore')
+
+NO_ID = 2**64 - 1 # event without message id
+
+HEADER = struct.Struct('<8sIIQ32sd')  # magic, version, capacity (records), written records, pid, wall clock time of the start
+RECORD = struct.Struct('<dBBxxI32sQ') # seconds since the start, layer, event, size (bytes), peer pid, message id
+MAGIC = b'DDSTRACE'
+VERSION = 1
+
+TRACER = None # enabled Tracer of the process
+
+def messageId(message) -> int:
+    """
+        sequence number of the perfect link messages (and watermark of the acks), message id of the envelopes, number n of 'MID:n',
+        NO_ID otherwise, also for malformed messages: tracing must never make a layer fail
+    """
+    message_id = NO_ID
+    if type(message) is list and message:
+        if isEnvelope(message):
+            message_id = message[MID]
+        elif message[0] == 'pl_DATA' or message[0] == 'pl_ACK':
+            if len(message) > 1:
+                message_id = message[1]
+                if message_id == 'pl_DATA' and len(message) > 2: # echo ack ['pl_ACK', 'pl_DATA', seq, message]
+                    message_id = message[2]
+        else:
+            for item in message[:2]:
+                if type(item) is str and item[:4] == 'MID:' and item[4:].isascii() and item[4:].isdigit():
+                    message_id = int(item[4:])
+                    break
+    if type(message_id) is not int or not 0 <= message_id < NO_ID:
+        return NO_ID
+    return message_id
+
+class Tracer:
+    """ ring buffer of capacity records mapped on path: once full, the oldest records are overwritten """
+
+    def __init__(self, path : str, pid, capacity : int = 1 << 20) -> None:
+        self.capacity = capacity
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self.fd, HEADER.size + capacity * RECORD.size)
+        self.buffer = mmap.mmap(self.fd, HEADER.size + capacity * RECORD.size)
+        self.start_wall = time.time()
+        self.start = time.monotonic()
+        self.pid = str(pid)
+        self.counter = itertools.count() # next() is atomic: every thread gets its own slot
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, capacity, 0, self.pid.encode('utf-8'), self.start_wall)
+
+    def record(self, layer : int, event : int, peer, message_id : int = NO_ID, size : int = 0) -> None:
+        if type(message_id) is not int or not 0 <= message_id < NO_ID: # tracing must never make a layer fail
+            message_id = NO_ID
+        n = next(self.counter)
+        RECORD.pack_into(self.buffer, HEADER.size + (n % self.capacity) * RECORD.size,
+                         time.monotonic() - self.start, layer, event, size, str(peer).encode('utf-8'), message_id)
+        struct.pack_into('<Q', self.buffer, 16, n + 1) # written records, approximate while threads are writing
+
+    def flush(self) -> None:
+        self.buffer.flush()
+
+    def close(self) -> None:
+        self.buffer.flush()
+        self.buffer.close()
+        os.close(self.fd)
+
+def enable(path : str, pid, capacity : int = 1 << 20) -> Tracer:
+    """ starts tracing the events of the process (capacity records of RECORD.size bytes) """
+    global TRACER
+    TRACER = Tracer(path, pid, capacity)
+    return TRACER
+
+def disable() -> None:
+    global TRACER
+    tracer, TRACER = TRACER, None
+    if tracer != None:
+        tracer.close()
+
+### OFFLINE TOOLS
+
+def readTrace(path : str) -> list:
+    """ records of a trace, oldest first: [(wall clock time, pid, layer, event, peer, message id, size)] """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    magic, version, capacity, written, pid, start_wall = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(path+' is not a trace')
+    pid = pid.rstrip(b'\0').decode('utf-8')
+    first = max(0, written - capacity)
+    records = []
+    for n in range(first, written):
+        t, layer, event, size, peer, message_id = RECORD.unpack_from(data, HEADER.size + (n % capacity) * RECORD.size)
+        records.append((start_wall + t, pid, layer, event, peer.rstrip(b'\0').decode('utf-8'), message_id, size))
+    records.sort(key=lambda r: r[0]) # concurrent writers may have filled their slots out of order
+    return records
+
+def merge(paths : list, out = sys.stdout) -> None:
+    """ global timeline of the events of all the traces (the clocks of the nodes are assumed synchronized) """
+    records = sorted((r for path in paths for r in readTrace(path)), key=lambda r: r[0])
+    for t, pid, layer, event, peer, message_id, size in records:
+        out.write('%.6f %s %s %s %s %s %d\n' % (t, pid, LAYERS[layer], EVENTS[event], peer, '-' if message_id == NO_ID else message_id, size))
+
+def replay(path : str, link_kind : str = 'persistent', speed : float = 1, base_port : int = 7500) -> dict:
+    """
+        replays the fair-loss sends of a trace (same sizes, same relative times divided by speed) from one link to another
+        on loopback, returns delivered messages and the lag of the deliveries with respect to the schedule
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import link
+    schedule = [(r[0], r[6]) for r in readTrace(path) if r[2] == FLL and r[3] == SEND]
+    if not schedule:
+        return {'scheduled' : 0}
+    addresses = {'a' : ('127.0.0.2', base_port), 'b' : ('127.0.0.3', base_port + 1)}
+    flls = {}
+    for pid in addresses:
+        ip, port = addresses[pid]
+        if link_kind == 'simple':
+            flls[pid] = link.FairLossLink_vTCP_simple(pid, port, addresses, source_address=ip)
+        elif link_kind == 'mtc':
+            flls[pid] = link.FairLossLink_vTCP_MTC(pid, port, addresses, source_address=ip)
+        elif link_kind == 'persistent':
+            flls[pid] = link.FairLossLink_vTCP_persistent(pid, port, addresses)
+        elif link_kind == 'asyncio':
+            flls[pid] = link.FairLossLink_vAsyncio(pid, port, addresses)
+        else:
+            flls[pid] = link.FairLossLink_vUDP(pid, port, addresses)
+    deliveries = flls['b'].getDeliverEvents()
+    time.sleep(0.2) # listening sockets
+
+    first = schedule[0][0]
+    start = time.monotonic()
+    lags = []
+    for i, (t, size) in enumerate(schedule):
+        due = start + (t - first) / speed
+        while True: # deliveries are consumed while waiting for the next send
+            wait = due - time.monotonic()
+            if wait <= 0:
+                break
+            try:
+                _, message = deliveries.get(timeout=wait)
+                lags.append(time.monotonic() - message[1])
+            except Exception:
+                pass
+        flls['a'].send('b', [i, due, 'x' * max(0, size - 24)]) # about the recorded encoded size
+    while len(lags) < len(schedule):
+        try:
+            _, message = deliveries.get(timeout=5)
+            lags.append(time.monotonic() - message[1])
+        except Exception: # the missing messages are lost
+            break
+    lags.sort()
+    return {'scheduled' : len(schedule), 'delivered' : len(lags), 'duration' : time.monotonic() - start,
+            'lag_p50_ms' : lags[len(lags) // 2] * 1000 if lags else None, 'lag_p99_ms' : lags[min(len(lags) - 1, int(0.99 * len(lags)))] * 1000 if lags else None}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tools for the binary traces of the processes')
+    commands = parser.add_subparsers(dest='command', required=True)
+    merge_parser = commands.add_parser('merge', help='prints the global timeline of the events of the traces')
+    merge_parser.add_argument('traces', nargs='+')
+    replay_parser = commands.add_parser('replay', help='replays the fair-loss send schedule of a trace on loopback')
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--link', default='persistent', choices=('simple', 'mtc', 'persistent', 'asyncio', 'udp'))
+    replay_parser.add_argument('--speed', type=float, default=1, help='speed-up of the schedule')
+    replay_parser.add_argument('--base-port', type=int, default=7500)
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        merge(args.traces)
+    else:
+        print(replay(args.trace, args.link, args.speed, args.base_port))
+        os._exit(0) # the threads of the links never end